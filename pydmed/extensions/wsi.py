@@ -4,11 +4,13 @@ import numpy as np
 from abc import ABC, abstractmethod
 import random
 import time
-import openslide
 import copy
+import threading
 import torchvision
 import pydmed
 import pydmed.lightdl
+import pydmed.utils.imagereader
+import pydmed.utils.output
 from pydmed import *
 from pydmed.lightdl import *
 from datetime import datetime
@@ -22,6 +24,19 @@ def default_func_patient_to_fnameimage(patient_input):
     return fname_wsi
 
 
+def open_image_of_patient(patient, const_global_info):
+    '''
+    Opens the image of a patient as an `ImageReader` (see `pydmed.utils.imagereader`).
+    The path is given by `pdmreserved_func_patient_to_fnameimage` and the image is opened by 
+    `pdmreserved_func_open_image` (default is `pydmed.utils.imagereader.open_image`).
+    '''
+    fname_wsi = const_global_info["pdmreserved_func_patient_to_fnameimage"](patient)
+    func_open_image = const_global_info.get("pdmreserved_func_open_image", None)
+    if(func_open_image == None):
+        func_open_image = pydmed.utils.imagereader.open_image
+    return func_open_image(fname_wsi)
+
+
 def Tensor3DtoPdmcsvrow(np_input, smalchunk_input):
     '''
     Converts a Tensor of shape [C x H x W] to pdmcsv format.
@@ -44,6 +59,45 @@ def Tensor3DtoPdmcsvrow(np_input, smalchunk_input):
        str(np_input.flatten().tolist())[1:-1] + "\n"
     return str_toret
     
+'''
+The binary pdm format (pdmbin). Each record is a fixed-size header followed by the raw CxHxW payload.
+All fields are little-endian. The field `dtype` of the header is 0 for float32 and 1 for float16.
+'''
+PDMBIN_DTYPE_HEADER = np.dtype([
+    ("y", "<f8"), ("x", "<f8"), ("H", "<f8"), ("W", "<f8"),
+    ("patch_levelidx", "<f8"), ("kernel_size", "<f8"), ("downsample_of_patchlevel", "<f8"),
+    ("c", "<i4"), ("h", "<i4"), ("w", "<i4"), ("dtype", "<i4")
+])
+PDMBIN_LIST_DTYPES = [np.dtype("<f4"), np.dtype("<f2")]
+
+def Tensor3DtoPdmbinrecord(np_input, smalchunk_input, dtype=np.float32):
+    '''
+    Converts a Tensor of shape [C x H x W] to a record of the binary pdm format (pdmbin).
+    The output can be written by a `StreamWriter` created with `str_format="pdmbin"`.
+    Inputs.
+        - np_input: a numpy array of shape [CxHxW].
+        - smallchunk_input: an instnace of SmallChunk,
+                            the smallchunk that that the tensor corresponds to.
+        - dtype: the dtype of the payload, either np.float32 or np.float16.
+    Outputs.
+        - the record, an instance of `bytes`.
+    '''
+    chw = list(np_input.shape)
+    dtype_payload = np.dtype(dtype).newbyteorder("<")
+    np_header = np.zeros(1, dtype=PDMBIN_DTYPE_HEADER)
+    np_header[0] = (
+        _float_or_nan(smalchunk_input.dict_info_of_bigchunk["y"]),
+        _float_or_nan(smalchunk_input.dict_info_of_smallchunk["x"]),
+        _float_or_nan(smalchunk_input.dict_info_of_bigchunk["H"]),
+        _float_or_nan(smalchunk_input.dict_info_of_bigchunk["W"]),
+        _float_or_nan(smalchunk_input.dict_info_of_smallchunk["patch_levelidx"]),
+        _float_or_nan(smalchunk_input.dict_info_of_smallchunk["kernel_size"]),
+        _float_or_nan(smalchunk_input.dict_info_of_bigchunk["downsample_of_patchlevel"]),
+        chw[0], chw[1], chw[2],
+        PDMBIN_LIST_DTYPES.index(dtype_payload)
+      )
+    return np_header.tobytes() + np.ascontiguousarray(np_input, dtype=dtype_payload).tobytes()
+
 def _float_or_nan(x):
     try:
         return float(x)
@@ -51,11 +105,13 @@ def _float_or_nan(x):
         return np.nan
 
 
-def pdmcsvtoarray(fname_pdmcsv, func_WSIxyWHval_to_rasterpoints, scale_upsampleraster=1.0):
+def pdmcsvtoarray(fname_pdmcsv, func_WSIxyWHval_to_rasterpoints, scale_upsampleraster=1.0, str_blending="last", fill_value=0.0, flag_fillgaps=False):
     '''
     Converts a pdmcsv file to an array.
     Inputs.
         - fname_pdmcsv: a string, the path-filename to the pdmcsv file.
+            Compressed files (e.g., patient_1.csv.gz, see the argument `str_compression` of `StreamWriter`)
+            are decompressed on the fly.
         - outputsize: a float, the scale of output. The default value is 1.0 meaning the output
             array is not scaled.
         - func_WSIxyval_to_rasterpoints: a function.
@@ -69,40 +125,225 @@ def pdmcsvtoarray(fname_pdmcsv, func_WSIxyWHval_to_rasterpoints, scale_upsampler
                 - list_x_onraster:
                 - list_y_onraster:
                 - list_val_onraster:
+            If the function has the attribute `flag_valasarray` set to True (as in `DefaultWSIxyWHvaltoRasterPoints`),
+            `val` is passed as a 1D numpy array instead of a list, and the outputs can be numpy arrays.
+        - str_blending: how the overlapping tiles (e.g., when stride < kernel_size, or the last column/bigrow of the
+            sliding window which is shifted back to fit in the image) are stitched together. One of
+                "last": the last tile in the file overwrites the previous ones (default).
+                "average": the overlapping values are averaged.
+                "weighted": the overlapping values are averaged with weights that fall off towards the borders of each tile,
+                    so there is no visible seam between the tiles (see `pydmed.utils.output.get_tileweights`).
+        - fill_value: the value of the raster points which are not covered by any record, 
+            e.g., the positions of the tiles which are dropped by the argument `func_tilefilter` of `SlidingWindowDL`. Default is 0.0.
+        - flag_fillgaps: a boolean, default False. If True, the whole rows/columns of tiles which are dropped by 
+            `func_tilefilter` of `SlidingWindowDL` are added back to the output (with `fill_value`),
+            at the grid step inferred from the data. If False, the output only has the rows/columns that appear in the file.
+    '''
+    return _pdmrecordstoarray(_iter_pdmcsvrecords(fname_pdmcsv),
+                              func_WSIxyWHval_to_rasterpoints, scale_upsampleraster, str_blending, fill_value, flag_fillgaps)
+
+
+def _iter_pdmcsvrecords(fname_pdmcsv):
+    '''
+    Reads a pdmcsv file line-by-line, and yields the records as
+    [y, x, H, W, patch_levelidx, kernel_size, downsample_of_patchlevel, c, h, w, val],
+    where val is a 1D numpy array.
+    '''
+    with pydmed.utils.output.open_pdmfile(fname_pdmcsv, 'r') as file_pdmcsv:
+        for line in file_pdmcsv:
+            #parse the whole line at once, "None" values are converted to nan ====
+            list_tokens = line.replace("None", "nan").split(",")
+            try:
+                np_numbers = np.array(list_tokens, dtype=np.float64)
+            except ValueError:
+                np_numbers = np.array([_float_or_nan(u) for u in list_tokens], dtype=np.float64)
+            #order: y,x,H,W,....  
+            list_numbers = np_numbers[0:7].tolist()
+            yield list_numbers + [int(np_numbers[7]), int(np_numbers[8]), int(np_numbers[9]),
+                                  np_numbers[10:]]
+
+
+def read_pdmbin(fname_pdmbin):
+    '''
+    Reads a pdmbin file (see `Tensor3DtoPdmbinrecord`) without parsing, by memory-mapping the file.
+    Compressed files (e.g., patient_1.pdmbin.gz) cannot be memory-mapped, so they are decompressed to memory.
+    Outputs.
+        - np_headers: a numpy structured array of length N with the fields of `PDMBIN_DTYPE_HEADER`.
+        - vals: if all records have the same shape and dtype, a memory-mapped array of shape [N x C x H x W].
+                Otherwise, a list of N arrays of shape [C x H x W] (views of the memory-mapped file).
+    '''
+    size_header = PDMBIN_DTYPE_HEADER.itemsize
+    if(pydmed.utils.output.get_compression_of_fname(fname_pdmbin) is None):
+        if(os.path.getsize(fname_pdmbin) == 0):
+            return np.zeros(0, dtype=PDMBIN_DTYPE_HEADER), np.zeros((0,0,0,0), dtype=np.float32)
+        np_bytes = np.memmap(fname_pdmbin, dtype=np.uint8, mode="r")
+    else:
+        with pydmed.utils.output.open_pdmfile(fname_pdmbin, 'rb') as file_pdmbin:
+            np_bytes = np.frombuffer(file_pdmbin.read(), dtype=np.uint8)
+        if(np_bytes.shape[0] == 0):
+            return np.zeros(0, dtype=PDMBIN_DTYPE_HEADER), np.zeros((0,0,0,0), dtype=np.float32)
+    #the fast path, all records have the same size ====
+    header_first = np_bytes[0:size_header].view(PDMBIN_DTYPE_HEADER)[0]
+    chw = (int(header_first["c"]), int(header_first["h"]), int(header_first["w"]))
+    dtype_payload = PDMBIN_LIST_DTYPES[int(header_first["dtype"])]
+    dtype_record = np.dtype([("header", PDMBIN_DTYPE_HEADER), ("val", dtype_payload, chw)])
+    if((np_bytes.shape[0]%dtype_record.itemsize) == 0):
+        np_records = np_bytes.view(dtype_record)
+        np_headers = np_records["header"]
+        flag_uniform = np.all(np_headers["c"] == chw[0]) and np.all(np_headers["h"] == chw[1]) and\
+                       np.all(np_headers["w"] == chw[2]) and np.all(np_headers["dtype"] == header_first["dtype"])
+        if(flag_uniform):
+            return np_headers, np_records["val"]
+    #the general case, walk over the records ====
+    list_headers, list_vals = [], []
+    offset = 0
+    while(offset < np_bytes.shape[0]):
+        header = np_bytes[offset:offset+size_header].view(PDMBIN_DTYPE_HEADER)[0]
+        offset += size_header
+        chw = (int(header["c"]), int(header["h"]), int(header["w"]))
+        dtype_payload = PDMBIN_LIST_DTYPES[int(header["dtype"])]
+        size_payload = chw[0]*chw[1]*chw[2]*dtype_payload.itemsize
+        list_headers.append(header)
+        list_vals.append(np_bytes[offset:offset+size_payload].view(dtype_payload).reshape(chw))
+        offset += size_payload
+    return np.array(list_headers, dtype=PDMBIN_DTYPE_HEADER), list_vals
+
+
+def _iter_pdmbinrecords(fname_pdmbin):
+    '''
+    Same as `_iter_pdmcsvrecords`, but for pdmbin files.
+    Compressed files are decompressed record-by-record, so they are never fully loaded to memory.
+    '''
+    if(pydmed.utils.output.get_compression_of_fname(fname_pdmbin) is None):
+        np_headers, vals = read_pdmbin(fname_pdmbin)
+        for n in range(np_headers.shape[0]):
+            yield _pdmbinrecord_to_list(np_headers[n], vals[n])
+    else:
+        size_header = PDMBIN_DTYPE_HEADER.itemsize
+        with pydmed.utils.output.open_pdmfile(fname_pdmbin, 'rb') as file_pdmbin:
+            while True:
+                bytes_header = file_pdmbin.read(size_header)
+                if(len(bytes_header) < size_header):
+                    break
+                header = np.frombuffer(bytes_header, dtype=PDMBIN_DTYPE_HEADER)[0]
+                chw = (int(header["c"]), int(header["h"]), int(header["w"]))
+                dtype_payload = PDMBIN_LIST_DTYPES[int(header["dtype"])]
+                size_payload = chw[0]*chw[1]*chw[2]*dtype_payload.itemsize
+                val = np.frombuffer(file_pdmbin.read(size_payload), dtype=dtype_payload).reshape(chw)
+                yield _pdmbinrecord_to_list(header, val)
+
+
+def _pdmbinrecord_to_list(header, val):
+    '''
+    Converts one record of a pdmbin file to the list yielded by `_iter_pdmcsvrecords`.
+    '''
+    return [float(header["y"]), float(header["x"]), float(header["H"]), float(header["W"]),
+            float(header["patch_levelidx"]), float(header["kernel_size"]), float(header["downsample_of_patchlevel"]),
+            int(header["c"]), int(header["h"]), int(header["w"]),
+            np.asarray(val, dtype=np.float64).reshape(-1)]
+
+
+def pdmbintoarray(fname_pdmbin, func_WSIxyWHval_to_rasterpoints, scale_upsampleraster=1.0, str_blending="last", fill_value=0.0, flag_fillgaps=False):
     '''
-    #read the file line-by-line =====
-    file_pdmcsv = open(fname_pdmcsv, 'r')
+    Same as `pdmcsvtoarray`, but for pdmbin files (see `Tensor3DtoPdmbinrecord`).
+    '''
+    return _pdmrecordstoarray(_iter_pdmbinrecords(fname_pdmbin),
+                              func_WSIxyWHval_to_rasterpoints, scale_upsampleraster, str_blending, fill_value, flag_fillgaps)
+
+
+def _fillgaps_of_axis(np_allraster):
+    '''
+    Takes the sorted unique coordinates of the raster points along one axis, and fills the gaps left by the dropped tiles.
+    The grid step is inferred from the data as the most frequent spacing between two consecutive coordinates,
+    and a gap which spans k>=2 steps gets k-1 evenly spaced points. The smaller spacings (e.g., the last column
+    of the sliding window which is shifted back to fit in the image) are left untouched.
+    '''
+    if(np_allraster.shape[0] < 3):
+        return np_allraster
+    np_diff = np.diff(np_allraster)
+    np_uniquediff, np_countdiff = np.unique(np.round(np_diff, 6), return_counts=True)
+    step = np_uniquediff[np.argmax(np_countdiff)]
+    np_numfill = np.round(np_diff/step).astype(np.int64) - 1
+    np_numfill[np_numfill < 0] = 0
+    num_fill = int(np_numfill.sum())
+    if(num_fill == 0):
+        return np_allraster
+    np_offset = np.arange(num_fill) - np.repeat(np.cumsum(np_numfill)-np_numfill, np_numfill) + 1
+    np_filled = np.repeat(np_allraster[0:-1], np_numfill) +\
+                np_offset*np.repeat(np_diff/(np_numfill+1), np_numfill)
+    return np.sort(np.concatenate([np_allraster, np_filled]))
+
+
+def _pdmrecordstoarray(iter_records, func_WSIxyWHval_to_rasterpoints, scale_upsampleraster, str_blending="last", fill_value=0.0,
+                       flag_fillgaps=False):
+    '''
+    Converts the records of a pdm file (as yielded by, e.g., `_iter_pdmcsvrecords`) to an array.
+    When several records fall on the same raster point, they are stitched as specified by `str_blending`
+    (see `pdmcsvtoarray`). The raster points which are not covered by any record are set to `fill_value`,
+    and if `flag_fillgaps` is True the gaps left by the dropped tiles are added to the grid (see `_fillgaps_of_axis`).
+    '''
+    np_x, np_y, np_val, np_weight = _pdmrecordstopoints(iter_records, func_WSIxyWHval_to_rasterpoints, str_blending)
+    c = np_val.shape[1]
+    np_allrasterx, np_allrastery = np.unique(np_x), np.unique(np_y) #sorted
+    if(flag_fillgaps == True):
+        np_allrasterx, np_allrastery = _fillgaps_of_axis(np_allrasterx), _fillgaps_of_axis(np_allrastery)
+    if(scale_upsampleraster > 1.0):
+        np_x, np_y = np.floor(scale_upsampleraster*np_x), np.floor(scale_upsampleraster*np_y)
+        np_allrasterx = np.unique(np.floor(scale_upsampleraster*np_allrasterx))
+        np_allrastery = np.unique(np.floor(scale_upsampleraster*np_allrastery))
+    np_idx_x = np.searchsorted(np_allrasterx, np_x)
+    np_idx_y = np.searchsorted(np_allrastery, np_y)
+    max_x, max_y = int(np_allrasterx[-1]), int(np_allrastery[-1])
+    np_linearidx = np_idx_y.reshape(-1)*np_allrasterx.shape[0] + np_idx_x.reshape(-1)
+    output_raster, np_covered = _stitchpoints(np_linearidx, np_val, np_weight,
+                                              np_allrastery.shape[0]*np_allrasterx.shape[0], str_blending)
+    output_raster[np_covered == False] = fill_value
+    output_raster = output_raster.reshape(np_allrastery.shape[0], np_allrasterx.shape[0], c)
+    #fill-in the zeros if scale_upsample>1.0
+    if(scale_upsampleraster > 1.0):
+        list_output_scaled = []
+        for count_c in range(c):
+            f = interp2d(
+                np_allrasterx.astype(np.int64),
+                np_allrastery.astype(np.int64),
+                output_raster[:,:,count_c], kind='cubic'
+            )
+            output_raster_scaled_forchannel = f(
+                   np.arange(max_x),
+                   np.arange(max_y)
+                 )
+            list_output_scaled.append(output_raster_scaled_forchannel)
+        return np.stack(list_output_scaled, 2)
+    return output_raster
+
+
+def _pdmrecordstopoints(iter_records, func_WSIxyWHval_to_rasterpoints, str_blending):
+    '''
+    Converts the records of a pdm file to raster points.
+    Outputs.
+        - np_x, np_y: the (floored) raster coordinates of the points, numpy arrays of length N.
+        - np_val: the values of the points, a numpy array of shape [N x C].
+        - np_weight: the blending weight of each point (see `pydmed.utils.output.get_tileweights`),
+            or None if `str_blending` is "last".
+    '''
+    if(str_blending not in ["last", "average", "weighted"]):
+        raise Exception("The argument `str_blending` must be one of 'last', 'average', or 'weighted'.")
+    flag_valasarray = getattr(func_WSIxyWHval_to_rasterpoints, "flag_valasarray", False)
     count_line = 0
-    dict_raster = {}
-    while True:
+    list_np_x, list_np_y, list_np_val, list_np_weight = [], [], [], []
+    for record in iter_records:
         count_line += 1
-        line = file_pdmcsv.readline() 
-        
-        if not line: 
-                break
-              
-        list_numbers = line.split(",")
-        for idx, u in enumerate(list_numbers):
-            if(isinstance(list_numbers[idx], str)):
-                if("None" in list_numbers[idx]):
-                    list_numbers[idx] = np.nan
-        list_numbers = [_float_or_nan(u) for u in list_numbers]
-        
         if(count_line == 1):
-            H, W = list_numbers[2], list_numbers[3]
+            H, W = record[2], record[3]
             H, W = int(H), int(W)
         
         #order: y,x,H,W,....  
-        y, x = list_numbers[0], list_numbers[1]
-        patch_levelidx = list_numbers[4]
-        kernel_size = list_numbers[5]
-        downsample_of_patchlevel = list_numbers[6]
-        c = int(list_numbers[7])
-        h = int(list_numbers[8])
-        w = int(list_numbers[9])
-        val = list_numbers[10:] #np.mean(np.array([list_numbers[4:]]))
-        
-        print("W={} , H = {}".format(W, H))
+        y, x = record[0], record[1]
+        patch_levelidx = record[4]
+        kernel_size = record[5]
+        downsample_of_patchlevel = record[6]
+        c, h, w = record[7], record[8], record[9]
+        val = record[10] if(flag_valasarray == True) else record[10].tolist()
         
         #convert the points to raster space using the function
         list_x_onraster, list_y_onraster, val = func_WSIxyWHval_to_rasterpoints(
@@ -112,62 +353,194 @@ def pdmcsvtoarray(fname_pdmcsv, func_WSIxyWHval_to_rasterpoints, scale_upsampler
                                             downsample_of_patchlevel,
                                             c, h, w, val
                                         )
-        #np_x_onraster, np_y_onraster = np.array(list_x_onraster), np.array(list_y_onraster)
-        for idx_rasterpoint in range(len(list_x_onraster)):
-            dict_raster["({},{})".format(
-                     math.floor(list_x_onraster[idx_rasterpoint]),
-                     math.floor(list_y_onraster[idx_rasterpoint])
-                    )
-                ] = val[idx_rasterpoint]
-            #print("set raster at [{} , {}]".format(math.floor(list_x_onraster[idx_rasterpoint]),
-            #         math.floor(list_y_onraster[idx_rasterpoint])))
+        np_val = np.asarray(val, dtype=np.float64)
+        if(np_val.ndim == 1):
+            np_val = np.repeat(np_val[:, None], c, axis=1) #one scalar for all channels.
+        list_np_x.append(np.floor(np.asarray(list_x_onraster, dtype=np.float64)))
+        list_np_y.append(np.floor(np.asarray(list_y_onraster, dtype=np.float64)))
+        list_np_val.append(np_val.reshape(-1, c))
+        if(str_blending != "last"):
+            np_weight = pydmed.utils.output.get_tileweights(h, w, str_blending).reshape(-1)
+            if(np_weight.shape[0] != list_np_x[-1].shape[0]):
+                np_weight = np.ones(list_np_x[-1].shape[0]) #the points are not the pixels of the tile.
+            list_np_weight.append(np_weight)
+    np_weight = np.concatenate(list_np_weight) if(str_blending != "last") else None
+    return np.concatenate(list_np_x), np.concatenate(list_np_y), np.concatenate(list_np_val, axis=0), np_weight
+
+
+def _stitchpoints(np_linearidx, np_val, np_weight, num_rasterpoints, str_blending):
+    '''
+    Stitches the values of points on a (flattened) raster of `num_rasterpoints` points.
+    Inputs.
+        - np_linearidx: the index of each point on the flattened raster, a numpy array of length N.
+        - np_val, np_weight: as returned by `_pdmrecordstopoints`.
+    Outputs.
+        - np_raster: a numpy array of shape [num_rasterpoints x C]. The points with no value are zero.
+        - np_covered: a boolean numpy array of length num_rasterpoints, whether each raster point has a value.
+    '''
+    c = np_val.shape[1]
+    if(str_blending == "last"):
+        #keep the last value written on each raster point ====
+        _, np_idx_lastreversed = np.unique(np_linearidx[::-1], return_index=True)
+        np_idx_last = np_linearidx.shape[0] - 1 - np_idx_lastreversed
+        np_raster = np.zeros((num_rasterpoints, c))
+        np_raster[np_linearidx[np_idx_last], :] = np_val[np_idx_last]
+        np_covered = np.zeros(num_rasterpoints, dtype=bool)
+        np_covered[np_linearidx] = True
+    else:
+        #accumulate the weighted sum and the sum of weights on each raster point ====
+        np_sumweight = np.bincount(np_linearidx, weights=np_weight, minlength=num_rasterpoints)
+        np_raster = np.stack([np.bincount(np_linearidx, weights=np_val[:, count_c]*np_weight,
+                                          minlength=num_rasterpoints) for count_c in range(c)], 1)
+        np_covered = np_sumweight > 0
+        np_raster[np_covered] /= np_sumweight[np_covered][:, None]
+    return np_raster, np_covered
+
+
+def pdmcsvtosparse(fname_pdmcsv, func_WSIxyWHval_to_rasterpoints, str_blending="last"):
+    '''
+    Same as `pdmcsvtoarray`, but returns a `SparseRaster`, so the memory usage is proportional
+    to the number of raster points that have a value (e.g., the tissue area) rather than the size of the slide.
+    '''
+    return SparseRaster(*_pdmrecordstopoints(_iter_pdmcsvrecords(fname_pdmcsv),
+                                             func_WSIxyWHval_to_rasterpoints, str_blending),
+                        str_blending=str_blending)
+
+
+def pdmbintosparse(fname_pdmbin, func_WSIxyWHval_to_rasterpoints, str_blending="last"):
+    '''
+    Same as `pdmcsvtosparse`, but for pdmbin files (see `Tensor3DtoPdmbinrecord`).
+    '''
+    return SparseRaster(*_pdmrecordstopoints(_iter_pdmbinrecords(fname_pdmbin),
+                                             func_WSIxyWHval_to_rasterpoints, str_blending),
+                        str_blending=str_blending)
+
+
+class SparseRaster:
+    def __init__(self, np_x, np_y, np_val, np_weight=None, str_blending="last"):
+        '''
+        A sparse (COO) raster, i.e. a list of points with their raster coordinates and values.
+        Unlike the output of `pdmcsvtoarray`, the coordinates are not compacted, 
+        i.e. the point (x,y) is at position [y,x] of the full raster.
+        The points are kept sorted by y (in their original order on each row), so the 
+        regions of interest are found by binary search.
+        Inputs.
+            - np_x, np_y: the raster coordinates of the points, numpy arrays of length N.
+            - np_val: the values of the points, a numpy array of shape [N x C].
+            - np_weight: the blending weights of the points, a numpy array of length N. 
+                It is ignored if `str_blending` is "last".
+            - str_blending: how the points that fall on the same raster point are stitched (see `pdmcsvtoarray`).
+        '''
+        np_order = np.argsort(np.asarray(np_y), kind="stable")
+        self.np_x = np.asarray(np_x)[np_order].astype(np.int32)
+        self.np_y = np.asarray(np_y)[np_order].astype(np.int32)
+        self.np_val = np.asarray(np_val)[np_order].astype(np.float32)
+        self.str_blending = str_blending
+        if(str_blending == "last"):
+            self.np_weight = None
+        else:
+            self.np_weight = np.asarray(np_weight)[np_order].astype(np.float32)
     
-    for temp_xy in dict_raster.keys():
-        print(temp_xy)
+    @property
+    def shape(self):
+        '''
+        The shape of the full (dense) raster, [H x W x C].
+        '''
+        if(self.np_x.shape[0] == 0):
+            return (0, 0, self.np_val.shape[1])
+        return (int(self.np_y[-1])+1, int(self.np_x.max())+1, self.np_val.shape[1])
     
+    @property
+    def nbytes(self):
+        '''
+        The memory used by the sparse raster, in bytes.
+        '''
+        toret = self.np_x.nbytes + self.np_y.nbytes + self.np_val.nbytes
+        if(self.np_weight is not None):
+            toret += self.np_weight.nbytes
+        return toret
     
-    #convert dict_raster to np.ndarray =====
-    list_allrasterx, list_allrastery = [], []
-    for u in dict_raster.keys():
-        x, y = u[1:-1].split(',')
-        x, y = float(x), float(y) 
-        if(scale_upsampleraster > 1.0):
-            x, y = scale_upsampleraster*x, scale_upsampleraster*y
-        x, y = math.floor(x), math.floor(y)
-        list_allrasterx.append(x); list_allrastery.append(y)
-    list_allrasterx = list(set(list_allrasterx))
-    list_allrastery = list(set(list_allrastery))
-    list_allrasterx.sort(); list_allrastery.sort()
-    max_x, max_y = np.max(list_allrasterx), np.max(list_allrastery)
-    output_raster = np.zeros((len(list_allrastery), len(list_allrasterx), c))
-    num_totalloops = len(list(dict_raster.keys()))
-    count = 0
-    for u in dict_raster.keys():
-        count += 1
-        if((count%10000) == 0):
-            print("    >>>>>> Interpolation in progress: point {} out of {}. Please wait .... .".format(count, num_totalloops), end="\r")
-        x,y = u[1:-1].split(',')
-        x, y = float(x), float(y)
-        if(scale_upsampleraster > 1.0):
-            x, y = scale_upsampleraster*x, scale_upsampleraster*y
-        x, y = math.floor(x), math.floor(y)
-        output_raster[list_allrastery.index(y), list_allrasterx.index(x),:] = dict_raster[u]
-    #fill-in the zeros if scale_upsample>1.0
-    if(scale_upsampleraster > 1.0):
-        list_output_scaled = []
-        for count_c in range(c):
-            f = interp2d(
-                np.array(list_allrasterx),
-                np.array(list_allrastery),
-                output_raster[:,:,count_c], kind='cubic'
-            )
-            output_raster_scaled_forchannel = f(
-                   np.array([j for j in range(max_x)]),
-                   np.array([i for i in range(max_y)])
-                 )
-            list_output_scaled.append(output_raster_scaled_forchannel)
-        return np.stack(list_output_scaled, 2)
-    return output_raster
+    def _select_rows(self, y_begin, y_end):
+        idx_begin = np.searchsorted(self.np_y, y_begin, side="left")
+        idx_end = np.searchsorted(self.np_y, y_end, side="left")
+        np_weight = None if(self.np_weight is None) else self.np_weight[idx_begin:idx_end]
+        return self.np_x[idx_begin:idx_end], self.np_y[idx_begin:idx_end],\
+               self.np_val[idx_begin:idx_end], np_weight
+    
+    def densify(self, y_begin=0, y_end=None, x_begin=0, x_end=None, fill_value=0.0):
+        '''
+        Returns the dense raster of a region of interest, [y_begin:y_end, x_begin:x_end], 
+        as a numpy array of shape [(y_end-y_begin) x (x_end-x_begin) x C].
+        If `y_end` or `x_end` is None, the region extends to the end of the raster.
+        The raster points with no value are set to `fill_value`.
+        '''
+        H, W, c = self.shape
+        y_end = H if(y_end is None) else y_end
+        x_end = W if(x_end is None) else x_end
+        np_x, np_y, np_val, np_weight = self._select_rows(y_begin, y_end)
+        np_inroi = (np_x >= x_begin) & (np_x < x_end)
+        if(np_weight is not None):
+            np_weight = np_weight[np_inroi]
+        h_roi, w_roi = max(y_end-y_begin, 0), max(x_end-x_begin, 0)
+        np_linearidx = (np_y[np_inroi].astype(np.int64)-y_begin)*w_roi + (np_x[np_inroi]-x_begin)
+        np_raster, np_covered = _stitchpoints(np_linearidx, np_val[np_inroi], np_weight,
+                                              h_roi*w_roi, self.str_blending)
+        np_raster[np_covered == False] = fill_value
+        return np_raster.reshape(h_roi, w_roi, c)
+    
+    def to_downsampled(self, factor_downsample, fill_value=0.0, size_rowblock=4096):
+        '''
+        Returns a dense view of the whole raster, downsampled by an integer factor, as a numpy array of shape
+        [ceil(H/factor_downsample) x ceil(W/factor_downsample) x C]. Each output point is the mean of the 
+        stitched raster points that fall in it, and the output points with no value are set to `fill_value`.
+        The points are stitched and pooled `size_rowblock` rows at a time without densifying the rows,
+        so apart from the output, the memory usage is proportional to the number of points in a block of rows.
+        '''
+        H, W, c = self.shape
+        factor_downsample = int(factor_downsample)
+        size_rowblock = max(size_rowblock//factor_downsample, 1)*factor_downsample
+        h_out, w_out = int(math.ceil(H/factor_downsample)), int(math.ceil(W/factor_downsample))
+        np_sum = np.zeros((h_out*w_out, c))
+        np_count = np.zeros(h_out*w_out)
+        for y_begin in range(0, H, size_rowblock):
+            y_end = min(y_begin+size_rowblock, H)
+            np_x, np_y, np_val, np_weight = self._select_rows(y_begin, y_end)
+            if(np_x.shape[0] == 0):
+                continue
+            #stitch the points of the block on the raster points which have a value ====
+            np_linearidx = np_y.astype(np.int64)*W + np_x
+            np_uniqueidx, np_inverse = np.unique(np_linearidx, return_inverse=True)
+            np_stitched, _ = _stitchpoints(np_inverse.reshape(-1), np_val, np_weight,
+                                           np_uniqueidx.shape[0], self.str_blending)
+            #pool the stitched raster points ====
+            np_linearidx_out = (np_uniqueidx//W//factor_downsample)*w_out + (np_uniqueidx%W)//factor_downsample
+            np_uniqueout, np_inverseout = np.unique(np_linearidx_out, return_inverse=True)
+            np_inverseout = np_inverseout.reshape(-1)
+            np_count[np_uniqueout] += np.bincount(np_inverseout, minlength=np_uniqueout.shape[0])
+            for count_c in range(c):
+                np_sum[np_uniqueout, count_c] += np.bincount(np_inverseout, weights=np_stitched[:, count_c],
+                                                             minlength=np_uniqueout.shape[0])
+        np_sum[np_count > 0] /= np_count[np_count > 0][:, None]
+        np_sum[np_count == 0] = fill_value
+        return np_sum.reshape(h_out, w_out, c)
+    
+    def save(self, fname):
+        '''
+        Saves the sparse raster to a .npz file, which can be loaded by `SparseRaster.load`.
+        '''
+        dict_tosave = {"np_x":self.np_x, "np_y":self.np_y, "np_val":self.np_val,
+                       "str_blending":np.array(self.str_blending)}
+        if(self.np_weight is not None):
+            dict_tosave["np_weight"] = self.np_weight
+        np.savez(fname, **dict_tosave)
+    
+    @staticmethod
+    def load(fname):
+        with np.load(fname) as npzfile:
+            str_blending = str(npzfile["str_blending"])
+            np_weight = npzfile["np_weight"] if("np_weight" in npzfile.files) else None
+            return SparseRaster(npzfile["np_x"], npzfile["np_y"], npzfile["np_val"],
+                                np_weight, str_blending)
 
 
 class DefaultWSIxyWHvaltoRasterPoints:
@@ -179,52 +552,87 @@ class DefaultWSIxyWHvaltoRasterPoints:
                 patch_levelidx, kernel_size,
                 downsample_of_patchlevel,
                 c, h, w, val):
-        try:
-            
-            if((c*h*w) != len(val)):
-                print("Warning: the line in the csv file is of length {} which is not equal to CxHxW.".format(len(val)))
-                print(" [c,h,w] = [{},{},{}]".format(c,h,w))
-            else:
-                pass
-                #print("OK: ...")
-                
-            assert(isinstance(val, list))
-            assert((c*h*w)== len(val))
-            np_val = np.reshape(val, [c,h,w])
-            
-            size_blockonraster = h #np.sqrt(len(val))
-            scale_wsi_to_raster = kernel_size/size_blockonraster
-            x_onraster = (x+0.0)/scale_wsi_to_raster
-            y_onraster = (y+0.0)/scale_wsi_to_raster
-            #make list_x_onraster and list_y_onraster ======
-            np_x_onraster = np.array([[j for j in range(int(size_blockonraster))]\
-                                 for i in range(int(size_blockonraster))]).flatten()+x_onraster
-            np_y_onraster = np.array([[i for j in range(int(size_blockonraster))]\
-                                 for i in range(int(size_blockonraster))]).flatten()+y_onraster
-            list_x_onraster = np_x_onraster.tolist()
-            list_y_onraster = np_y_onraster.tolist()
-            toret_val = []
-            for i in range(h):
-                for j in range(w):
-                    toret_val.append(np_val[:,i,j])
-            return list_x_onraster, list_y_onraster, toret_val
-        except:
-            size_blockonraster = h #np.sqrt(len(val))
-            scale_wsi_to_raster = kernel_size/size_blockonraster
-            x_onraster = (x+0.0)/scale_wsi_to_raster
-            y_onraster = (y+0.0)/scale_wsi_to_raster
-            #make list_x_onraster and list_y_onraster ======
-            np_x_onraster = np.array([[j for j in range(int(size_blockonraster))]\
-                                 for i in range(int(size_blockonraster))]).flatten()+x_onraster
-            np_y_onraster = np.array([[i for j in range(int(size_blockonraster))]\
-                                 for i in range(int(size_blockonraster))]).flatten()+y_onraster
-            list_x_onraster = np_x_onraster.tolist()
-            list_y_onraster = np_y_onraster.tolist()
-            toret_val = []
-            for i in range(h):
-                for j in range(w):
-                    toret_val.append(0.0)
-            return list_x_onraster, list_y_onraster, toret_val
+        '''
+        Maps a block of [c x h x w] values (one record of a pdm file) to raster points, in one shot.
+        Outputs.
+            - np_x_onraster, np_y_onraster: numpy arrays of length h*w.
+            - np_val: a numpy array of shape [h*w x c]. If `val` is not of length c*h*w, 
+                a numpy array of h*w zeros is returned instead.
+        '''
+        np_val = np.asarray(val, dtype=np.float64).reshape(-1)
+        scale_wsi_to_raster = kernel_size/h
+        x_onraster = (x+0.0)/scale_wsi_to_raster
+        y_onraster = (y+0.0)/scale_wsi_to_raster
+        #make np_x_onraster and np_y_onraster, in row-major order ======
+        np_x_onraster = np.tile(np.arange(w, dtype=np.float64), h) + x_onraster
+        np_y_onraster = np.repeat(np.arange(h, dtype=np.float64), w) + y_onraster
+        if((c*h*w) != np_val.shape[0]):
+            print("Warning: the line in the csv file is of length {} which is not equal to CxHxW.".format(np_val.shape[0]))
+            print(" [c,h,w] = [{},{},{}]".format(c,h,w))
+            return np_x_onraster, np_y_onraster, np.zeros(h*w)
+        return np_x_onraster, np_y_onraster, np_val.reshape(c, h*w).T
+    func_WSIxyWHval_to_rasterpoints.flag_valasarray = True #see `pdmcsvtoarray`.
+
+class TfmsBatchNormalize:
+    def __init__(self, mean, std):
+        '''
+        A batch transformation for `SlidingWindowDL(..., tfms_onbatchcollection=...)`.
+        It is equivalent to applying ToPILImage, ToTensor, and Normalize to each tile, 
+        but it works on all tiles at once.
+        Inputs.
+            - mean, std: lists of length C, e.g., [0.485, 0.456, 0.406] and [0.229, 0.224, 0.225].
+        '''
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+    
+    def __call__(self, np_tiles):
+        '''
+        Inputs.
+            - np_tiles: a uint8 numpy array of shape [N x H x W x C].
+        Outputs.
+            - a float32 numpy array of shape [N x H x W x C].
+        '''
+        toret = np_tiles.astype(np.float32)
+        toret *= (1.0/255.0)
+        toret -= self.mean
+        toret /= self.std
+        return toret
+
+
+class TissueTileFilter:
+    def __init__(self, thresh_saturation=20, thresh_tissuefraction=0.1, thresh_intensity=None, stride_subsample=4):
+        '''
+        A tile filter for `SlidingWindowDL(..., func_tilefilter=...)`, which finds the background tiles (e.g., blank glass)
+        on the uint8 tiles in the collector processes, before the tiles are transformed and placed in the queues.
+        A tile is kept if the fraction of its pixels with saturation (i.e. max(R,G,B)-min(R,G,B)) above `thresh_saturation`
+        is at least `thresh_tissuefraction` (see `get_tissuefraction`).
+        Inputs.
+            - thresh_saturation: a number in [0, 255], default is 20.
+            - thresh_tissuefraction: a number in [0, 1], default is 0.1.
+            - thresh_intensity: a number in [0, 255] or None (default). If not None, a tile is kept only if
+                its mean intensity is below `thresh_intensity` as well (the glass is bright).
+            - stride_subsample: an integer, the statistics are computed on every `stride_subsample`-th pixel
+                along each axis. Default is 4.
+        '''
+        self.thresh_saturation = thresh_saturation
+        self.thresh_tissuefraction = thresh_tissuefraction
+        self.thresh_intensity = thresh_intensity
+        self.stride_subsample = stride_subsample
+    
+    def __call__(self, np_tiles):
+        '''
+        Inputs.
+            - np_tiles: a uint8 numpy array of shape [N x H x W x C].
+        Outputs.
+            - a boolean numpy array of shape [N], True for the tiles to be kept.
+        '''
+        s = self.stride_subsample
+        np_sub = np_tiles[:, ::s, ::s, 0:3] #no copy is made.
+        toret = get_tissuefraction(np_sub, self.thresh_saturation) >= self.thresh_tissuefraction
+        if(self.thresh_intensity is not None):
+            toret = toret & (np_sub.mean(axis=(1,2,3)) < self.thresh_intensity)
+        return toret
+
 
 class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
     def __init__(self, *args, **kwargs):
@@ -242,6 +650,15 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
         self.flag_unschedme = False
         #grab privates
         self.tfms_onsmallchunkcollection = self.const_global_info["pdmreserved_tfms_onsmallchunkcollection"]
+        self.flag_batchcolumns = self.const_global_info.get("pdmreserved_flag_batchcolumns", False)
+        self.tfms_onbatchcollection = self.const_global_info.get("pdmreserved_tfms_onbatchcollection", None)
+        self.flag_readahead = self.const_global_info.get("pdmreserved_flag_readahead", False)
+        self.func_tilefilter = self.const_global_info.get("pdmreserved_func_tilefilter", None)
+        self.str_tilefiltermode = self.const_global_info.get("pdmreserved_str_tilefiltermode", "drop")
+        self._bigchunk_ofrow = None #in read-ahead mode, the bigrow which is being sliced.
+        self._callcount_rowbegin = 0 #in read-ahead mode, the `call_count` at which `_bigchunk_ofrow` started.
+        self._thread_readahead = None
+        self._retval_readahead = None
         # ~ \
             # ~ torchvision.transforms.Compose([
             # ~ torchvision.transforms.ToPILImage(),\
@@ -261,6 +678,128 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
             toret = math.floor((W-kernel_size)/stride) + 2
         return toret
     
+    def get_range_of_col(self, idx_col, W, w, kernel_size, stride):
+        '''
+        Returns the horizontal range of the `idx_col`-th column of the bigrow.
+        Outputs.
+            - x_begin, x_end: the range of the column.
+            - flag_auxlastcol: True if the column is shifted back to fit in the bigrow.
+            - vertbar_overlaptheprevpatch: the overlap with the previous column if `flag_auxlastcol` is True, otherwise "None".
+        '''
+        x_begin = int(idx_col*w)
+        x_end = x_begin + w
+        flag_auxlastcol = False
+        vertbar_overlaptheprevpatch = "None"
+        if(x_end > W):
+            prev_x_end = x_end-stride
+            x_end = W
+            x_begin = W-w
+            vertbar_overlaptheprevpatch = kernel_size-(x_end-prev_x_end)
+            flag_auxlastcol = True
+        return x_begin, x_end, flag_auxlastcol, vertbar_overlaptheprevpatch
+    
+    def _transform_tile(self, np_smallchunk):
+        '''
+        Applies `tfms_onsmallchunkcollection` to a tile of shape [H x W x C]
+        and returns a numpy array of shape [H x W x C].
+        '''
+        if(self.tfms_onsmallchunkcollection != None):
+            toret = self.tfms_onsmallchunkcollection(np_smallchunk)
+            toret = toret.cpu().detach().numpy() #[3 x 224 x 224]
+            toret = np.transpose(toret, [1,2,0]) #[224 x 224 x 3]
+        else:
+            toret = np_smallchunk
+        return toret
+    
+    def _extract_allcols(self, bigchunk, W, w, kernel_size, stride, num_cols, attention_levelidx):
+        '''
+        Extracts all columns of the bigrow with a strided view, transforms them as a batch,
+        and returns them as a list of `SmallChunk`s (i.e. a single message in the queues).
+        '''
+        list_colranges = [self.get_range_of_col(idx_col, W, w, kernel_size, stride)\
+                          for idx_col in range(num_cols)]
+        np_xbegin = np.array([u[0] for u in list_colranges])
+        np_windows = np.lib.stride_tricks.sliding_window_view(
+                        bigchunk.data, w, axis=1
+                    ) #[H x W-w+1 x C x w], no copy is made.
+        np_tiles = np.transpose(np_windows[:, np_xbegin], [1,0,3,2]) #[num_cols x H x w x C]
+        #filter the background tiles ===========
+        np_flagtissue = None
+        if(self.func_tilefilter != None):
+            np_flagtissue = np.asarray(self.func_tilefilter(np_tiles), dtype=bool)
+            if(self.str_tilefiltermode == "drop"):
+                list_colranges = [list_colranges[n] for n in np.nonzero(np_flagtissue)[0]]
+                np_tiles = np_tiles[np_flagtissue]
+                num_cols = len(list_colranges)
+                np_flagtissue = None
+                if(num_cols == 0):
+                    return []
+        #apply the transformation ===========
+        if(self.tfms_onbatchcollection != None):
+            np_tiles = self.tfms_onbatchcollection(np_tiles)
+        elif(self.tfms_onsmallchunkcollection != None):
+            np_tiles = [self._transform_tile(np_tiles[n]) for n in range(num_cols)]
+        else:
+            np_tiles = np.ascontiguousarray(np_tiles)
+        #wrap in SmallChunks
+        list_smallchunks = []
+        for idx_col in range(num_cols):
+            x_begin, x_end, flag_auxlastcol, vertbar_overlaptheprevpatch = list_colranges[idx_col]
+            dict_info_of_smallchunk = {
+                               "x":x_begin, "y":0,\
+                               "patch_levelidx":attention_levelidx,
+                               "kernel_size":kernel_size,
+                               "flag_auxlastcol":flag_auxlastcol,
+                               "vertbar_overlaptheprevpatch":vertbar_overlaptheprevpatch
+                           }
+            if(np_flagtissue is not None):
+                dict_info_of_smallchunk["flag_tissue"] = bool(np_flagtissue[idx_col])
+            list_smallchunks.append(
+                SmallChunk(data=np_tiles[idx_col],\
+                           dict_info_of_smallchunk=dict_info_of_smallchunk,\
+                           dict_info_of_bigchunk = bigchunk.dict_info_of_bigchunk,\
+                           patient=bigchunk.patient
+                )
+            )
+        return list_smallchunks
+    
+    def _start_readahead(self, bigchunk):
+        '''
+        Starts reading the bigrow after `bigchunk` in a background thread.
+        '''
+        self._thread_readahead = None
+        self._retval_readahead = None
+        idx_nextbigrow = bigchunk.dict_info_of_bigchunk["idx_bigrow"] + 1
+        if(idx_nextbigrow > (bigchunk.dict_info_of_bigchunk["num_bigrows"]-1)):
+            return
+        if(hasattr(self.type_bigchunkloader, "read_bigrow")):
+            func_read_bigrow = self.type_bigchunkloader.read_bigrow
+        else:
+            func_read_bigrow = SlidingWindowBigChunkLoader.read_bigrow
+        def _readahead():
+            self._retval_readahead = func_read_bigrow(self.patient, self.const_global_info, idx_nextbigrow)
+        self._thread_readahead = threading.Thread(target=_readahead, daemon=True)
+        self._thread_readahead.start()
+    
+    def _advance_to_nextrow(self, call_count):
+        '''
+        Waits for the read-ahead bigrow, and makes it the bigrow to be sliced.
+        Returns False if no bigrow could be read ahead, in which case the collector goes idle as usual
+        and the scheduler reloads the patient from the checkpoint.
+        '''
+        if(self._thread_readahead == None):
+            return False
+        self._thread_readahead.join()
+        bigchunk_next = self._retval_readahead
+        self._thread_readahead, self._retval_readahead = None, None
+        if(isinstance(bigchunk_next, BigChunk) == False):
+            return False
+        self._bigchunk_ofrow = bigchunk_next
+        self._callcount_rowbegin = call_count
+        self.set_checkpoint({"idx_bigrow":bigchunk_next.dict_info_of_bigchunk["idx_bigrow"]+1})
+        self._start_readahead(bigchunk_next)
+        return True
+    
     @abstractmethod     
     def extract_smallchunk(self, call_count, bigchunk, last_message_fromroot):
         '''
@@ -297,6 +836,16 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
                     self.set_checkpoint({"idx_bigrow":checkpoint["idx_bigrow"]+1})
                 self.set_status(status_busy)
                 self.flag_unschedme = False
+            
+            #in read-ahead mode, the bigrows are sliced back to back within this process.
+            idx_callinrow = call_count
+            if(self.flag_readahead == True):
+                if(call_count == 0):
+                    self._bigchunk_ofrow = bigchunk
+                    self._callcount_rowbegin = 0
+                    self._start_readahead(bigchunk)
+                bigchunk = self._bigchunk_ofrow
+                idx_callinrow = call_count - self._callcount_rowbegin
            
             #extract fields from const_global_info ====
             intorfunc_opslevel = self.const_global_info["pdmreserved_intorfunc_opslevel"]
@@ -314,17 +863,9 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
             W, H = bigchunk.data.shape[1], bigchunk.data.shape[0]
             #osimage.level_dimensions[self.const_global_info["attention_levelidx"]]
             w, h = H+0, H+0
-            x_begin = int(call_count*w)
-            x_end = x_begin + w
             num_cols = self.slice_by_slidingwindow(W, kernel_size, stride)
-            flag_auxlastcol = False
-            vertbar_overlaptheprevpatch = "None"
-            if(x_end > W):
-                prev_x_end = x_end-stride
-                x_end = W
-                x_begin = W-w
-                vertbar_overlaptheprevpatch = kernel_size-(x_end-prev_x_end)
-                flag_auxlastcol = True
+            x_begin, x_end, flag_auxlastcol, vertbar_overlaptheprevpatch = \
+                self.get_range_of_col(idx_callinrow, W, w, kernel_size, stride)
             
             WSI_H = bigchunk.dict_info_of_bigchunk["WSI_H"]
             bigchunk_numbigrows = bigchunk.dict_info_of_bigchunk["num_bigrows"]
@@ -337,8 +878,13 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
                 print("Please wait. SlidingWindowDL is still working .....  (printed on {})".format(str_now), end="\r")
                 pass
             
-            if(call_count > (num_cols-1)):
+            #in batch mode, all columns are returned by the first call.
+            num_calls = 1 if(self.flag_batchcolumns == True) else num_cols
+            if(idx_callinrow > (num_calls-1)):
                 #x out of boundary
+                if((flag_lastbigchunk == False) and (self.flag_readahead == True)):
+                    if(self._advance_to_nextrow(call_count) == True):
+                        return self.extract_smallchunk(call_count, self._bigchunk_ofrow, last_message_fromroot)
                 if(flag_lastbigchunk == False):
                     self.flag_unschedme = True #next calls will return immediately.
                     self.set_status(status_idle)
@@ -347,25 +893,31 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
                     self.flag_unschedme = True #next calls will return immediately.
                     self.set_status(status_idlefinished)
                     return None
+            elif(self.flag_batchcolumns == True):
+                return self._extract_allcols(bigchunk, W, w, kernel_size, stride, num_cols, attention_levelidx)
             else:
                 #X within boundary ==== 
                 np_smallchunk = bigchunk.data[:, x_begin:x_end, :]
+                #filter the background tile ===========
+                flag_tissue = None
+                if(self.func_tilefilter != None):
+                    flag_tissue = bool(self.func_tilefilter(np_smallchunk[None])[0])
+                    if((flag_tissue == False) and (self.str_tilefiltermode == "drop")):
+                        return None
                 #apply the transformation ===========
-                if(self.tfms_onsmallchunkcollection != None):
-                    toret = self.tfms_onsmallchunkcollection(np_smallchunk)
-                    toret = toret.cpu().detach().numpy() #[3 x 224 x 224]
-                    toret = np.transpose(toret, [1,2,0]) #[224 x 224 x 3]
-                else:
-                    toret = np_smallchunk
+                toret = self._transform_tile(np_smallchunk)
                 #wrap in SmallChunk
-                smallchunk = SmallChunk(data=toret,\
-                                        dict_info_of_smallchunk={
+                dict_info_of_smallchunk = {
                                             "x":x_begin, "y":0,\
                                             "patch_levelidx":attention_levelidx,
                                             "kernel_size":kernel_size,
                                             "flag_auxlastcol":flag_auxlastcol,
                                             "vertbar_overlaptheprevpatch":vertbar_overlaptheprevpatch
-                                        },\
+                                        }
+                if((flag_tissue is not None) and (self.str_tilefiltermode == "tag")):
+                    dict_info_of_smallchunk["flag_tissue"] = flag_tissue
+                smallchunk = SmallChunk(data=toret,\
+                                        dict_info_of_smallchunk=dict_info_of_smallchunk,\
                                         dict_info_of_bigchunk = bigchunk.dict_info_of_bigchunk,\
                                         patient=bigchunk.patient
                                 )
@@ -377,7 +929,8 @@ class SlidingWindowSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
     
     
 class SlidingWindowBigChunkLoader(pydmed.lightdl.BigChunkLoader):
-    def slice_by_slidingwindow(self, W, kernel_size, stride):
+    @staticmethod
+    def slice_by_slidingwindow(W, kernel_size, stride):
         '''
         Slices the length `W` by `kernel_size` and `stride`.
         Outputs the number of shifts. 
@@ -395,31 +948,37 @@ class SlidingWindowBigChunkLoader(pydmed.lightdl.BigChunkLoader):
         Please note that in this function you have access to
         self.patient and self.const_global_info.
         '''
+        #get `idx_bigrow` to be extracted =====
+        checkpoint = self.get_checkpoint()
+        if(checkpoint == None):
+            idx_bigrow = 0
+        else:
+            idx_bigrow = checkpoint["idx_bigrow"]
+        return self.read_bigrow(self.patient, self.const_global_info, idx_bigrow)
+    
+    @staticmethod
+    def read_bigrow(patient, const_global_info, idx_bigrow):
+        '''
+        Reads the `idx_bigrow`-th bigrow of the patient's image and returns it as a `BigChunk`.
+        If the row does not exist (or reading fails), the string "None-Bigchunk" is returned.
+        This function is also called by `SlidingWindowSmallChunkCollector` to read ahead the next bigrow.
+        '''
         try:
-            #get `idx_bigrow` to be extracted =====
-            checkpoint = self.get_checkpoint()
-            if(checkpoint == None):
-                idx_bigrow = 0
-            else:
-                idx_bigrow = checkpoint["idx_bigrow"]
-                
             #extract fields from const_global_info ====
-            intorfunc_opslevel = self.const_global_info["pdmreserved_intorfunc_opslevel"]
-            kernel_size = self.const_global_info["pdmreserved_kernel_size"]
-            stride = self.const_global_info["pdmreserved_stride"]
-            func_patient_to_fnameimage = self.const_global_info["pdmreserved_func_patient_to_fnameimage"]
+            intorfunc_opslevel = const_global_info["pdmreserved_intorfunc_opslevel"]
+            kernel_size = const_global_info["pdmreserved_kernel_size"]
+            stride = const_global_info["pdmreserved_stride"]
             
             #compute some constants ====
-            fname_wsi = func_patient_to_fnameimage(self.patient) #os.path.join(wsi.rootdir, wsi.relativedir)
-            osimage = openslide.OpenSlide(fname_wsi)
+            osimage = open_image_of_patient(patient, const_global_info)
             if(isinstance(intorfunc_opslevel, int) == True):
                 attention_levelidx = intorfunc_opslevel
             else:
-                attention_levelidx = intorfunc_opslevel(self.patient)
+                attention_levelidx = intorfunc_opslevel(patient)
             w, h = kernel_size, kernel_size #in the taget level
             W, H = osimage.level_dimensions[attention_levelidx] #size in the target level
             downsample_of_patchlevel = osimage.level_downsamples[attention_levelidx] 
-            num_bigrows = self.slice_by_slidingwindow(H, kernel_size, stride)
+            num_bigrows = SlidingWindowBigChunkLoader.slice_by_slidingwindow(H, kernel_size, stride)
             
             #extract the target row ====
             y_begin = int(stride*idx_bigrow) #size in the target level
@@ -440,17 +999,13 @@ class SlidingWindowBigChunkLoader(pydmed.lightdl.BigChunkLoader):
                 y_begin_at_level0 = int(y_begin*osimage.level_downsamples[attention_levelidx])
                 flag_from_auxbigrow = True
                 horizbar_overlaptheprevpatch = kernel_size - (y_end-prev_y_end)
-            pil_bigchunk = osimage.read_region(
+            np_bigchunk = osimage.read_region(
                                 [0, y_begin_at_level0],
                                 attention_levelidx,
                                 [W,h]
                               )
-            np_bigchunk = np.array(pil_bigchunk)[:,:,0:3]
-            self.patient.dict_records["precomputed_opsimage"] =  "none"
-            patient_without_foregroundmask = copy.deepcopy(self.patient)
-            for k in patient_without_foregroundmask.dict_records.keys():
-                if(k.startswith("precomputed")):
-                    patient_without_foregroundmask.dict_records[k] = None
+            osimage.close()
+            #no need to copy the patient, only its unique id goes through the queues (see `BigChunk.__getstate__`).
             bigchunk = BigChunk(data=np_bigchunk,\
                                 dict_info_of_bigchunk={
                                     "W":W, "H":H, "x":0, "y":y_begin,
@@ -461,11 +1016,11 @@ class SlidingWindowBigChunkLoader(pydmed.lightdl.BigChunkLoader):
                                     "flag_from_auxbigrow":flag_from_auxbigrow,
                                     "horizbar_overlaptheprevpatch": horizbar_overlaptheprevpatch
                                 },\
-                                patient=patient_without_foregroundmask
+                                patient=patient
                          )
             return bigchunk
         except Exception as exception:
-            print("extractbigchunk failed for patient {}.".format(self.patient))
+            print("extractbigchunk failed for patient {}.".format(patient))
             print(exception)
             return "None-Bigchunk"
         
@@ -474,11 +1029,14 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
         self, intorfunc_opslevel, kernel_size,
         stride, mininterval_loadnewbigchunk, 
         tfms_onsmallchunkcollection, func_patient_to_fnameimage = None,
+        flag_batchcolumns = False, tfms_onbatchcollection = None,
+        flag_readahead = False, func_open_image = None,
+        func_tilefilter = None, str_tilefiltermode = "drop",
         *args, **kwargs):
         '''
         Inputs.
             - intorfunc_opslevel: it can be either an integer, or a function. 
-                    This argument specifies the level of the openslide image
+                    This argument specifies the level of the image
                     from which the patches are extracted.
                     If it is an integer, e.g., 0, the DL will return from level 0.
                     If it is a function, it has to take in a patient and return
@@ -492,9 +1050,35 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
                 between loading two bigchunks.
                 This number depends on how big each `BigChunk` is as well as system specs.
             - tfms_onsmallchunkcollection: a callable object, the transformations to be applied to each SmallChunk (i.e. each tile).
+            - flag_batchcolumns: a boolean. If True, all columns of a bigrow are sliced at once, transformed as a batch,
+                and placed in the queue as a single message. Default is False.
+            - tfms_onbatchcollection: a callable object, only used when `flag_batchcolumns` is True.
+                It has to take in a numpy array of shape [N x H x W x C] (the tiles of a bigrow) and return
+                an array of the same layout, e.g., `TfmsBatchNormalize`. If None, `tfms_onsmallchunkcollection`
+                is applied to the tiles one by one.
+            - flag_readahead: a boolean. If True, while a bigrow is being sliced the next bigrow
+                of the same patient is read in a background thread, and the bigrows are processed back to back
+                without waiting for the scheduler to reload the patient. Default is False.
+            - func_open_image: a function that takes in the path returned by `func_patient_to_fnameimage`
+                and returns an `ImageReader` (see `pydmed.utils.imagereader`).
+                If None, `pydmed.utils.imagereader.open_image` is used, which picks the reader based on the file extension.
+            - func_tilefilter: a callable object or None (default). If not None, it has to take in a uint8 numpy array
+                of shape [N x H x W x C] (the untransformed tiles) and return a boolean numpy array of shape [N]
+                which is False for the background tiles, e.g., `TissueTileFilter`. It is called in the collector processes,
+                before the transformations and before the tiles are placed in the queues.
+            - str_tilefiltermode: a string in {"drop", "tag"}, only used when `func_tilefilter` is not None.
+                "drop" (default): the background tiles are not returned at all, so the model is only run on tissue.
+                    The skipped positions get the `fill_value` of `pdmcsvtoarray`/`pdmbintoarray` (pass `flag_fillgaps=True`
+                    so the rows/columns with no tissue at all are kept as well)
+                    (or of `RasterWriter` in the "stream_to_raster" mode of `StreamCollector`).
+                    Note that a patient whose tiles are all dropped has no output.
+                "tag": all tiles are returned, and `smallchunk.dict_info_of_smallchunk["flag_tissue"]` tells
+                    whether a tile is tissue.
             
                 
         '''
+        if(str_tilefiltermode not in ["drop", "tag"]):
+            raise Exception("`str_tilefiltermode` has to be either 'drop' or 'tag', but it is {}.".format(str_tilefiltermode))
         super(SlidingWindowDL, self).__init__(*args, **kwargs)
         #grab privates ====
         kwargs["type_bigchunkloader"] = SlidingWindowBigChunkLoader
@@ -514,11 +1098,44 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
             self.const_global_info["pdmreserved_func_patient_to_fnameimage"] = default_func_patient_to_fnameimage
         self.const_global_info["pdmreserved_mininterval_loadnewbigchunk"] = mininterval_loadnewbigchunk
         self.const_global_info["pdmreserved_tfms_onsmallchunkcollection"] = tfms_onsmallchunkcollection
+        self.const_global_info["pdmreserved_flag_batchcolumns"] = flag_batchcolumns
+        self.const_global_info["pdmreserved_tfms_onbatchcollection"] = tfms_onbatchcollection
+        self.const_global_info["pdmreserved_flag_readahead"] = flag_readahead
+        self.const_global_info["pdmreserved_func_open_image"] = func_open_image
+        self.const_global_info["pdmreserved_func_tilefilter"] = func_tilefilter
+        self.const_global_info["pdmreserved_str_tilefiltermode"] = str_tilefiltermode
     
+    def resume_from_progressjournal(self, progressjournal):
+        '''
+        Resumes a crashed run from a `pydmed.utils.output.ProgressJournal`. The finished patients are not scheduled,
+        and other patients are resumed from the first row which is not fully written (i.e. `idx_bigrow` in the journal).
+        It has to be called before the `SlidingWindowDL` is started.
+        '''
+        super(SlidingWindowDL, self).resume_from_progressjournal(progressjournal)
+        if(self.flag_enable_setgetcheckpoint == False):
+            print("Warning: `flag_enable_setgetcheckpoint` is False, so the patients are resumed from the first row.")
+            return
+        for patient in self.dataset.list_patients:
+            progress = progressjournal.get_progress(patient)
+            if(progress is None):
+                continue
+            if((progress["flag_finished"] == False) and (progress["idx_bigrow"] is not None)):
+                self.dict_patient_to_checkpoint[patient] = {"idx_bigrow":progress["idx_bigrow"]}
+
+    def get_flag_patientemitted(self, subproc):
+        '''
+        All tiles of a patient are emitted when its `SlidingWindowSmallChunkCollector` has sliced the last row,
+        i.e. when its status is "idlefinished" (see `pydmed.lightdl.LightDL.get_flag_patientemitted`).
+        '''
+        return (subproc.get_status() == "idlefinished")
+
     def initial_schedule(self):
-        #Default is to choose randomly from dataset.
+        #Default is to choose randomly from dataset (except the finished patients).
+        list_candidates = self.get_list_initialcandidates()
+        if(len(list_candidates) == 0):
+            return [] #all patients are finished.
         toret =  random.choices(
-                    self.dataset.list_patients,\
+                    list_candidates,\
                     k=self.const_global_info["num_bigchunkloaders"]
                 )
         for patient in toret:
@@ -548,6 +1165,11 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
                 if(subproc.get_flag_bigchunkloader_terminated() == False):
                     return None, None
             
+            #the patients finished by the consumer are handled as if their last bigchunk is loaded ====
+            for patient in self.get_list_finishedpatients():
+                if((patient in self.list_itwaslastbigchunk) == False):
+                    self.list_itwaslastbigchunk.append(patient)
+            
             #see if all patients are done ====
             #TODO:print? print("set of it was last bigchunk = {}\n".format(set(self.list_itwaslastbigchunk)))
             if(set(self.list_itwaslastbigchunk) == set(self.dataset.list_patients)):
@@ -615,6 +1237,8 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
                 else:
                     #load a new patient, which indeed won't return any big/small chunk.
                     list_waitingpatients = self.get_list_waitingpatients()
+                    if(len(list_waitingpatients) == 0):
+                        return None, None #only the finished patients are waiting.
                     patient_toload = random.choice(list_waitingpatients)
                     
                 #check if the sched/unsched is useful (i.e. not swapping two finished patients)
@@ -633,3 +1257,179 @@ class SlidingWindowDL(pydmed.lightdl.LightDL):
             print(str(e))
             print("     but returned None, None (case 3)")
             return None, None
+
+
+def extract_crops(np_image, np_y, np_x, size_crop):
+    '''
+    Extracts many crops from an image at once, without a python loop over the crops.
+    Inputs.
+        - np_image: a numpy array of shape [H x W x C].
+        - np_y, np_x: integer numpy arrays of shape [K], the top-left corners of the crops.
+        - size_crop: an integer, the width (and height) of the crops.
+    Outputs.
+        - np_crops: a numpy array of shape [K x size_crop x size_crop x C].
+    '''
+    np_windows = np.lib.stride_tricks.sliding_window_view(
+                        np_image, (size_crop, size_crop), axis=(0,1)
+                    ) #[H-size_crop+1 x W-size_crop+1 x C x size_crop x size_crop], no copy is made.
+    np_crops = np_windows[np_y, np_x] #[K x C x size_crop x size_crop]
+    return np.ascontiguousarray(np.transpose(np_crops, [0,2,3,1]))
+
+
+def get_tissuefraction(np_crops, thresh_saturation):
+    '''
+    Computes the fraction of tissue pixels in a batch of RGB crops.
+    A pixel is considered as tissue if max(R,G,B)-min(R,G,B) is above `thresh_saturation`.
+    Inputs.
+        - np_crops: a numpy array of shape [K x h x w x 3].
+        - thresh_saturation: a number in [0, 255].
+    Outputs.
+        - np_tissuefraction: a numpy array of shape [K] with values in [0,1].
+    '''
+    np_saturation = np_crops.max(axis=3).astype(np.int16) - np_crops.min(axis=3)
+    return np.mean(np_saturation > thresh_saturation, axis=(1,2))
+
+
+class RandomPatchBigChunkLoader(pydmed.lightdl.BigChunkLoader):
+    @abstractmethod
+    def extract_bigchunk(self, last_message_fromroot):
+        '''
+        Extracts a bigchunk from a random location of the image.
+        Please note that in this function you have access to
+        self.patient and self.const_global_info.
+        '''
+        try:
+            #extract fields from const_global_info ====
+            intorfunc_opslevel = self.const_global_info["pdmreserved_intorfunc_opslevel"]
+            size_bigchunk = self.const_global_info["pdmreserved_size_bigchunk"]
+            
+            #compute some constants ====
+            osimage = open_image_of_patient(self.patient, self.const_global_info)
+            if(isinstance(intorfunc_opslevel, int) == True):
+                attention_levelidx = intorfunc_opslevel
+            else:
+                attention_levelidx = intorfunc_opslevel(self.patient)
+            W, H = osimage.level_dimensions[attention_levelidx] #size in the target level
+            downsample_of_patchlevel = osimage.level_downsamples[attention_levelidx]
+            w, h = min(size_bigchunk, W), min(size_bigchunk, H)
+            
+            #extract a random bigchunk ====
+            x_begin = np.random.randint(0, W-w+1) #in the target level
+            y_begin = np.random.randint(0, H-h+1)
+            np_bigchunk = osimage.read_region(
+                                [int(x_begin*downsample_of_patchlevel), int(y_begin*downsample_of_patchlevel)],
+                                attention_levelidx,
+                                [w,h]
+                              )
+            osimage.close()
+            bigchunk = BigChunk(data=np_bigchunk,\
+                                dict_info_of_bigchunk={
+                                    "W":w, "H":h, "x":x_begin, "y":y_begin,
+                                    "WSI_W":W, "WSI_H":H,
+                                    "patch_levelidx":attention_levelidx,
+                                    "downsample_of_patchlevel":downsample_of_patchlevel
+                                },\
+                                patient=self.patient
+                         )
+            return bigchunk
+        except Exception as exception:
+            print("extractbigchunk failed for patient {}.".format(self.patient))
+            print(exception)
+            return "None-Bigchunk"
+
+
+class RandomPatchSmallChunkCollector(pydmed.lightdl.SmallChunkCollector):
+    def __init__(self, *args, **kwargs):
+        super(RandomPatchSmallChunkCollector, self).__init__(*args, **kwargs)
+        #grab privates
+        self.size_smallchunk = self.const_global_info["pdmreserved_size_smallchunk"]
+        self.num_smallchunks_percall = self.const_global_info["pdmreserved_num_smallchunks_percall"]
+        self.thresh_saturation = self.const_global_info["pdmreserved_thresh_saturation"]
+        self.thresh_tissuefraction = self.const_global_info["pdmreserved_thresh_tissuefraction"]
+    
+    @abstractmethod
+    def extract_smallchunk(self, call_count, bigchunk, last_message_fromroot):
+        '''
+        Extracts `num_smallchunks_percall` random crops from the bigchunk at once, and
+        returns them as a list of `SmallChunk`s (i.e. a single message in the queues).
+        If `thresh_saturation` is not None, the crops whose tissue fraction is
+        below `thresh_tissuefraction` are dropped.
+        '''
+        #handle the case where the returned BigChunk is None.
+        if(isinstance(bigchunk, str)):
+            assert(bigchunk == "None-Bigchunk")
+            return None
+        
+        #draw the crops ====
+        H, W = bigchunk.data.shape[0], bigchunk.data.shape[1]
+        size_smallchunk = min(self.size_smallchunk, H, W)
+        np_y = np.random.randint(0, H-size_smallchunk+1, size=self.num_smallchunks_percall)
+        np_x = np.random.randint(0, W-size_smallchunk+1, size=self.num_smallchunks_percall)
+        np_crops = extract_crops(bigchunk.data, np_y, np_x, size_smallchunk)
+        
+        #reject the background crops if needed ====
+        if(self.thresh_saturation != None):
+            np_keep = get_tissuefraction(np_crops, self.thresh_saturation) >= self.thresh_tissuefraction
+            np_crops, np_y, np_x = np_crops[np_keep], np_y[np_keep], np_x[np_keep]
+        
+        #wrap in SmallChunks ====
+        list_smallchunks = []
+        for n in range(np_crops.shape[0]):
+            list_smallchunks.append(
+                SmallChunk(data=np_crops[n],\
+                           dict_info_of_smallchunk={
+                               "x":int(np_x[n]), "y":int(np_y[n]),
+                               "kernel_size":size_smallchunk
+                           },\
+                           dict_info_of_bigchunk = bigchunk.dict_info_of_bigchunk,\
+                           patient=bigchunk.patient
+                )
+            )
+        return list_smallchunks
+
+
+class RandomPatchDL(pydmed.lightdl.LightDL):
+    def __init__(
+        self, intorfunc_opslevel, size_bigchunk, size_smallchunk,
+        num_smallchunks_percall, func_patient_to_fnameimage = None,
+        thresh_saturation = None, thresh_tissuefraction = 0.5, func_open_image = None,
+        *args, **kwargs):
+        '''
+        A dataloader that returns random patches from the images.
+        Each `SmallChunkCollector` extracts `num_smallchunks_percall` patches from its `BigChunk` at once.
+        Inputs.
+            - intorfunc_opslevel: it can be either an integer, or a function. 
+                    This argument specifies the level of the image
+                    from which the patches are extracted.
+                    If it is a function, it has to take in a patient and return
+                    the intended level based on the input patient.
+            - size_bigchunk: an integer, the width (and height) of the `BigChunk`s in the target level.
+            - size_smallchunk: an integer, the width (and height) of the patches.
+            - num_smallchunks_percall: an integer, number of patches extracted at once.
+            - func_patient_to_fnameimage: a function. 
+                This function has to take in a `Patient` and return the aboslute path
+                of the image (or WSI).
+            - thresh_saturation: a number in [0,255] or None. If not None, a pixel is considered
+                as tissue if max(R,G,B)-min(R,G,B) is above this threshold, and the patches with
+                few tissue pixels are dropped.
+            - thresh_tissuefraction: a number in [0,1], the minimum fraction of tissue pixels
+                in a patch. Only used when `thresh_saturation` is not None.
+            - func_open_image: a function that takes in the path returned by `func_patient_to_fnameimage`
+                and returns an `ImageReader` (see `pydmed.utils.imagereader`).
+                If None, `pydmed.utils.imagereader.open_image` is used, which picks the reader based on the file extension.
+        '''
+        kwargs.setdefault("type_bigchunkloader", RandomPatchBigChunkLoader)
+        kwargs.setdefault("type_smallchunkcollector", RandomPatchSmallChunkCollector)
+        super(RandomPatchDL, self).__init__(*args, **kwargs)
+        #place the input arguments within `const_global_info`
+        self.const_global_info["pdmreserved_intorfunc_opslevel"] = intorfunc_opslevel
+        self.const_global_info["pdmreserved_size_bigchunk"] = size_bigchunk
+        self.const_global_info["pdmreserved_size_smallchunk"] = size_smallchunk
+        self.const_global_info["pdmreserved_num_smallchunks_percall"] = num_smallchunks_percall
+        if(func_patient_to_fnameimage != None):
+            self.const_global_info["pdmreserved_func_patient_to_fnameimage"] = func_patient_to_fnameimage
+        else:
+            self.const_global_info["pdmreserved_func_patient_to_fnameimage"] = default_func_patient_to_fnameimage
+        self.const_global_info["pdmreserved_thresh_saturation"] = thresh_saturation
+        self.const_global_info["pdmreserved_thresh_tissuefraction"] = thresh_tissuefraction
+        self.const_global_info["pdmreserved_func_open_image"] = func_open_image
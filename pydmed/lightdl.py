@@ -3,7 +3,7 @@
 
 '''
 General TODO:s
-    - replace os.nice and taskset with cross-platform counterparts.
+    - replace os.nice with a cross-platform counterpart.
 '''
 
 
@@ -15,6 +15,7 @@ from pathlib import Path
 import re
 import time
 import random
+import queue
 import multiprocessing as mp
 import subprocess
 from abc import ABC, abstractmethod
@@ -24,6 +25,7 @@ import torchvision
 import torchvision.models as models
 from multiprocessing import Process, Queue
 import pydmed.utils.multiproc
+import pydmed.utils.data
 from pydmed.utils.multiproc import *
 
 '''
@@ -49,6 +51,39 @@ def get_default_constglobinf():
     return toret
 
 
+def get_numinstances_of_message(message):
+    '''
+    Returns the number of instances in a message of the queues, i.e. the length of the list
+    if `SmallChunkCollector.extract_smallchunk` has returned a list of `SmallChunk`s, 0 for a `PatientEmitted`, and 1 otherwise.
+    The limits `maxlength_queue_smallchunk` and `maxlength_queue_lightdl` are on the number of instances (not messages).
+    '''
+    if(isinstance(message, list)):
+        return len(message)
+    if(isinstance(message, PatientEmitted)):
+        return 0
+    return 1
+
+
+def _add_to_counter(counter, num):
+    '''
+    Adds `num` to a shared counter (an instance of multiprocessing.Value).
+    '''
+    with counter.get_lock():
+        counter.value += num
+
+
+class PatientEmitted:
+    def __init__(self, int_uniqueid):
+        '''
+        Is placed in `queue_lightdl` by the DL process after the last smallchunk of a patient
+        whose smallchunks are all emitted (see `LightDL.get_flag_patientemitted`).
+        It is not returned by `LightDL.get`, the patient is listed by `LightDL.pop_list_emittedpatients` instead.
+        Inputs.
+            - int_uniqueid: the unique id of the patient.
+        '''
+        self.int_uniqueid = int_uniqueid
+
+
 class BigChunk:
     def __init__(self, data, dict_info_of_bigchunk, patient):
         '''
@@ -69,6 +104,13 @@ class BigChunk:
         self.data = data
         self.dict_info_of_bigchunk = dict_info_of_bigchunk
         self.patient = patient
+    
+    def __getstate__(self):
+        '''
+        When passed through a `multiprocessing.Queue`, only the unique id of the patient is pickled.
+        The receiving process maps the id back to the `Patient` (see `SmallChunkCollector.run`).
+        '''
+        return _compactpatient_state(self.__dict__)
 
 class SmallChunk:
     '''
@@ -94,6 +136,25 @@ class SmallChunk:
         self.dict_info_of_smallchunk = dict_info_of_smallchunk
         self.dict_info_of_bigchunk = dict_info_of_bigchunk
         self.patient = patient
+    
+    def __getstate__(self):
+        '''
+        When passed through a `multiprocessing.Queue`, only the unique id of the patient is pickled.
+        The `Patient` is looked up again in `LightDL.get`.
+        '''
+        return _compactpatient_state(self.__dict__)
+
+
+def _compactpatient_state(dict_state):
+    '''
+    Returns a shallow copy of `dict_state` in which the field "patient" is replaced by
+    `patient.int_uniqueid`. In this way `Patient.dict_records` (including the "precomputed*" records)
+    never go through the queues.
+    '''
+    toret = dict_state.copy()
+    if(isinstance(toret.get("patient"), pydmed.utils.data.Patient)):
+        toret["patient"] = toret["patient"].int_uniqueid
+    return toret
 
 
 class BigChunkLoader(mp.Process):
@@ -141,8 +202,7 @@ class BigChunkLoader(mp.Process):
         
         #assign the bigchunkloader to core
         if(self.const_global_info["core-assignment"]["bigchunkloaders"] != None):
-            os.system("taskset -cp {} {}".format(self.const_global_info["core-assignment"]["bigchunkloaders"], os.getpid()))
-            print(" taskset called for bigchunkloader")
+            pydmed.utils.multiproc.set_cpuaffinity(self.const_global_info["core-assignment"]["bigchunkloaders"], flag_allthreads=False)
             
         #extract a bigchunk =======
         bigchunk = self.extract_bigchunk(self.last_message_from_root)
@@ -221,6 +281,7 @@ class SmallChunkCollector(mp.Process):
         self._queue_status = mp.Queue()
         self._cached_status = "TODO:packagename reserverd: empty cache"
         self._queue_bigchunkloader_terminated = mp.Queue()
+        self.numinstances_queue_smallchunks = mp.Value("q", 0) #the number of instances (not messages) in `queue_smallchunks`.
         
     def log(self, str_input):
         '''
@@ -313,8 +374,7 @@ class SmallChunkCollector(mp.Process):
             # ~ idx_cores = [int(u) for u in self.const_global_info["core-assignment"]["smallchunkloaders"].split(",")]
             # ~ p.cpu_affinity(idx_cores)
             # ~ print("in smallchunkloaders, idx_cores={}".format(idx_cores))
-            os.system("taskset -cp {} {}".format(self.const_global_info["core-assignment"]["smallchunkloaders"], os.getpid()))
-            print(" taskset called for smallchunkloader")
+            pydmed.utils.multiproc.set_cpuaffinity(self.const_global_info["core-assignment"]["smallchunkloaders"], flag_allthreads=False)
         #print("    subprocess pinded to cores")
         
         # ~ print("reached here 1")
@@ -336,10 +396,11 @@ class SmallChunkCollector(mp.Process):
         self._queue_bigchunkloader_terminated.put_nowait("Finished loading a bigchunk")
         
         bigchunk = queue_bc.get()
+        self._reattach_patient(bigchunk)
         # ~ print("reached here 6")
         call_count = 0
         while(True):
-            if(self.queue_smallchunks.qsize() < self.const_global_info["maxlength_queue_smallchunk"]):
+            if(self.numinstances_queue_smallchunks.value < self.const_global_info["maxlength_queue_smallchunk"]):
                 # ~ print(" ----------------- reached here 7")
                 #print("  smallchunkcollector saw emtpy place in queue.")
                 smallchunk = self.extract_smallchunk(call_count, bigchunk, self.last_message_from_root)
@@ -348,12 +409,44 @@ class SmallChunkCollector(mp.Process):
                 if(isinstance(smallchunk, np.ndarray) == False):
                     if(smallchunk == None):
                         pass
+                    elif(isinstance(smallchunk, list) and (len(smallchunk) == 0)):
+                        pass
                     else:
-                        self.queue_smallchunks.put_nowait(smallchunk)
+                        self.put_smallchunk(smallchunk) #a list of smallchunks goes as a single message.
                 else:
-                    self.queue_smallchunks.put_nowait(smallchunk)
+                    self.put_smallchunk(smallchunk)
                 #print("     placed a smallchunk in queue.")
         
+    def put_smallchunk(self, smallchunk):
+        '''
+        Places a smallchunk (or a list of smallchunks) in `queue_smallchunks`, and counts its instances.
+        '''
+        _add_to_counter(self.numinstances_queue_smallchunks, get_numinstances_of_message(smallchunk))
+        self.queue_smallchunks.put_nowait(smallchunk)
+    
+    def get_smallchunk_nowait(self):
+        '''
+        Is called by `LightDL`. Pops a message from `queue_smallchunks` and uncounts its instances.
+        Raises `queue.Empty` if the queue is empty.
+        '''
+        smallchunk = self.queue_smallchunks.get_nowait()
+        _add_to_counter(self.numinstances_queue_smallchunks, -get_numinstances_of_message(smallchunk))
+        return smallchunk
+    
+    def _reattach_patient(self, bigchunk):
+        '''
+        `BigChunk`s arrive with only the unique id of the patient (see `BigChunk.__getstate__`).
+        This function places `self.patient` back, so `extract_smallchunk` can use `bigchunk.patient` as before.
+        The bigchunkloader may return a `BigChunk`, a list of `BigChunk`s, or any other object.
+        '''
+        if(isinstance(bigchunk, (list, tuple))):
+            for elem in bigchunk:
+                self._reattach_patient(elem)
+        elif(isinstance(bigchunk, BigChunk)):
+            if(isinstance(bigchunk.patient, pydmed.utils.data.Patient) == False):
+                if(bigchunk.patient == self.patient.int_uniqueid):
+                    bigchunk.patient = self.patient
+    
     def get_flag_bigchunkloader_terminated(self):
         '''
         checks if the _queue_bigchunkloader_terminated attribute has any items in it. If it does, it returns True, indicating that the big chunk loader has finished loading a big chunk. Otherwise, it returns False.
@@ -384,9 +477,11 @@ class SmallChunkCollector(mp.Process):
             - `last_message_fromroot`: The last messsage sent to this patient. Indeed, this is the message sent by calling the function
                                        `lightdl.send_message`.
         Output:
-            - smallchunk: has to be either an instance of `SmallChunk` or None.
+            - smallchunk: has to be either an instance of `SmallChunk`, a list of `SmallChunk`s, or None.
                           Returning None means the `SmallChunkCollector` is no longer willing to extract `SmallChunk`s for, e.g.,
                           it has sufficiently explored the patient's records. 
+                          A list of `SmallChunk`s is placed in the queues as a single message, which is much cheaper
+                          than placing the `SmallChunk`s one by one. `LightDL.get` unpacks the list.
         '''
         pass
 
@@ -394,7 +489,7 @@ class SmallChunkCollector(mp.Process):
 class LightDL(mp.Process):
     def __init__(self, dataset, type_bigchunkloader, type_smallchunkcollector,\
                  const_global_info, batch_size, tfms, flag_grabqueue_onunsched=True, collate_func=None, fname_logfile=None,
-                 flag_enable_sendgetmessage = True, flag_enable_setgetcheckpoint = True):
+                 flag_enable_sendgetmessage = True, flag_enable_setgetcheckpoint = True, maxwait_batch = None):
         '''
         inherits from mp.Process
         initializes the instance variables inputs, the transformation function (tfms). The class also has flags to enable/disable sending and getting messages (flag_enable_sendgetmessage) and setting/getting checkpoints (flag_enable_setgetcheckpoint).
@@ -417,6 +512,10 @@ class LightDL(mp.Process):
                         waiting times. etc.
             - batch_size: the size of each batch, an integer.
             - fname_logfile: the name of the file to which `.log(str)` function will write.
+            - maxwait_batch: if None (default), `get` returns batches of size `batch_size` while the DL is running, 
+                and single instances once the DL is finished. Otherwise, dynamic batching is used, i.e. `batch_size` is
+                the maximum size of batches, and `get` returns the instances which are available within
+                `maxwait_batch` seconds after the first instance of the batch arrives (also when the DL is finished).
         '''
         #grab privates ====
         super(LightDL, self).__init__()
@@ -425,6 +524,7 @@ class LightDL(mp.Process):
         self.type_smallchunkcollector = type_smallchunkcollector
         self.const_global_info = const_global_info
         self.queue_lightdl = mp.Queue()
+        self.numinstances_queue_lightdl = mp.Value("q", 0) #the number of instances (not messages) in `queue_lightdl`.
         self.batch_size = batch_size
         self.flag_grabqueue_onunsched = flag_grabqueue_onunsched
         self.fname_logfile = fname_logfile
@@ -435,11 +535,18 @@ class LightDL(mp.Process):
         self.tfms = tfms
         self.flag_enable_setgetcheckpoint = flag_enable_setgetcheckpoint
         self.flag_enable_sendgetmessage = flag_enable_sendgetmessage
+        self.maxwait_batch = maxwait_batch
         #make internals ====
         self.active_subprocesses = set() #set of currently active processes
         self._queue_pid_of_lightdl = mp.Queue()
         self._queue_message_lightdlfinished = mp.Queue()
+        self._event_ready = mp.Event() #set when the first smallchunk is placed in `queue_lightdl`, or when the DL is finished.
+        self._event_stop = mp.Event() #set by `pause_loading` to stop the DL process.
+        self._queue_finishedpatients = mp.Queue() #the unique ids of the patients which are finished by the consumer.
+        self.list_finishedpatients = [] #updated within the DL process, see `mark_patient_finished`.
+        self._list_emittedpatients = [] #updated within the consumer process, see `pop_list_emittedpatients`.
         self.dict_patient_to_schedcount = {patient:0 for patient in self.dataset.list_patients}
+        self._dict_uniqueid_to_patient = {patient.int_uniqueid:patient for patient in self.dataset.list_patients}
         #self.list_poped_entities = []
         self.list_smallchunksforvis = [] #smallchunks without data and only for visualization.
         if(flag_enable_setgetcheckpoint == True):
@@ -516,14 +623,22 @@ class LightDL(mp.Process):
         except:
             pass
     
-    def pause_loading(self):
+    def pause_loading(self, timeout_join=10):
         '''
-        used to pause the data loading process by killing the LightDataLoader subprocess
-        retrieves the PID of the LightDataLoader process from the queue and then terminates it using the _terminaterecursively method
+        used to pause the data loading process by stopping the LightDataLoader subprocess
+        The DL process is signaled to stop. It stops its `SmallChunkCollector`s and exits, and is then joined.
+        If it does not exit within `timeout_join` seconds, it is killed (recursively, with its subprocesses) by the _terminaterecursively method
         also flushes the log file using the flush_log method
         '''
+        self._event_stop.set()
         lightdl_pid = self._queue_pid_of_lightdl.get()
         self.flush_log()
+        try:
+            self.join(timeout_join)
+            if(self.is_alive() == False):
+                return
+        except Exception as e:
+            pass #e.g., when it is not called from the parent process.
         parent = psutil.Process(lightdl_pid)#TODO:copyright, https://www.reddit.com/r/learnpython/comments/7vwyez/how_to_kill_child_processes_when_using/
         for child in parent.children(recursive=True):
             try:
@@ -537,6 +652,155 @@ class LightDL(mp.Process):
         except:
             pass
     
+    def _drain_subprocesses(self):
+        '''
+        Is called within the DL process before it signals that the DL is finished.
+        Moves all remaining smallchunks of the `SmallChunkCollector`s to `queue_lightdl`,
+        and places a `PatientEmitted` after the smallchunks of each patient whose smallchunks are all emitted.
+        '''
+        for subproc in list(self.active_subprocesses):
+            self._grab_smallchunks_of(subproc, timeout=1.0)
+            self._put_patientemitted_ifneeded(subproc)
+    
+    def _grab_smallchunks_of(self, subproc, timeout=None):
+        '''
+        Is called within the DL process. Moves the smallchunks of a `SmallChunkCollector` to `queue_lightdl`.
+        If `timeout` is None, only the smallchunks which are available are moved.
+        Otherwise, it waits (at most `timeout` seconds for each message) until all smallchunks placed by the collector are moved.
+        '''
+        if(timeout is None):
+            size_queue = subproc.queue_smallchunks.qsize()
+            for count in range(size_queue):
+                try:
+                    self._put_in_queuelightdl(subproc.get_smallchunk_nowait())
+                except Exception as e:
+                    print("Warning: Some smallchunks may have lost. If not, you can safely ignore this warning.")
+            return
+        while(subproc.numinstances_queue_smallchunks.value > 0):
+            try:
+                smallchunk = subproc.queue_smallchunks.get(timeout=timeout)
+            except queue.Empty:
+                print("Warning: Some smallchunks may have lost. If not, you can safely ignore this warning.")
+                return
+            _add_to_counter(subproc.numinstances_queue_smallchunks, -get_numinstances_of_message(smallchunk))
+            self._put_in_queuelightdl(smallchunk)
+    
+    def _put_patientemitted_ifneeded(self, subproc):
+        '''
+        Is called within the DL process, right after the smallchunks of `subproc` are moved to `queue_lightdl`.
+        Places a `PatientEmitted` in `queue_lightdl` if all smallchunks of the patient are emitted (see `get_flag_patientemitted`).
+        '''
+        if(subproc.patient in self.list_finishedpatients):
+            return #the consumer has finished the patient itself.
+        if(self.get_flag_patientemitted(subproc) == True):
+            self.queue_lightdl.put_nowait(PatientEmitted(subproc.patient.int_uniqueid))
+    
+    def get_flag_patientemitted(self, subproc):
+        '''
+        Is called within the DL process when a `SmallChunkCollector` is unscheduled (or when the DL is finished).
+        Returns True if all smallchunks of the patient of `subproc` are emitted, e.g., the last row of a WSI is sliced.
+        In this case, after its smallchunks the patient is listed by `pop_list_emittedpatients` in the consumer process
+        (e.g., so `StreamCollector` can save the patient as finished in its journal).
+        The default implementation returns False. Override it in subclasses, e.g., see `SlidingWindowDL`.
+        '''
+        return False
+    
+    def pop_list_emittedpatients(self):
+        '''
+        Is called in the consumer process, right after `get`. Returns the list of patients 
+        whose `PatientEmitted` has been popped by `get`, i.e. all smallchunks of these patients are already returned by `get`.
+        The returned patients are not returned again.
+        '''
+        toret = self._list_emittedpatients
+        self._list_emittedpatients = []
+        return toret
+    
+    def _put_in_queuelightdl(self, smallchunk):
+        '''
+        Is called within the DL process. Places a smallchunk (or a list of smallchunks) in `queue_lightdl`, and counts its instances.
+        '''
+        _add_to_counter(self.numinstances_queue_lightdl, get_numinstances_of_message(smallchunk))
+        self.queue_lightdl.put_nowait(smallchunk)
+    
+    def _get_from_queuelightdl(self, timeout=None):
+        '''
+        Pops a message from `queue_lightdl` and uncounts its instances.
+        If `timeout` is None it does not block, otherwise it blocks for at most `timeout` seconds.
+        Raises `queue.Empty` if no message is available.
+        '''
+        if(timeout is None):
+            smallchunk = self.queue_lightdl.get_nowait()
+        else:
+            smallchunk = self.queue_lightdl.get(timeout=timeout)
+        _add_to_counter(self.numinstances_queue_lightdl, -get_numinstances_of_message(smallchunk))
+        return smallchunk
+    
+    def _stop_subprocesses(self):
+        '''
+        Is called within the DL process when it is stopped (see `pause_loading`). 
+        Stops the `SmallChunkCollector`s (and their `BigChunkLoader`s) and joins them.
+        The smallchunks which are not consumed are dropped, so the DL process can exit without waiting for its queue to be consumed.
+        '''
+        for subproc in list(self.active_subprocesses):
+            LightDL._terminaterecursively(subproc.pid)
+            subproc.join()
+        self.active_subprocesses = set()
+        self.queue_lightdl.cancel_join_thread()
+    
+    def wait_until_ready(self, timeout=None):
+        '''
+        Blocks until the first smallchunk is placed in the queue of `LightDL` (or the DL is finished),
+        so consumers can start as soon as there is something to consume.
+        It waits in short slices, and raises an exception if the DL process exits before it becomes ready
+        (e.g., when the `BigChunkLoader` fails to open an image in the start-up).
+        Inputs.
+            - timeout: the maximum waiting time in seconds. If None, waits without a time limit.
+        Outputs.
+            - flag_ready: True if the `LightDL` is ready, False if the timeout is reached.
+        '''
+        time_deadline = None if(timeout is None) else (time.time() + timeout)
+        while(self.is_dl_running() and self.is_alive()):
+            timeout_slice = 0.5
+            if(time_deadline is not None):
+                timeout_slice = min(timeout_slice, time_deadline - time.time())
+                if(timeout_slice <= 0):
+                    return self._event_ready.is_set()
+            if(self._event_ready.wait(timeout_slice) == True):
+                return True
+        if((self._event_ready.is_set() == True) or (self.is_dl_running() == False)):
+            return True #the DL is finished (it sets `_event_ready` right after the end-of-stream signal).
+        raise Exception("The `LightDL` process exited (with exitcode {}) before it became ready.".format(self.exitcode))
+    
+    def mark_patient_finished(self, patient):
+        '''
+        Tells the DL that a patient is finished (e.g., by `StreamCollector.get_flag_finishcollecting_of`),
+        so the scheduler does not load the patient anymore. 
+        Can be called from the process which consumes the DL.
+        Inputs.
+            - patient: the patient, an instance of `utils.data.Patient`.
+        '''
+        self._queue_finishedpatients.put_nowait(patient.int_uniqueid)
+    
+    def _update_list_finishedpatients(self):
+        '''
+        Moves the patients which are marked as finished (see `mark_patient_finished`) to `self.list_finishedpatients`.
+        Is called within the DL process before each call to `schedule`.
+        '''
+        while(self._queue_finishedpatients.empty() == False):
+            try:
+                int_uniqueid = self._queue_finishedpatients.get_nowait()
+            except:
+                break
+            patient = self._dict_uniqueid_to_patient[int_uniqueid]
+            if((patient in self.list_finishedpatients) == False):
+                self.list_finishedpatients.append(patient)
+    
+    def get_list_finishedpatients(self):
+        '''
+        Returns the list of `Patient`s which are marked as finished (see `mark_patient_finished`).
+        '''
+        return self.list_finishedpatients
+    
     def is_dl_running(self):
         '''
         used to check if the data loading process is still running
@@ -609,23 +873,43 @@ class LightDL(mp.Process):
             smallchunk.data = "None to avoid memory leak"
         return x, list_patients, list_smallchunks
     
+    def _append_poped(self, list_poped_smallchunks, elem):
+        '''
+        Appends an element poped from `queue_lightdl` to `list_poped_smallchunks`.
+        The element can be a `SmallChunk` or a list of `SmallChunk`s (see `SmallChunkCollector.extract_smallchunk`).
+        A `PatientEmitted` is not appended, and its patient is listed by `pop_list_emittedpatients`.
+        '''
+        if(isinstance(elem, list)):
+            list_poped_smallchunks.extend(elem)
+        elif(isinstance(elem, PatientEmitted)):
+            self._list_emittedpatients.append(self._dict_uniqueid_to_patient[elem.int_uniqueid])
+        else:
+            list_poped_smallchunks.append(elem)
+    
     def get(self):
         '''
         responsible for retrieving a batch of data instances from the internal queue
         checks whether the data loader is still running or not. If the data loader is still running, the method tries to retrieve instances from the queue until it has collected enough instances to make up a batch of the specified size. If the queue is empty and the data loader has finished running, the method returns a flag indicating that it is the last batch to be returned. 
         If the data loader is not running, the method retrieves a single instance from the queue regardless of the batch size, until it has retrieved at least one instance. If the queue is empty and the data loader is not running, the method returns the flag indicating that it is the last batch to be returned.
         Once the instances are retrieved, the method applies the collate function specified in the constructor to convert the list of instances to a batch tensor and returns it. Finally, the method creates a new list of small chunks, similar to the input list but with the actual data replaced with the string "None to avoid memory leak", and adds these data-free small chunks to the internal list used for visualization. This is done to prevent memory leaks from accumulating during the lifetime of the LightDL object.
+        Note: when `SmallChunkCollector`s return lists of `SmallChunk`s, the lists are never split. 
+              Therefore, the size of the returned batch may exceed `batch_size` by at most the length of one list.
+        If `maxwait_batch` is not None, the batch is made by `_pop_dynamicbatch`.
         '''
         #make toret values =================
         list_poped_smallchunks = []
         flag_dl_running = self.is_dl_running()
-        if(flag_dl_running == True):
+        if(self.maxwait_batch is not None):
+            list_poped_smallchunks = self._pop_dynamicbatch()
+            if(isinstance(list_poped_smallchunks, str)):
+                return list_poped_smallchunks #i.e. PYDMEDRESERVED_DLRETURNEDLASTINSTANCE
+        elif(flag_dl_running == True):
             while(len(list_poped_smallchunks) < self.batch_size):
                 #try to get a new instance ====
                 if(self.queue_lightdl.qsize()>0):
                     try:
-                        smallchunk = self.queue_lightdl.get_nowait()
-                        list_poped_smallchunks.append(smallchunk)
+                        smallchunk = self._get_from_queuelightdl()
+                        self._append_poped(list_poped_smallchunks, smallchunk)
                     except:
                         pass
                 #if dl_is_finished and Q is empty, exit the while loop
@@ -640,21 +924,21 @@ class LightDL(mp.Process):
                         break
         elif(flag_dl_running == False):
             #in this case, `get` will return the Q instances one-by-one regardless of the the `batch_size`.
-            if(self.queue_lightdl.qsize() > 0):
-                while(len(list_poped_smallchunks) < 1):
-                    #try to get a new instance ====
-                    if(self.queue_lightdl.qsize()>0):
-                        try:
-                            smallchunk = self.queue_lightdl.get_nowait()
-                            list_poped_smallchunks.append(smallchunk)
-                        except:
-                            pass
-            else:
-                #in this case, dl is finished and Q is empty.
+            while((len(list_poped_smallchunks) < 1) and (self.queue_lightdl.qsize() > 0)):
+                #try to get a new instance ====
+                try:
+                    smallchunk = self._get_from_queuelightdl()
+                    self._append_poped(list_poped_smallchunks, smallchunk)
+                except:
+                    pass
+            if(len(list_poped_smallchunks) == 0):
+                #in this case, dl is finished and Q is empty (or only has `PatientEmitted`s).
                 return PYDMEDRESERVED_DLRETURNEDLASTINSTANCE
                         
                 
         # ~ print("get: reached here 2")
+        for smallchunk in list_poped_smallchunks:
+            self._reattach_patient(smallchunk)
         returnvalue_of_collatefunc = self.collate_func(list_poped_smallchunks, self.tfms)
         # ~ print("get: reached here 3")
         #grab visualization info ============
@@ -670,6 +954,56 @@ class LightDL(mp.Process):
         # ~ print("get: reached here 4")
         return returnvalue_of_collatefunc #batch_smallchunks, batch_patients, toret_list_smallchunks
     
+    def _pop_dynamicbatch(self):
+        '''
+        Pops the instances of a batch in dynamic batching mode (i.e. when `maxwait_batch` is not None).
+        It blocks until the first instance arrives, and then pops the instances which arrive within `maxwait_batch` seconds,
+        until `batch_size` instances are popped. When the DL is finished, the remaining instances are popped in batches as well,
+        and the batch is returned as soon as the queue is empty.
+        Outputs.
+            - list_poped_smallchunks: the popped instances, or PYDMEDRESERVED_DLRETURNEDLASTINSTANCE if the DL is finished
+                and no instance is left.
+        '''
+        list_poped_smallchunks = []
+        time_deadline = None
+        flag_retriedafterfinish = False
+        while(len(list_poped_smallchunks) < self.batch_size):
+            timeout_get = 0.05 #to check whether the DL is finished while waiting.
+            if(time_deadline is not None):
+                timeout_get = min(timeout_get, time_deadline - time.time())
+                if(timeout_get <= 0):
+                    break
+            #checked before `get`, so the last instances of the DL cannot arrive between the timeout and the check ====
+            flag_dl_finished = (self.is_dl_running() == False)
+            try:
+                elem = self._get_from_queuelightdl(timeout=timeout_get)
+                self._append_poped(list_poped_smallchunks, elem)
+                if(time_deadline is None):
+                    time_deadline = time.time() + self.maxwait_batch
+                continue
+            except queue.Empty:
+                pass
+            #the queue is empty, no more instances will arrive if the DL is finished ====
+            if((flag_dl_finished == True) and (self.queue_lightdl.qsize() == 0)):
+                if((self.numinstances_queue_lightdl.value > 0) and (flag_retriedafterfinish == False)):
+                    #some instances may still be on the way (e.g., in the pipe of the queue), try once more.
+                    flag_retriedafterfinish = True
+                    continue
+                if(len(list_poped_smallchunks) == 0):
+                    return PYDMEDRESERVED_DLRETURNEDLASTINSTANCE
+                break
+        return list_poped_smallchunks
+    
+    def _reattach_patient(self, smallchunk):
+        '''
+        `SmallChunk`s go through the queues with only the unique id of the patient (see `SmallChunk.__getstate__`).
+        This function maps the id back to the `Patient` of `self.dataset`.
+        '''
+        if(isinstance(smallchunk, SmallChunk)):
+            if(isinstance(smallchunk.patient, pydmed.utils.data.Patient) == False):
+                if(smallchunk.patient in self._dict_uniqueid_to_patient):
+                    smallchunk.patient = self._dict_uniqueid_to_patient[smallchunk.patient]
+    
     def get_list_loadedpatients(self):
         '''
         returns a list of Patient instances that are currently being loaded (one SmallChunkCollector is collecting SmallChunks from them)
@@ -693,7 +1027,8 @@ class LightDL(mp.Process):
         '''
         set_running_patients = set(self.get_list_loadedpatients())
         set_waiting_patients = set(self.dataset.list_patients).difference(
-                                        set_running_patients)
+                                        set_running_patients).difference(
+                                        set(self.get_list_finishedpatients()))
         return list(set_waiting_patients)
     
     
@@ -719,9 +1054,33 @@ class LightDL(mp.Process):
             - `list_initial_patients`: a list containing `Patients` who are initially loaded.
                         The length of the list must be equal to `self.const_global_info["num_bigchunkloaders"]`
         '''
-        #Default is to choose randomly from dataset.
-        return random.choices(self.dataset.list_patients,\
+        #Default is to choose randomly from dataset (except the finished patients).
+        list_candidates = self.get_list_initialcandidates()
+        if(len(list_candidates) == 0):
+            return [] #all patients are finished.
+        return random.choices(list_candidates,\
                               k=self.const_global_info["num_bigchunkloaders"])
+    
+    def get_list_initialcandidates(self):
+        '''
+        Returns the patients which can be selected by `initial_schedule`, i.e. the patients which are not finished 
+        (see `mark_patient_finished` and `resume_from_progressjournal`). 
+        The list is empty if all patients are finished, e.g. when a finished run is resumed.
+        '''
+        return [patient for patient in self.dataset.list_patients
+                if((patient in self.list_finishedpatients) == False)]
+    
+    def resume_from_progressjournal(self, progressjournal):
+        '''
+        Resumes a crashed run from a `pydmed.utils.output.ProgressJournal` (e.g., the journal of the `StreamWriter` of 
+        a `StreamCollector`). The patients which are finished in the journal are never scheduled.
+        It has to be called before the `LightDL` is started.
+        Subclasses which support resuming in the middle of a patient (e.g., `SlidingWindowDL`) override this function.
+        '''
+        for patient in self.dataset.list_patients:
+            if(progressjournal.is_finished(patient) == True):
+                if((patient in self.list_finishedpatients) == False):
+                    self.list_finishedpatients.append(patient)
         
     def schedule(self):
         '''
@@ -745,11 +1104,20 @@ class LightDL(mp.Process):
         #get initial fields ==============================
         list_loadedpatients = self.get_list_loadedpatients()
         list_waitingpatients = self.get_list_waitingpatients()
+        list_finishedpatients = self.get_list_finishedpatients()
         waitingpatients_schedcount = [self.get_schedcount_of(patient)\
                                       for patient in list_waitingpatients]
+        if(set(list_finishedpatients) == set(self.dataset.list_patients)):
+            return PYDMEDRESERVED_HALTDL, None
+        if(len(list_waitingpatients) == 0):
+            return None, None #do not reschedule
         
-        #patient_toremove is selected randomly =======================
-        patient_toremove = random.choice(list_loadedpatients)
+        #patient_toremove is selected randomly (with priority to the finished patients) =======================
+        list_loadedfinished = [patient for patient in list_loadedpatients if(patient in list_finishedpatients)]
+        if(len(list_loadedfinished) > 0):
+            patient_toremove = random.choice(list_loadedfinished)
+        else:
+            patient_toremove = random.choice(list_loadedpatients)
         
         #when choosing a patient to load, give huge weight to the instances which are not schedulled so far.
         weights = 1.0/(1.0+np.array(waitingpatients_schedcount))
@@ -783,8 +1151,7 @@ class LightDL(mp.Process):
                 # ~ idx_cores = [int(u) for u in self.const_global_info["core-assignment"]["lightdl"].split(",")]
                 # ~ p.cpu_affinity(idx_cores)
                 # ~ print("in lightdl, idx_cores={}".format(idx_cores))
-                os.system("taskset -a -cp {} {}".format(self.const_global_info["core-assignment"]["lightdl"], os.getpid()))
-                print(" taskset called for lightdl")
+                pydmed.utils.multiproc.set_cpuaffinity(self.const_global_info["core-assignment"]["lightdl"])
             #save pid of lightdl (to do recursive kill on finish)
             self._queue_pid_of_lightdl.put_nowait(os.getpid())
             #initially fill the pool of subprocesses ========
@@ -802,7 +1169,7 @@ class LightDL(mp.Process):
                                 )
                 else:
                     last_message_from_root = None
-                if(self._queue_messages_to_subprocs != None):
+                if(self.flag_enable_setgetcheckpoint == True):
                     old_checkpoint = self.dict_patient_to_checkpoint[patients_forinitialload[i]]
                     queue_checkpoint = self._dict_patient_to_queueckpoint[patients_forinitialload[i]]
                 else:
@@ -833,18 +1200,24 @@ class LightDL(mp.Process):
             print("The initial loading of bigchunks took {} seconds.".format(t2-t1))
             #patrol the subprocesses ======================
             time_lastresched = time.time() + 1*self.const_global_info["interval_resched"]
+            flag_readysignaled = False
             while(True):
+                if(self._event_stop.is_set() == True):
+                    break
                 # ~ print("============= lightdl-queue.qsize() = {} ===========".format(self.queue_lightdl.qsize()))
                 #collect patches from the subporcesses ============
-                while(self.queue_lightdl.qsize() >=\
-                      self.const_global_info["maxlength_queue_lightdl"]):
+                while((self.numinstances_queue_lightdl.value >=\
+                      self.const_global_info["maxlength_queue_lightdl"]) and (self._event_stop.is_set() == False)):
                     pass
                     #wait until queue_lightdl becomes less heavy.
                 for subproc in list(self.active_subprocesses):
                     if(subproc.queue_smallchunks.empty() == False):
                         try:
-                            smallchunk = subproc.queue_smallchunks.get_nowait()
-                            self.queue_lightdl.put_nowait(smallchunk)
+                            smallchunk = subproc.get_smallchunk_nowait()
+                            self._put_in_queuelightdl(smallchunk)
+                            if(flag_readysignaled == False):
+                                self._event_ready.set()
+                                flag_readysignaled = True
                             #print("lightdl placed smallchunk in queue")
                             #print("LightPatcher collected patches from WSI {}"\
                             #      .format(subproc.fname_wsi))
@@ -865,11 +1238,15 @@ class LightDL(mp.Process):
                                            # ~ set_running_patients)
                     # ~ list_waitingpatients = list(set_waiting_patiens)
                     # ~ print("reached before schedule")
+                    self._update_list_finishedpatients()
                     patient_toremove, patient_toadd = self.schedule()
                     if(isinstance(patient_toremove, str)):
                         if(patient_toremove == PYDMEDRESERVED_HALTDL):
+                            self._drain_subprocesses() #so no smallchunk is lost after the end-of-stream signal.
                             self._queue_message_lightdlfinished.put_nowait("DL-Finished")
-                            while(True): pass #the DL process has to be terminated by the parent process. LightDL._terminaterecursively(self.pid)
+                            self._event_ready.set()
+                            self._event_stop.wait() #the DL process is stopped by the parent process, see `pause_loading`.
+                            break
                             
                     
                     # ~ print("reached after schedule")
@@ -896,14 +1273,12 @@ class LightDL(mp.Process):
                         
                         #add the smallchunks of subproc_toremove to lightdl.queue ===============
                         if(self.flag_grabqueue_onunsched == True):
-                            size_queueof_subproctoremove = subproc_toremove.queue_smallchunks.qsize()
-                            for count in range(size_queueof_subproctoremove):
-                                try:
-                                    smallchunk = subproc_toremove.queue_smallchunks.get_nowait()
-                                    self.queue_lightdl.put_nowait(smallchunk)
-                                except Exception as e:
-                                    print("Warning: Some smallchunks may have lost. If not, you can safely ignore this warning.")
-                                    #print(str(e))
+                            if(self.get_flag_patientemitted(subproc_toremove) == True):
+                                #wait for all smallchunks, so `PatientEmitted` comes after them.
+                                self._grab_smallchunks_of(subproc_toremove, timeout=1.0)
+                                self._put_patientemitted_ifneeded(subproc_toremove)
+                            else:
+                                self._grab_smallchunks_of(subproc_toremove)
                                     
                         
                         #grab the last checkpoint of the subproc =======================
@@ -943,7 +1318,7 @@ class LightDL(mp.Process):
                                 )
                         else:
                             last_message_from_root = None
-                        if(self._queue_messages_to_subprocs != None):
+                        if(self.flag_enable_setgetcheckpoint == True):
                             old_checkpoint = self.dict_patient_to_checkpoint[patient_toadd]
                             queue_checkpoint = self._dict_patient_to_queueckpoint[patient_toadd]
                         else:
@@ -968,6 +1343,8 @@ class LightDL(mp.Process):
                         # ~ print("  reached here 10")
                         new_subproc.start()
                         # ~ print("  reached here 11")
+            #stop the subprocesses, and exit ====
+            self._stop_subprocesses()
         except Exception as e:
             '''
             prints a message stating that an exception has occurred, along with a string representation of the exception object.
@@ -9,12 +9,16 @@ import re
 import time
 import random
 import multiprocessing as mp
+import threading
+import queue
 import openslide
 from multiprocessing import Process, Queue
 from abc import ABC, abstractmethod
 import matplotlib.pyplot as plt
 import pydmed.utils.output
-from pydmed.utils.output import StreamWriter
+import pydmed.utils.multiproc
+from pydmed.utils.output import StreamWriter, ShardedStreamWriter, RasterWriter, StatSpiller
+from pydmed.utils.accumulator import PatientAccumulator
 
 
 class ProcessedPiece:
@@ -43,43 +47,153 @@ class ProcessedPiece:
          self.source_smallchunk.data = "None, to avoid memory leak"
 
 
+#placed in the queues of the pipelined mode of `StreamCollector`, to signal the end of the stream.
+_PIPELINE_END = "PYDMEDRESERVED_PIPELINE_END"
+
+
+def _put_untilaborted(queue_target, elem, event_abortpipeline):
+    '''
+    Places `elem` in a bounded queue of the pipelined mode. The queue is retried with a timeout,
+    so the threads do not block forever on a full queue after the pipeline is aborted.
+    Returns True if `elem` is placed, and False if `event_abortpipeline` is set before that.
+    '''
+    while(event_abortpipeline.is_set() == False):
+        try:
+            queue_target.put(elem, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _start_lightdl(lightdl, list_streamcollectors, cores_loading, cores_collecting, timeout_waitforready):
+    '''
+    Starts a `LightDL` and the writers of its `StreamCollector`s with the core layout of `StreamCollector.start_collecting`,
+    and waits until the `LightDL` is ready. Raises an exception if the `LightDL` process exits before it becomes ready.
+    '''
+    #set the affinity of the loading processes, they inherit it from the current process ====
+    if((cores_loading == "auto") or (cores_collecting == "auto")):
+        dict_corelayout = pydmed.utils.multiproc.get_auto_corelayout()
+        if(cores_loading == "auto"):
+            cores_loading = dict_corelayout["loading"]
+        if(cores_collecting == "auto"):
+            cores_collecting = dict_corelayout["collecting"]
+    if(cores_loading is not None):
+        pydmed.utils.multiproc.set_cpuaffinity(cores_loading)
+    lightdl.start()
+    for streamcollector in list_streamcollectors:
+        streamcollector._start_writers()
+    if(cores_collecting is not None):
+        pydmed.utils.multiproc.set_cpuaffinity(cores_collecting)
+    
+    #wait until the lightdl is ready ====
+    try:
+        flag_ready = lightdl.wait_until_ready(timeout_waitforready)
+    except Exception:
+        #the DL process has died in the start-up, stop the writers so they do not outlive the collection.
+        for streamcollector in list_streamcollectors:
+            if(streamcollector.str_collectortype.startswith("stream_to_file")):
+                streamcollector.streamwriter.flush_and_close()
+        raise
+    if(flag_ready == False):
+        print("Warning: `LightDL` did not become ready in {} seconds, collecting is started anyway.".format(timeout_waitforready))
+
+
 class StreamCollector(object):
-    def __init__(self, lightdl, str_collectortype, flag_visualizestats=False, kwargs_streamwriter=None):
+    def __init__(self, lightdl, str_collectortype, flag_visualizestats=False, kwargs_streamwriter=None,
+                 kwargs_rasterwriter=None, flag_pipelined=False, maxlength_pipelinequeue=4,
+                 kwargs_accumulator=None, kwargs_statspiller=None):
         '''
-        TODO:adddoc. str_collectortype can be "accum" or "saveall" or "stream_to_file"
+        TODO:adddoc. str_collectortype can be "accum" or "saveall" or "stream_to_file" or "stream_to_raster".
+        In "stream_to_raster" mode, `ProcessedPiece.stat` has to be a numpy array of shape [C x h x w], and 
+        it is written directly into a memory-mapped raster of the patient (see `pydmed.utils.output.RasterWriter`).
+        The arguments of `RasterWriter` are passed in by `kwargs_rasterwriter`.
+        In "stream_to_file" mode, the arguments of `StreamWriter` are passed in by `kwargs_streamwriter`.
+        If `kwargs_streamwriter` has the key "num_writers" (greater than 1), the outputs are written by that many
+        processes in parallel (see `pydmed.utils.output.ShardedStreamWriter`).
+        Once collecting is finished, `get_finalstats` returns a dictionary that maps each patient to the path of its raster.
+        If `flag_pipelined` is True, fetching from the `LightDL` (i.e. `lightdl.get`), `process_pieceofstream`, and 
+        `_manage_stats` run on three threads connected by queues of length `maxlength_pipelinequeue`, 
+        so loading, computation, and writing overlap. `_manage_stats` and `get_flag_finishcollecting` are always called 
+        from the thread that calls `start_collecting`.
+        In "accum" mode, if `kwargs_accumulator` is not None, `accum_statistics` is not called. Instead, the stats 
+        (numbers or numpy arrays) of each batch are added to a `pydmed.utils.accumulator.PatientAccumulator` at once, 
+        whose arguments are passed in by `kwargs_accumulator` (e.g., {"dim_stat":2, "list_bins":np.linspace(0,1,11)}).
+        Then `get_finalstats` returns a dictionary that maps each patient to its statistics (see `PatientAccumulator.get_stats`).
+        In "saveall" mode, if `kwargs_statspiller` is not None, the stats (numpy arrays of the same shape for each patient) 
+        are spilled to disk by a `pydmed.utils.output.StatSpiller` (e.g., {"rootpath":"./stats/", "maxbytes_inmemory":2**30}),
+        and `collate_stats_onfinishcollecting` receives a `pydmed.utils.output.LazyStats` instead of a list.
+        In "stream_to_file" mode, if `kwargs_streamwriter` has the key "fname_journal", the progress of the run is journaled
+        (see `pydmed.utils.output.ProgressJournal`), and when the journal exists the run is resumed from it, 
+        i.e. the finished patients are skipped and the other patients continue from their last fully written row.
+        A patient can be finished before the others by overriding `get_flag_finishcollecting_of`. Then the stats of the patient 
+        are finalized (collated, or written and closed) and freed right away, `on_patient_finished` is called, and 
+        the `LightDL` stops scheduling the patient.
         '''
         #grab initargs
         self.lightdl = lightdl
         self.str_collectortype = str_collectortype
         self.flag_visualizestats = flag_visualizestats
         self.kwargs_streamwriter = kwargs_streamwriter
+        self.kwargs_rasterwriter = kwargs_rasterwriter
+        self.flag_pipelined = flag_pipelined
+        self.maxlength_pipelinequeue = maxlength_pipelinequeue
+        self.kwargs_accumulator = kwargs_accumulator
+        self.kwargs_statspiller = kwargs_statspiller
         #make internals
         self.dict_patient_to_liststats = {patient:[] for patient in self.lightdl.dataset.list_patients}
         self.dict_patient_to_accumstat = {patient:None for patient in self.lightdl.dataset.list_patients}
         self._queue_onfinish_collectedstats = mp.Queue()
+        self._dict_patient_to_finalstat = {} #the final stats of the patients which are finished early.
+        self._fanoutcollector = None #set when the collector is a consumer of a `FanOutCollector`.
         if(self.str_collectortype.startswith("stream_to_file")):
-            self.streamwriter = StreamWriter(lightdl.dataset.list_patients, **kwargs_streamwriter)
+            kwargs_streamwriter = dict(kwargs_streamwriter)
+            num_writers = kwargs_streamwriter.pop("num_writers", 1)
+            if(num_writers > 1):
+                self.streamwriter = ShardedStreamWriter(lightdl.dataset.list_patients,
+                                                        num_writers=num_writers, **kwargs_streamwriter)
+            else:
+                self.streamwriter = StreamWriter(lightdl.dataset.list_patients, **kwargs_streamwriter)
+            #resume a crashed run if the journal of the streamwriter exists ====
+            progressjournal = self.streamwriter.get_progressjournal()
+            if(progressjournal is not None):
+                self.lightdl.resume_from_progressjournal(progressjournal)
+                for patient in self.lightdl.dataset.list_patients:
+                    if(progressjournal.is_finished(patient) == True):
+                        self._dict_patient_to_finalstat[patient] = None
+        if(self.str_collectortype == "stream_to_raster"):
+            self.rasterwriter = RasterWriter(**kwargs_rasterwriter)
+        self.accumulator = None
+        if((self.str_collectortype == "accum") and (kwargs_accumulator is not None)):
+            self.accumulator = PatientAccumulator(lightdl.dataset.list_patients, **kwargs_accumulator)
+        self.statspiller = None
+        if((self.str_collectortype == "saveall") and (kwargs_statspiller is not None)):
+            self.statspiller = StatSpiller(**kwargs_statspiller)
         
         
     
-    def start_collecting(self):
-        
-        
-        #make the following line tunable
-        os.system("taskset -a -cp {} {}".format("0,1,2,3,4", os.getpid()))
-        self.lightdl.start()
-        if(self.str_collectortype.startswith("stream_to_file")):
-            self.streamwriter.start()
-            # ~ print(" statcollector.streamwriter started ")
-        
-        
-        #TODO:make the following lines tunable.
-        time.sleep(1*10)
-        os.system("taskset -cp {} {}".format("5,6,7", os.getpid()))
-        time.sleep(1*10)
-        
-        time.sleep(2) #TODO:remove
-        time_lastcheck = time.time()+2 #TODO:make tunable
+    def start_collecting(self, cores_loading="auto", cores_collecting="auto", timeout_waitforready=None):
+        '''
+        Starts the `LightDL` (and the `StreamWriter`, if any), and collects the stream until `get_flag_finishcollecting` returns True.
+        Inputs.
+            - cores_loading: the cores of the `LightDL` and its subprocesses, either a list of integers or a string like "0,1,2,3,4".
+                If "auto" (default), the layout is made by `pydmed.utils.multiproc.get_auto_corelayout` based on the available cores.
+                If None, the cpu affinity is not changed.
+            - cores_collecting: the cores of the current (i.e. collecting) process, similar to `cores_loading`.
+            - timeout_waitforready: collecting starts as soon as the `LightDL` places its first smallchunks in its queue.
+                This argument is the maximum waiting time (in seconds) for that. If None, there is no time limit.
+                In both cases, an exception is raised if the `LightDL` process exits before it becomes ready.
+        If all patients are already finished (e.g., when a finished run is resumed), collecting is finished without starting the `LightDL`.
+        '''
+        if(len(self.lightdl.get_list_initialcandidates()) == 0):
+            self._start_writers()
+            self._finalize_collecting()
+            return
+        _start_lightdl(self.lightdl, [self], cores_loading, cores_collecting, timeout_waitforready)
+        if(self.flag_pipelined == True):
+            self._collect_pipelined()
+            return
+        time_lastcheck = time.time()
         time_lastupdate_visstats = time.time()+5 #TODO:make tunable
         count = 0
         #plot the visstats if needed,
@@ -98,6 +212,7 @@ class StreamCollector(object):
             
             #get an instance from the DL ============
             retval_dl = self.lightdl.get()
+            list_emittedpatients = self.lightdl.pop_list_emittedpatients()
             flag_invalid_retvaldl = False
             if(isinstance(retval_dl, str)):
                 if(retval_dl == pydmed.lightdl.PYDMEDRESERVED_DLRETURNEDLASTINSTANCE):
@@ -105,34 +220,239 @@ class StreamCollector(object):
             
             #collect stat only if the retval is valid =====
             if(flag_invalid_retvaldl == False):
-                list_collectedstats = self.process_pieceofstream(retval_dl)
-                list_patients = [st.source_smallchunk.patient for st in list_collectedstats]
-                self._manage_stats(list_collectedstats, list_patients)
+                self._collect_retvaldl(retval_dl)
+            self._on_patients_emitted(list_emittedpatients)
             
             
-            #stop collecting if needed ======
-            if((time.time()-time_lastcheck) > 5):#TODO:make tunable
+            #stop collecting if needed (right away, when the DL has returned its last instance) ======
+            if(self._get_flag_allpatientsfinished() == True):
+                self._finish_collecting()
+                break
+            if((flag_invalid_retvaldl == True) or ((time.time()-time_lastcheck) > 5)):#TODO:make tunable
                 time_lastcheck = time.time()
                 if(self.get_flag_finishcollecting() == True):
-                    toret_onfinish_collectedstats = {}
-                    #colllate all statistics
-                    if(self.str_collectortype == "saveall"):
-                        for patient in self.lightdl.dataset.list_patients:
-                            toret_onfinish_collectedstats[patient] = self.collate_stats_onfinishcollecting(patient, self.dict_patient_to_liststats[patient])
-                    elif(self.str_collectortype == "accum"):
-                        for patient in self.lightdl.dataset.list_patients:
-                            toret_onfinish_collectedstats[patient] = \
-                                    self.dict_patient_to_accumstat[patient]
-                    elif(self.str_collectortype.startswith("stream_to_file")):
-                        self.streamwriter.flush_and_close()
-                            
-                    self._onfinish_collectedstats = toret_onfinish_collectedstats
-                    if(self.str_collectortype.startswith("stream_to_file") == False):
-                        pass #self._queue_onfinish_collectedstats.put_nowait(toret_onfinish_collectedstats)
-                    time.sleep(3) #TODO:make tunable
-                    #stop the lightdl
-                    self.lightdl.pause_loading()
+                    self._finish_collecting()
                     break
+                if(flag_invalid_retvaldl == True):
+                    time.sleep(0.1) #the DL is finished, wait for `get_flag_finishcollecting`.
+    
+    def _start_writers(self):
+        if(self.str_collectortype.startswith("stream_to_file")):
+            self.streamwriter.start()
+    
+    def _collect_retvaldl(self, retval_dl):
+        '''
+        Processes an instance returned by `lightdl.get` (see `process_pieceofstream`) and manages its stats.
+        '''
+        list_collectedstats = self.process_pieceofstream(retval_dl)
+        list_patients = [st.source_smallchunk.patient for st in list_collectedstats]
+        self._manage_stats(list_collectedstats, list_patients)
+    
+    def _on_patients_emitted(self, list_emittedpatients):
+        '''
+        Is called after the outputs of the patients in `list_emittedpatients` are managed, where all tiles of these patients
+        are returned by the `LightDL` (see `pydmed.lightdl.LightDL.pop_list_emittedpatients`).
+        In "stream_to_file" mode, the patients are saved as finished in the journal of the streamwriter (if any).
+        '''
+        if(self.str_collectortype.startswith("stream_to_file") == False):
+            return
+        for patient in list_emittedpatients:
+            if(patient in self._dict_patient_to_finalstat):
+                continue #already finished by `get_flag_finishcollecting_of`.
+            self.streamwriter.mark_patient_finished(patient)
+    
+    def _finish_collecting(self):
+        '''
+        Collates the collected statistics (or closes the writers), and stops the `LightDL`.
+        '''
+        self._finalize_collecting()
+        #stop the lightdl
+        self.lightdl.pause_loading()
+    
+    def _finalize_collecting(self):
+        '''
+        Collates the collected statistics (or closes the writers), without stopping the `LightDL`.
+        '''
+        toret_onfinish_collectedstats = {}
+        #colllate all statistics (the patients which are finished early are already collated)
+        if(self.str_collectortype in ["saveall", "accum"]):
+            for patient in self.lightdl.dataset.list_patients:
+                if(patient in self._dict_patient_to_finalstat):
+                    toret_onfinish_collectedstats[patient] = self._dict_patient_to_finalstat[patient]
+                else:
+                    toret_onfinish_collectedstats[patient] = self._finalize_patient(patient)
+        elif(self.str_collectortype.startswith("stream_to_file")):
+            self.streamwriter.flush_and_close()
+        elif(self.str_collectortype == "stream_to_raster"):
+            toret_onfinish_collectedstats = {patient:fname for patient, fname in self._dict_patient_to_finalstat.items()
+                                             if(fname is not None)}
+            toret_onfinish_collectedstats.update(self.rasterwriter.flush_and_close())
+                
+        self._onfinish_collectedstats = toret_onfinish_collectedstats
+        if(self.str_collectortype.startswith("stream_to_file") == False):
+            pass #self._queue_onfinish_collectedstats.put_nowait(toret_onfinish_collectedstats)
+    
+    def _get_flag_allpatientsfinished(self):
+        '''
+        Returns True if all patients are finished early (see `get_flag_finishcollecting_of`).
+        '''
+        return len(self._dict_patient_to_finalstat) == len(self.lightdl.dataset.list_patients)
+    
+    def _finalize_patient(self, patient):
+        '''
+        Collates the stats of a patient (or closes its raster, or marks it finished in the streamwriter), 
+        frees what is kept in memory for the patient, and returns the final stat of the patient (None in "stream_to_file" mode).
+        '''
+        toret = None
+        if(self.str_collectortype == "saveall"):
+            if(self.statspiller is not None):
+                list_collectedstats = self.statspiller.get_lazystats(patient)
+            else:
+                list_collectedstats = self.dict_patient_to_liststats[patient]
+            toret = self.collate_stats_onfinishcollecting(patient, list_collectedstats)
+            self.dict_patient_to_liststats[patient] = []
+        elif(self.str_collectortype == "accum"):
+            if(self.accumulator is not None):
+                toret = self.accumulator.get_stats(patient)
+            else:
+                toret = self.dict_patient_to_accumstat[patient]
+                self.dict_patient_to_accumstat[patient] = None
+        elif(self.str_collectortype.startswith("stream_to_file")):
+            self.streamwriter.mark_patient_finished(patient)
+        elif(self.str_collectortype == "stream_to_raster"):
+            toret = self.rasterwriter.flush_and_close_patient(patient)
+        return toret
+    
+    def _finish_patient(self, patient):
+        '''
+        Finishes a patient for which `get_flag_finishcollecting_of` has returned True.
+        The patient is finalized (see `_finalize_patient`), the `LightDL` is told to stop scheduling the patient,
+        and `on_patient_finished` is called. The stats of the patient which arrive afterwards are ignored.
+        '''
+        finalstat = self._finalize_patient(patient)
+        self._dict_patient_to_finalstat[patient] = finalstat
+        if(self._fanoutcollector is None):
+            self.lightdl.mark_patient_finished(patient)
+        else:
+            self._fanoutcollector._on_patient_finished_inconsumer(patient)
+        self.on_patient_finished(patient, finalstat)
+    
+    def _collect_pipelined(self):
+        '''
+        The pipelined version of the collecting loop of `start_collecting`.
+        Two threads fetch from the `LightDL` and run `process_pieceofstream`, and the current thread runs `_manage_stats`.
+        When `get_flag_finishcollecting` returns True, fetching is stopped, and the pieces which are already fetched 
+        are processed and managed before finishing.
+        '''
+        event_stopfetching = threading.Event()
+        event_endofstream = threading.Event() #set when the DL has returned its last instance.
+        event_abortpipeline = threading.Event() #set when the current thread fails, so the threads exit.
+        queue_fetched = queue.Queue(maxsize=self.maxlength_pipelinequeue)
+        queue_computed = queue.Queue(maxsize=self.maxlength_pipelinequeue)
+        list_exceptions = []
+        thread_fetch = threading.Thread(target=self._pipeline_fetch,
+                                        args=(queue_fetched, event_stopfetching, list_exceptions, event_endofstream,
+                                              event_abortpipeline), daemon=True)
+        thread_compute = threading.Thread(target=self._pipeline_compute,
+                                          args=(queue_fetched, queue_computed, list_exceptions, event_abortpipeline), daemon=True)
+        thread_fetch.start()
+        thread_compute.start()
+        time_lastcheck = time.time()
+        flag_mainloopfinished = False
+        try:
+            while True:
+                try:
+                    elem = queue_computed.get(timeout=0.5)
+                except queue.Empty:
+                    elem = None
+                if(isinstance(elem, str)):
+                    if(elem == _PIPELINE_END):
+                        break
+                if(elem is not None):
+                    list_collectedstats, list_patients, list_emittedpatients = elem
+                    self._manage_stats(list_collectedstats, list_patients)
+                    self._on_patients_emitted(list_emittedpatients)
+                #stop fetching if needed ======
+                if(event_stopfetching.is_set() == False):
+                    if(len(list_exceptions) > 0):
+                        event_stopfetching.set()
+                    elif(self._get_flag_allpatientsfinished() == True):
+                        event_stopfetching.set()
+                    elif((event_endofstream.is_set() == True) or ((time.time()-time_lastcheck) > 5)):#TODO:make tunable
+                        time_lastcheck = time.time()
+                        if(self.get_flag_finishcollecting() == True):
+                            event_stopfetching.set()
+            flag_mainloopfinished = True
+        finally:
+            if(flag_mainloopfinished == False):
+                #the current thread has failed (e.g., in `_manage_stats`), stop the threads and unblock their queues ====
+                event_abortpipeline.set()
+                event_stopfetching.set()
+                for queue_internal in [queue_fetched, queue_computed]:
+                    while True:
+                        try:
+                            queue_internal.get_nowait()
+                        except queue.Empty:
+                            break
+                self.lightdl.pause_loading()
+        thread_fetch.join()
+        thread_compute.join()
+        if(len(list_exceptions) > 0):
+            self.lightdl.pause_loading()
+            raise list_exceptions[0]
+        self._finish_collecting()
+    
+    def _pipeline_fetch(self, queue_fetched, event_stopfetching, list_exceptions, event_endofstream, event_abortpipeline):
+        '''
+        The fetching thread of the pipelined mode. It exits when `event_stopfetching` is set, 
+        or as soon as `event_abortpipeline` is set while it waits on the full `queue_fetched`.
+        '''
+        try:
+            while(event_stopfetching.is_set() == False):
+                retval_dl = self.lightdl.get()
+                list_emittedpatients = self.lightdl.pop_list_emittedpatients()
+                if(isinstance(retval_dl, str)):
+                    if(retval_dl == pydmed.lightdl.PYDMEDRESERVED_DLRETURNEDLASTINSTANCE):
+                        if(len(list_emittedpatients) > 0):
+                            _put_untilaborted(queue_fetched, (None, list_emittedpatients), event_abortpipeline)
+                        event_endofstream.set()
+                        time.sleep(0.1) #the DL is finished, wait for `get_flag_finishcollecting`.
+                        continue
+                if(_put_untilaborted(queue_fetched, (retval_dl, list_emittedpatients), event_abortpipeline) == False):
+                    break
+        except Exception as exception:
+            list_exceptions.append(exception)
+        finally:
+            _put_untilaborted(queue_fetched, _PIPELINE_END, event_abortpipeline)
+    
+    def _pipeline_compute(self, queue_fetched, queue_computed, list_exceptions, event_abortpipeline):
+        '''
+        The computing thread of the pipelined mode. After a failure, it keeps emptying `queue_fetched`
+        so the fetching thread is never blocked. It exits as soon as `event_abortpipeline` is set.
+        '''
+        flag_failed = False
+        while(event_abortpipeline.is_set() == False):
+            try:
+                retval_dl = queue_fetched.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if(isinstance(retval_dl, str)):
+                if(retval_dl == _PIPELINE_END):
+                    break
+            if(flag_failed == True):
+                continue
+            retval_dl, list_emittedpatients = retval_dl
+            try:
+                if(retval_dl is None):
+                    list_collectedstats = [] #only some patients are emitted.
+                else:
+                    list_collectedstats = self.process_pieceofstream(retval_dl)
+                list_patients = [st.source_smallchunk.patient for st in list_collectedstats]
+                _put_untilaborted(queue_computed, (list_collectedstats, list_patients, list_emittedpatients), event_abortpipeline)
+            except Exception as exception:
+                list_exceptions.append(exception)
+                flag_failed = True
+        _put_untilaborted(queue_computed, _PIPELINE_END, event_abortpipeline)
     
     def get_finalstats(self):
         try:
@@ -145,16 +465,61 @@ class StreamCollector(object):
             print("Error in getting the final collected stats. Is the StreamCollector finished when you called `StreamCollector.get_finalstats`?")
 
     def _manage_stats(self, list_collectedstats, list_patients):
+        if(len(self._dict_patient_to_finalstat) > 0):
+            #drop the stats of the patients which are already finished ====
+            list_idxtokeep = [n for n in range(len(list_patients))
+                              if(list_patients[n] not in self._dict_patient_to_finalstat)]
+            list_collectedstats = [list_collectedstats[n] for n in list_idxtokeep]
+            list_patients = [list_patients[n] for n in list_idxtokeep]
+        self._manage_stats_ofbatch(list_collectedstats, list_patients)
+        #finish the patients which are done ====
+        for patient in list(dict.fromkeys(list_patients)):
+            if(self.get_flag_finishcollecting_of(patient) == True):
+                self._finish_patient(patient)
+    
+    def _manage_stats_ofbatch(self, list_collectedstats, list_patients):
+        if(self.accumulator is not None):
+            #add the whole batch to the accumulator at once ====
+            if(len(list_patients) > 0):
+                self.accumulator.update(
+                        self.accumulator.get_idx_of_patients(list_patients),
+                        np.stack([np.asarray(st.stat, dtype=np.float64).reshape(-1) for st in list_collectedstats])
+                    )
+            return
         for n in range(len(list_patients)):
             patient = list_patients[n]
             if(self.str_collectortype == "saveall"):
-                self.dict_patient_to_liststats[patient].append(list_collectedstats[n])
+                if(self.statspiller is not None):
+                    self.statspiller.append(patient, list_collectedstats[n].stat, list_collectedstats[n].source_smallchunk)
+                else:
+                    self.dict_patient_to_liststats[patient].append(list_collectedstats[n])
             elif(self.str_collectortype == "accum"):
                 self.dict_patient_to_accumstat[patient] = self.accum_statistics(self.dict_patient_to_accumstat[patient],
                                                                                 list_collectedstats[n],
                                                                                 patient)
             elif(self.str_collectortype.startswith("stream_to_file")):
-                self.streamwriter.write(patient, list_collectedstats[n].stat)
+                dict_info_of_bigchunk = list_collectedstats[n].source_smallchunk.dict_info_of_bigchunk
+                idx_row = dict_info_of_bigchunk.get("idx_bigrow", None)
+                self.streamwriter.write(patient, list_collectedstats[n].stat, idx_row)
+            elif(self.str_collectortype == "stream_to_raster"):
+                self._write_to_raster(patient, list_collectedstats[n])
+    
+    def _write_to_raster(self, patient, processedpiece):
+        '''
+        Writes a `ProcessedPiece` into the raster of the patient.
+        The position of the tile is read from its source `SmallChunk`.
+        '''
+        smallchunk = processedpiece.source_smallchunk
+        dict_info_of_bigchunk = smallchunk.dict_info_of_bigchunk
+        dict_info_of_smallchunk = smallchunk.dict_info_of_smallchunk
+        self.rasterwriter.write(
+                patient, np.asarray(processedpiece.stat),
+                x = dict_info_of_bigchunk.get("x", 0) + dict_info_of_smallchunk["x"],
+                y = dict_info_of_bigchunk.get("y", 0) + dict_info_of_smallchunk.get("y", 0),
+                kernel_size = dict_info_of_smallchunk["kernel_size"],
+                WSI_W = dict_info_of_bigchunk["WSI_W"],
+                WSI_H = dict_info_of_bigchunk["WSI_H"]
+            )
                 
     
     
@@ -189,7 +554,29 @@ class StreamCollector(object):
         
     
     @abstractmethod
-    def get_flag_finishcollecting(self): #TODO: make this method patient-wise, so that user would not need to work with self.dict_patient_to_liststats
+    def get_flag_finishcollecting(self): #see `get_flag_finishcollecting_of` for the patient-wise counterpart.
+        pass
+    
+    def get_flag_finishcollecting_of(self, patient):
+        '''
+        The patient-wise counterpart of `get_flag_finishcollecting`. 
+        After the stats of each batch are managed, it is called for the patients in the batch.
+        If it returns True, the patient is finished right away, i.e. its stats are collated and freed, 
+        `on_patient_finished` is called, and the `LightDL` stops scheduling the patient.
+        By default returns False, i.e. the patients are finished only when `get_flag_finishcollecting` returns True.
+        Inputs.
+            - patient: the patient, an instance of utils.data.Patient.
+        '''
+        return False
+    
+    def on_patient_finished(self, patient, finalstat):
+        '''
+        Is called when a patient is finished before the others (see `get_flag_finishcollecting_of`). 
+        Override it to, e.g., start the downstream processing of the patient.
+        Inputs.
+            - patient: the patient, an instance of utils.data.Patient.
+            - finalstat: the final stat of the patient, i.e. the same as what `get_finalstats` returns for the patient.
+        '''
         pass
         
     @abstractmethod
@@ -205,5 +592,127 @@ class StreamCollector(object):
     
 
 
+class FanOutCollector(object):
+    def __init__(self, lightdl, list_streamcollectors):
+        '''
+        Feeds one `LightDL` to several `StreamCollector`s (e.g., one per model), so each image is read and decoded once.
+        Each instance returned by `lightdl.get` is passed, as the same object (i.e. without copying), 
+        to the `process_pieceofstream` of all collectors one after another. 
+        So `process_pieceofstream` must not modify its input in place.
+        Each collector keeps its own type (e.g., "accum" or "stream_to_file") and outputs, and is finished on its own 
+        when its `get_flag_finishcollecting` returns True (or when all its patients are finished early, 
+        see `StreamCollector.get_flag_finishcollecting_of`). Afterwards, it is not fed anymore.
+        The `LightDL` stops scheduling a patient when all active collectors have finished the patient
+        (a collector which is finished counts as having finished all patients), and it is stopped when all collectors are finished.
+        As the `LightDL` is shared, a crashed run can be resumed (see the argument `fname_journal` of `pydmed.utils.output.StreamWriter`)
+        only if all collectors are "stream_to_file" collectors with journals, and all journals have the same progress.
+        Inputs.
+            - lightdl: the `LightDL`.
+            - list_streamcollectors: a list of `StreamCollector`s, all created with `lightdl`. 
+                Their argument `flag_pipelined` is ignored.
+        '''
+        for streamcollector in list_streamcollectors:
+            if(streamcollector.lightdl is not lightdl):
+                raise Exception("All `StreamCollector`s of a `FanOutCollector` must be created with the same `LightDL`.")
+        #check that either no collector is resumed, or all collectors are resumed from the same progress ====
+        list_journals = [streamcollector.streamwriter.get_progressjournal()
+                         if(streamcollector.str_collectortype.startswith("stream_to_file")) else None
+                         for streamcollector in list_streamcollectors]
+        flag_resuming = False
+        for progressjournal in list_journals:
+            if(progressjournal is not None):
+                if(len(progressjournal.dict_uniqueid_to_progress) > 0):
+                    flag_resuming = True
+        if(flag_resuming == True):
+            for progressjournal in list_journals:
+                if((progressjournal is None) or
+                   (progressjournal.dict_uniqueid_to_progress != list_journals[0].dict_uniqueid_to_progress)):
+                    raise Exception("A collector of the `FanOutCollector` is resumed from a journal, but the `LightDL` is shared."+\
+                                    " Resuming is only supported when all collectors are resumed from journals with the same progress.")
+        #grab privates ====
+        self.lightdl = lightdl
+        self.list_streamcollectors = list_streamcollectors
+        self._list_activecollectors = list(list_streamcollectors)
+        self._list_releasedpatients = [] #the patients which are marked as finished in the `LightDL`.
+        for streamcollector in list_streamcollectors:
+            streamcollector._fanoutcollector = self
+    
+    def start_collecting(self, cores_loading="auto", cores_collecting="auto", timeout_waitforready=None):
+        '''
+        Starts the `LightDL` (and the writers of the collectors), and collects the stream until all collectors are finished.
+        The arguments are the same as `StreamCollector.start_collecting`.
+        If all patients are already finished (e.g., when a finished run is resumed), the collectors are finished without starting the `LightDL`.
+        '''
+        if(len(self.lightdl.get_list_initialcandidates()) == 0):
+            for streamcollector in list(self._list_activecollectors):
+                streamcollector._start_writers()
+                streamcollector._finalize_collecting()
+                self._list_activecollectors.remove(streamcollector)
+            return
+        _start_lightdl(self.lightdl, self.list_streamcollectors, cores_loading, cores_collecting, timeout_waitforready)
+        list_activecollectors = self._list_activecollectors
+        time_lastcheck = time.time()
+        while True:
+            #get an instance from the DL, and pass it to the active collectors ============
+            retval_dl = self.lightdl.get()
+            list_emittedpatients = self.lightdl.pop_list_emittedpatients()
+            flag_invalid_retvaldl = False
+            if(isinstance(retval_dl, str)):
+                if(retval_dl == pydmed.lightdl.PYDMEDRESERVED_DLRETURNEDLASTINSTANCE):
+                    flag_invalid_retvaldl = True
+            if(flag_invalid_retvaldl == False):
+                for streamcollector in list_activecollectors:
+                    streamcollector._collect_retvaldl(retval_dl)
+            for streamcollector in list_activecollectors:
+                streamcollector._on_patients_emitted(list_emittedpatients)
+            
+            #finish the collectors if needed (right away, when the DL has returned its last instance) ======
+            flag_checkfinish = (flag_invalid_retvaldl == True) or ((time.time()-time_lastcheck) > 5) #TODO:make tunable
+            if(flag_checkfinish == True):
+                time_lastcheck = time.time()
+            for streamcollector in list(list_activecollectors):
+                if((streamcollector._get_flag_allpatientsfinished() == True) or
+                   ((flag_checkfinish == True) and (streamcollector.get_flag_finishcollecting() == True))):
+                    streamcollector._finalize_collecting()
+                    list_activecollectors.remove(streamcollector)
+                    self._release_finishedpatients()
+            if(len(list_activecollectors) == 0):
+                self.lightdl.pause_loading()
+                break
+            if(flag_invalid_retvaldl == True):
+                time.sleep(0.1) #the DL is finished, wait for `get_flag_finishcollecting`.
+    
+    def _on_patient_finished_inconsumer(self, patient):
+        '''
+        Is called when a collector finishes a patient, and tells the `LightDL` to stop scheduling the patient
+        if all active collectors have finished it.
+        '''
+        if(patient in self._list_releasedpatients):
+            return
+        for streamcollector in self._list_activecollectors:
+            if((patient in streamcollector._dict_patient_to_finalstat) == False):
+                return
+        self._list_releasedpatients.append(patient)
+        self.lightdl.mark_patient_finished(patient)
+    
+    def _release_finishedpatients(self):
+        '''
+        Is called when a collector is finished. The patients which are finished by all remaining active collectors
+        are marked as finished in the `LightDL`.
+        '''
+        if(len(self._list_activecollectors) == 0):
+            return
+        for patient in self.lightdl.dataset.list_patients:
+            if(patient in self._list_activecollectors[0]._dict_patient_to_finalstat):
+                self._on_patient_finished_inconsumer(patient)
+    
+    def get_finalstats(self):
+        '''
+        Returns the list of final stats of the collectors (see `StreamCollector.get_finalstats`), in the order of `list_streamcollectors`.
+        '''
+        return [streamcollector.get_finalstats() for streamcollector in self.list_streamcollectors]
+
+
+
 StatCollector = StreamCollector #to support previous versions.
 Statistic = ProcessedPiece #to support previous versions.
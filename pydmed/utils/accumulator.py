@@ -0,0 +1,109 @@
+
+'''
+Vectorized per-patient accumulators, used by the "accum" mode of `StreamCollector`.
+'''
+
+import numpy as np
+
+
+
+class PatientAccumulator(object):
+    def __init__(self, list_patients, dim_stat=1, list_bins=None):
+        '''
+        Keeps running statistics of vector-valued stats for each patient in preallocated numpy arrays,
+        where the row of each patient is decided by its order in `list_patients`.
+        A whole batch of stats is added by `update`, with one scatter operation per statistic.
+        The kept statistics are: count, sum, mean and variance (by the parallel version of Welford's algorithm),
+        min, max, and (optionally) histograms.
+        Inputs.
+            - list_patients: the list of patients.
+            - dim_stat: the length of each stat, an integer. Each stat is flattened to a vector of this length.
+            - list_bins: the edges of the bins of the histograms, a 1D list or numpy array of length B+1.
+                The values outside the range of the bins are counted in the first or the last bin.
+                If None (default), no histogram is kept.
+        '''
+        #grab privates ====
+        self.list_patients = list_patients
+        self.dim_stat = dim_stat
+        self.np_bins = None if(list_bins is None) else np.asarray(list_bins, dtype=np.float64)
+        #make internals ====
+        self._dict_uniqueid_to_idx = {patient.int_uniqueid:idx for idx, patient in enumerate(list_patients)}
+        num_patients = len(list_patients)
+        self.np_count = np.zeros(num_patients, dtype=np.int64)
+        self.np_sum = np.zeros((num_patients, dim_stat), dtype=np.float64)
+        self.np_mean = np.zeros((num_patients, dim_stat), dtype=np.float64)
+        self.np_m2 = np.zeros((num_patients, dim_stat), dtype=np.float64) #sum of squared deviations from the mean.
+        self.np_min = np.full((num_patients, dim_stat), np.inf)
+        self.np_max = np.full((num_patients, dim_stat), -np.inf)
+        if(self.np_bins is not None):
+            self.np_hist = np.zeros((num_patients, dim_stat, self.np_bins.shape[0]-1), dtype=np.int64)
+        else:
+            self.np_hist = None
+
+    def get_idx_of_patients(self, list_patients):
+        '''
+        Returns the rows of a list of patients, as a numpy array of integers.
+        '''
+        return np.array([self._dict_uniqueid_to_idx[patient.int_uniqueid] for patient in list_patients], dtype=np.int64)
+
+    def update(self, np_idxpatient, np_stats):
+        '''
+        Adds a batch of stats.
+        Inputs.
+            - np_idxpatient: the rows of the patients of the stats (see `get_idx_of_patients`), a numpy array of length N.
+            - np_stats: the stats, a numpy array of shape [N x dim_stat].
+        '''
+        np_idxpatient = np.asarray(np_idxpatient, dtype=np.int64)
+        np_stats = np.asarray(np_stats, dtype=np.float64).reshape(np_idxpatient.shape[0], self.dim_stat)
+        if(np_idxpatient.shape[0] == 0):
+            return
+        #the rows of the patients in the batch ====
+        np_rows, np_idxinbatch = np.unique(np_idxpatient, return_inverse=True)
+        np_idxinbatch = np_idxinbatch.reshape(-1)
+        num_rows = np_rows.shape[0]
+        #count, sum, min, max ====
+        np_countbatch = np.bincount(np_idxinbatch, minlength=num_rows)
+        np_sumbatch = np.zeros((num_rows, self.dim_stat))
+        np.add.at(np_sumbatch, np_idxinbatch, np_stats)
+        np.minimum.at(self.np_min, np_idxpatient, np_stats)
+        np.maximum.at(self.np_max, np_idxpatient, np_stats)
+        #mean and variance, by merging the batch into the running values (Chan et al.) ====
+        np_meanbatch = np_sumbatch / np_countbatch[:, None]
+        np_m2batch = np.zeros((num_rows, self.dim_stat))
+        np.add.at(np_m2batch, np_idxinbatch, (np_stats - np_meanbatch[np_idxinbatch])**2)
+        np_countold = self.np_count[np_rows]
+        np_countnew = np_countold + np_countbatch
+        np_delta = np_meanbatch - self.np_mean[np_rows]
+        np_ratio = np_countbatch / np_countnew
+        self.np_mean[np_rows] += np_delta * np_ratio[:, None]
+        self.np_m2[np_rows] += np_m2batch + (np_delta**2) * (np_countold * np_ratio)[:, None]
+        self.np_count[np_rows] = np_countnew
+        self.np_sum[np_rows] += np_sumbatch
+        #histograms ====
+        if(self.np_hist is not None):
+            num_bins = self.np_hist.shape[2]
+            np_idxbin = np.clip(np.searchsorted(self.np_bins, np_stats, side="right")-1, 0, num_bins-1)
+            np_idxdim = np.broadcast_to(np.arange(self.dim_stat)[None, :], np_stats.shape)
+            np.add.at(self.np_hist,
+                      (np.broadcast_to(np_idxpatient[:, None], np_stats.shape), np_idxdim, np_idxbin), 1)
+
+    def get_stats(self, patient):
+        '''
+        Returns the statistics of a patient as a dictionary with the keys
+        "count", "sum", "mean", "var", "min", "max", and "hist" (if `list_bins` is not None).
+        For a patient without any stat, "mean", "var", "min", and "max" are nan.
+        '''
+        idx = self._dict_uniqueid_to_idx[patient.int_uniqueid]
+        count = int(self.np_count[idx])
+        toret = {"count":count, "sum":self.np_sum[idx].copy()}
+        if(count > 0):
+            toret["mean"] = self.np_mean[idx].copy()
+            toret["var"] = self.np_m2[idx] / count
+            toret["min"] = self.np_min[idx].copy()
+            toret["max"] = self.np_max[idx].copy()
+        else:
+            for str_key in ["mean", "var", "min", "max"]:
+                toret[str_key] = np.full(self.dim_stat, np.nan)
+        if(self.np_hist is not None):
+            toret["hist"] = self.np_hist[idx].copy()
+        return toret
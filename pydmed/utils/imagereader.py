@@ -0,0 +1,191 @@
+
+'''
+Image readers used by the WSI extensions.
+All readers expose the same interface (a subset of `openslide.OpenSlide`), so the
+fastest decoder can be used for each format, and the pipeline can be profiled
+without disk I/O by using `SyntheticReader`.
+'''
+
+import numpy as np
+import os
+from abc import ABC, abstractmethod
+
+
+
+class ImageReader(ABC):
+    '''
+    The region-read interface. Subclasses have to set the following fields:
+        - level_dimensions: a list of (W,H) tuples, the size of each level.
+        - level_downsamples: a list of floats, the downsample factor of each level with respect to level 0.
+        - tile_size: a tuple (w,h), the size of the native tiles (or chunks) of the image.
+    '''
+    @property
+    def level_count(self):
+        return len(self.level_dimensions)
+
+    @property
+    def dimensions(self):
+        return self.level_dimensions[0]
+
+    @abstractmethod
+    def read_region(self, location, level, size):
+        '''
+        Reads a region of the image.
+        Inputs.
+            - location: (x,y), the top-left corner of the region in level 0 coordinates (as in openslide).
+            - level: an integer, the level to read from.
+            - size: (w,h), the size of the region in the given level.
+        Outputs.
+            - np_region: a uint8 numpy array of shape [h x w x 3].
+                The parts of the region that fall outside the image are filled with zeros.
+        '''
+        pass
+
+    def close(self):
+        pass
+
+
+def _read_from_array(np_level, x, y, w, h):
+    '''
+    Reads the region [y:y+h, x:x+w] from an array-like object of shape [H x W x C] (e.g., numpy or zarr arrays).
+    The parts which fall outside the array are filled with zeros.
+    '''
+    H, W = np_level.shape[0], np_level.shape[1]
+    np_toret = np.zeros((h, w, 3), dtype=np.uint8)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x+w, W), min(y+h, H)
+    if((x1 > x0) and (y1 > y0)):
+        np_toret[y0-y:y1-y, x0-x:x1-x, :] = np.asarray(np_level[y0:y1, x0:x1])[:, :, 0:3]
+    return np_toret
+
+
+class OpenSlideReader(ImageReader):
+    def __init__(self, fname):
+        import openslide
+        self.osimage = openslide.OpenSlide(fname)
+        self.level_dimensions = list(self.osimage.level_dimensions)
+        self.level_downsamples = list(self.osimage.level_downsamples)
+        dict_properties = self.osimage.properties
+        self.tile_size = (
+            int(dict_properties.get("openslide.level[0].tile-width", 256)),
+            int(dict_properties.get("openslide.level[0].tile-height", 256))
+          )
+
+    def read_region(self, location, level, size):
+        pil_region = self.osimage.read_region([int(location[0]), int(location[1])], level, [int(size[0]), int(size[1])])
+        return np.array(pil_region)[:, :, 0:3]
+
+    def close(self):
+        self.osimage.close()
+
+
+class TiffReader(ImageReader):
+    def __init__(self, fname):
+        '''
+        Reads (pyramidal) tiff files as chunked zarr arrays, so only the chunks that overlap
+        the requested region are decoded. Requires the packages `tifffile` and `zarr`.
+        '''
+        import tifffile
+        import zarr
+        self._tif = tifffile.TiffFile(fname)
+        series = self._tif.series[0]
+        z = zarr.open(series.aszarr(), mode="r")
+        if(isinstance(z, zarr.Array)):
+            self.list_levels = [z]
+        else:
+            self.list_levels = [z[str(idx_level)] for idx_level in range(len(series.levels))]
+        self.level_dimensions = [(int(u.shape[1]), int(u.shape[0])) for u in self.list_levels]
+        W0 = self.level_dimensions[0][0]
+        self.level_downsamples = [W0/float(u[0]) for u in self.level_dimensions]
+        keyframe = series.levels[0].keyframe
+        if(keyframe.is_tiled):
+            self.tile_size = (int(keyframe.tilewidth), int(keyframe.tilelength))
+        else:
+            self.tile_size = (self.level_dimensions[0][0], int(keyframe.rowsperstrip))
+
+    def read_region(self, location, level, size):
+        downsample = self.level_downsamples[level]
+        x, y = int(location[0]/downsample), int(location[1]/downsample)
+        return _read_from_array(self.list_levels[level], x, y, int(size[0]), int(size[1]))
+
+    def close(self):
+        self._tif.close()
+
+
+class ArrayReader(ImageReader):
+    def __init__(self, np_image, list_downsamples=(1,)):
+        '''
+        Reads from an in-memory (or memory-mapped) numpy array of shape [H x W x C].
+        Inputs.
+            - np_image: the image, or the path to a .npy/.png/.jpg file.
+                .npy files are memory-mapped. Other files are decoded with PIL.
+            - list_downsamples: a list of integers, the downsample factors of the levels.
+                The levels are strided views of the image, so no extra memory is used.
+        '''
+        if(isinstance(np_image, str)):
+            if(np_image.endswith(".npy")):
+                np_image = np.load(np_image, mmap_mode="r")
+            else:
+                import PIL.Image
+                np_image = np.array(PIL.Image.open(np_image).convert("RGB"))
+        if(np_image.ndim == 2):
+            np_image = np.stack([np_image, np_image, np_image], 2)
+        self.list_levels = [np_image[::d, ::d] for d in list_downsamples]
+        self.level_dimensions = [(int(u.shape[1]), int(u.shape[0])) for u in self.list_levels]
+        self.level_downsamples = [float(d) for d in list_downsamples]
+        self.tile_size = self.level_dimensions[0]
+
+    def read_region(self, location, level, size):
+        downsample = self.level_downsamples[level]
+        x, y = int(location[0]/downsample), int(location[1]/downsample)
+        return _read_from_array(self.list_levels[level], x, y, int(size[0]), int(size[1]))
+
+
+class SyntheticReader(ImageReader):
+    def __init__(self, W, H, list_downsamples=(1,), tile_size=(256,256), seed=0):
+        '''
+        An in-memory synthetic image of size WxH, with no disk I/O and no decoding.
+        It is useful for profiling the pipeline, and for testing.
+        The pixel values are a deterministic function of the position, so two reads of
+        the same region return the same values.
+        '''
+        self.level_downsamples = [float(d) for d in list_downsamples]
+        self.level_dimensions = [(int(W/d), int(H/d)) for d in list_downsamples]
+        self.tile_size = tuple(tile_size)
+        self.seed = seed
+
+    def read_region(self, location, level, size):
+        downsample = self.level_downsamples[level]
+        x, y = int(location[0]/downsample), int(location[1]/downsample)
+        w, h = int(size[0]), int(size[1])
+        np_x = np.arange(x, x+w, dtype=np.int64)[None, :]
+        np_y = np.arange(y, y+h, dtype=np.int64)[:, None]
+        np_toret = np.empty((h, w, 3), dtype=np.uint8)
+        np_toret[:, :, 0] = (np_x + self.seed) % 256
+        np_toret[:, :, 1] = (np_y + self.seed) % 256
+        np_toret[:, :, 2] = (np_x + np_y) % 256
+        W, H = self.level_dimensions[level]
+        np_toret[:, ((np_x < 0) | (np_x >= W))[0], :] = 0
+        np_toret[((np_y < 0) | (np_y >= H))[:, 0], :, :] = 0
+        return np_toret
+
+
+#the reader used for each file extension. Other extensions are read by `OpenSlideReader`.
+dict_extension_to_reader = {
+    ".npy":ArrayReader,
+    ".png":ArrayReader,
+    ".jpg":ArrayReader,
+    ".jpeg":ArrayReader
+}
+
+
+def open_image(fname):
+    '''
+    Opens an image with the reader registered for its extension in `dict_extension_to_reader`.
+    Other extensions (e.g., .svs, .ndpi, .tif) are read by `OpenSlideReader`.
+    To read, e.g., tiff files with tifffile/zarr, one can set
+        `pydmed.utils.imagereader.dict_extension_to_reader[".tif"] = TiffReader`.
+    '''
+    str_extension = os.path.splitext(fname)[1].lower()
+    type_reader = dict_extension_to_reader.get(str_extension, OpenSlideReader)
+    return type_reader(fname)
@@ -78,3 +78,74 @@ def terminaterecursively(pid):
         parent.kill()
     except:
         pass
+
+
+def parse_listcores(cores):
+    '''
+    Converts a set of cores to a list of integers.
+    Inputs.
+        - cores: either a list of integers, or a string as in `taskset`, e.g., "0,1,2" or "0-3,6".
+    '''
+    if(isinstance(cores, str)):
+        list_cores = []
+        for str_part in cores.split(","):
+            str_part = str_part.strip()
+            if(str_part == ""):
+                continue
+            if("-" in str_part):
+                core_begin, core_end = str_part.split("-")
+                list_cores.extend(range(int(core_begin), int(core_end)+1))
+            else:
+                list_cores.append(int(str_part))
+        return list_cores
+    return [int(u) for u in cores]
+
+
+def set_cpuaffinity(cores, pid=None, flag_allthreads=True):
+    '''
+    Pins a process to a set of cores by `psutil.Process.cpu_affinity`. 
+    The processes (and threads) that are created afterwards inherit the affinity.
+    On platforms where setting the affinity is not supported (e.g., macOS), a warning is printed and nothing is done.
+    Inputs.
+        - cores: the cores, as accepted by `parse_listcores`.
+        - pid: the process id, if None the current process is pinned.
+        - flag_allthreads: if True, the threads that are already running in the process are pinned as well (as in `taskset -a`).
+    '''
+    list_cores = parse_listcores(cores)
+    try:
+        process = psutil.Process(pid)
+        process.cpu_affinity(list_cores)
+        if(flag_allthreads == True):
+            for thread in process.threads():
+                try:
+                    psutil.Process(thread.id).cpu_affinity(list_cores)
+                except (psutil.Error, OSError, ValueError):
+                    pass #e.g., the thread is finished.
+        return True
+    except (AttributeError, NotImplementedError, psutil.Error, OSError, ValueError) as exception:
+        print("Warning: could not set the cpu affinity to {}: {}".format(list_cores, exception))
+        return False
+
+
+def get_auto_corelayout(list_cores=None):
+    '''
+    Splits the available cores between loading (i.e. `LightDL` and its subprocesses) and collecting 
+    (i.e. the process that consumes the `LightDL`, e.g., `StreamCollector`).
+    About 3/8 of the cores are used for collecting (e.g., 5 and 3 cores on an 8-core machine).
+    Inputs.
+        - list_cores: the available cores. If None, the cores that the current process is allowed to run on are used.
+    Outputs.
+        - dict_layout: a dictionary with the keys "loading" and "collecting", each a list of cores.
+            If there is only one core, both lists contain that core.
+    '''
+    if(list_cores is None):
+        try:
+            list_cores = psutil.Process().cpu_affinity()
+        except (AttributeError, NotImplementedError, psutil.Error, OSError):
+            list_cores = list(range(psutil.cpu_count() or 1))
+    list_cores = sorted(parse_listcores(list_cores))
+    if(len(list_cores) < 2):
+        return {"loading":list_cores, "collecting":list_cores}
+    num_cores_collecting = max(1, (3*len(list_cores))//8)
+    return {"loading":list_cores[0:-num_cores_collecting],
+            "collecting":list_cores[-num_cores_collecting:]}
@@ -5,13 +5,149 @@ import sys
 import os
 import multiprocessing as mp
 import csv
+import math
 import time
+import queue
+import gzip
+import lzma
+import bz2
+import json
+import pickle
+from collections import OrderedDict
 
 
 
+#the suffix of compressed files, for each compression method supported by `StreamWriter`.
+dict_compression_to_suffix = {"gzip":".gz", "lzma":".xz", "bz2":".bz2"}
+
+
+def get_compression_of_fname(fname):
+    '''
+    Returns the compression method of a file (one of the keys of `dict_compression_to_suffix`)
+    based on its suffix, or None if the file is not compressed.
+    '''
+    for str_compression, str_suffix in dict_compression_to_suffix.items():
+        if(fname.endswith(str_suffix)):
+            return str_compression
+    return None
+
+
+def open_pdmfile(fname, mode, compresslevel=None, buffering=-1):
+    '''
+    Opens a (possibly compressed) output file. The compression method is decided by the suffix of `fname`,
+    so the same function is used for writing and reading.
+    Compressed files are written and read as streams, so a file can be reopened in append mode
+    (each reopening appends a new compressed stream, which is read back transparently).
+    Inputs.
+        - fname: the file name.
+        - mode: one of 'r', 'rb', 'a', 'ab' (as in the builtin `open`).
+        - compresslevel: the compression level, 1 (fastest) to 9 (smallest). If None, the default of the method is used.
+            It is ignored when reading, or when the file is not compressed.
+        - buffering: as in the builtin `open`. It is ignored for compressed files.
+    '''
+    str_compression = get_compression_of_fname(fname)
+    if(str_compression is None):
+        return open(fname, mode=mode, buffering=buffering)
+    if(mode.endswith("b") == False):
+        mode = mode + "t"
+    if(mode.startswith("r")):
+        compresslevel = None
+    if(str_compression == "gzip"):
+        if(compresslevel is None):
+            return gzip.open(fname, mode)
+        return gzip.open(fname, mode, compresslevel=compresslevel)
+    elif(str_compression == "lzma"):
+        return lzma.open(fname, mode, preset=compresslevel)
+    elif(str_compression == "bz2"):
+        if(compresslevel is None):
+            return bz2.open(fname, mode)
+        return bz2.open(fname, mode, compresslevel=compresslevel)
+
+
+
+def get_tileweights(h, w, str_blending):
+    '''
+    Returns the weights of the pixels of a tile of size [h x w] when overlapping tiles are stitched.
+    Inputs.
+        - str_blending: either "average" (all weights are 1.0) or "weighted".
+            In "weighted" mode, the weights fall off linearly from the center of the tile towards its borders
+            (but never reach zero), so the contribution of each tile fades out smoothly in the overlaps.
+    '''
+    if(str_blending == "weighted"):
+        np_rampy = np.minimum(np.arange(h)+1, h-np.arange(h)).astype(np.float64)
+        np_rampx = np.minimum(np.arange(w)+1, w-np.arange(w)).astype(np.float64)
+        return np.outer(np_rampy, np_rampx)
+    return np.ones((h, w), dtype=np.float64)
+
+
+class ProgressJournal(object):
+    def __init__(self, fname_journal=None):
+        '''
+        The progress of a run, kept in a json file so that the run can be resumed after a crash
+        (see the argument `fname_journal` of `StreamWriter`).
+        For each patient (by its `int_uniqueid`), it keeps a dictionary with the following keys:
+            - idx_bigrow: the rows of the patient before this row are fully written.
+            - offset: the size of the output file of the patient right after those rows, i.e. the last consistent point of the file.
+            - flag_finished: if True, all outputs of the patient are written.
+        Inputs.
+            - fname_journal: the path of the json file. If the file exists, the progress is loaded from it.
+                If None, the journal is only kept in memory.
+        '''
+        self.fname_journal = fname_journal
+        self.dict_uniqueid_to_progress = {}
+        if(fname_journal is not None):
+            if(os.path.isfile(fname_journal)):
+                with open(fname_journal, "r") as file_journal:
+                    self.dict_uniqueid_to_progress = {int(k):v for k, v in json.load(file_journal).items()}
+    
+    def get_progress(self, patient):
+        '''
+        Returns the progress of a patient (see `ProgressJournal`), or None if nothing is saved for the patient.
+        '''
+        return self.dict_uniqueid_to_progress.get(patient.int_uniqueid, None)
+    
+    def is_finished(self, patient):
+        progress = self.get_progress(patient)
+        if(progress is None):
+            return False
+        return progress["flag_finished"]
+    
+    def set_progress(self, int_uniqueid, idx_bigrow, offset, flag_finished=False):
+        self.dict_uniqueid_to_progress[int_uniqueid] = {"idx_bigrow":idx_bigrow, "offset":offset,
+                                                        "flag_finished":flag_finished}
+    
+    def update(self, progressjournal):
+        '''
+        Adds the progress of another `ProgressJournal` (e.g., of another process of `ShardedStreamWriter`).
+        '''
+        self.dict_uniqueid_to_progress.update(progressjournal.dict_uniqueid_to_progress)
+    
+    def save(self):
+        '''
+        Saves the journal atomically, i.e. it is written to a temporary file which then replaces `fname_journal`.
+        So after a crash the journal is either the old or the new one, and never partially written.
+        '''
+        fname_tmp = self.fname_journal + ".tmp"
+        with open(fname_tmp, "w") as file_journal:
+            json.dump({str(k):v for k, v in self.dict_uniqueid_to_progress.items()}, file_journal)
+            file_journal.flush()
+            os.fsync(file_journal.fileno())
+        os.replace(fname_tmp, self.fname_journal)
+
+
+
+#placed in the queue of `StreamWriter` by `flush_and_close`, after all records.
+_STREAMWRITER_END = "PYDMEDRESERVED_STREAMWRITER_END"
+
+
 class StreamWriter(mp.Process):
+    dict_format_to_extension = {"pdmcsv":".csv", "pdmbin":".pdmbin"}
+    
     def __init__(self, list_patients=None, rootpath=None, fname_tosave=None, 
-                 waiting_time_before_flush = 3):
+                 waiting_time_before_flush = None, str_format = "pdmcsv",
+                 timeout_get = 0.5, max_elems_perdrain = 10000, size_writebuffer = 1024*1024,
+                 max_openfiles = 256, str_compression = None, compresslevel = None,
+                 fname_journal = None, interval_savejournal = 10, flag_checkrootpath = True):
         '''
         StreamWriter works in two modes:
             1) one file is created for the whole dataset. In this case, 
@@ -19,8 +155,38 @@ class StreamWriter(mp.Process):
             2) one file is created for each `Patient` in the directory `rootpath`.
                In this case, `fname_tosave` must be None.
         Inputs:
-            - waiting_time_before_flush: before flushing the contents, it should 
-                sleep a few seconds. Default is 3 seconds.
+            - waiting_time_before_flush: deprecated and ignored, it is only kept so the positional arguments of 
+                previous versions still work. `flush_and_close` waits until the writing process has written all records instead.
+            - str_format: either "pdmcsv" or "pdmbin". 
+                In "pdmcsv" format, strings are written to .csv text files (e.g., the output of `Tensor3DtoPdmcsvrow`).
+                In "pdmbin" format, bytes are written to .pdmbin binary files 
+                (e.g., the output of `pydmed.extensions.wsi.Tensor3DtoPdmbinrecord`).
+            - timeout_get: the writing process blocks on the queue for at most this many seconds
+                before checking whether `flush_and_close` is called. Default is 0.5 seconds.
+            - max_elems_perdrain: the maximum number of elements that are popped from the queue
+                and written at once. Default is 10000.
+            - size_writebuffer: the size of the write buffer of each file, in bytes. Default is 1MB.
+            - max_openfiles: the maximum number of files that are kept open at the same time.
+                In mode 2, the file of a patient is created when its first record is written.
+                When more than `max_openfiles` files are open, the least recently written file is closed,
+                and it is reopened in append mode when the patient produces more records. Default is 256.
+            - str_compression: either None (default, no compression) or one of "gzip", "lzma", "bz2".
+                The output files are compressed as streams in the writing process, and their names are
+                suffixed by ".gz", ".xz", or ".bz2", respectively (e.g., patient_1.csv.gz).
+                They can be read by the functions of `pydmed.extensions.wsi` (e.g., `pdmcsvtoarray`) as usual.
+            - compresslevel: the compression level, 1 (fastest) to 9 (smallest). 
+                If None, the default level of the compression method is used.
+            - fname_journal: the path of a `ProgressJournal`, only supported in mode 2. If not None, 
+                whenever the records of a new row of a patient arrive (see the argument `idx_row` of `write`),
+                the file of the patient is flushed to disk and its size is kept as the last consistent point of the file.
+                The journal is saved when the `StreamWriter` is created, every `interval_savejournal` seconds, and on `flush_and_close`.
+                When `fname_journal` is not None, `rootpath` does not need to be empty: the files are truncated to their
+                last consistent points in the journal (or to zero, for the patients with no progress or when the journal does not exist), 
+                and the journal is used to resume the run (see `StreamCollector` and `LightDL.resume_from_progressjournal`).
+                The records of each patient must arrive in the order of their rows.
+            - interval_savejournal: the interval (in seconds) of saving the journal. Default is 10 seconds.
+            - flag_checkrootpath: if True (default), in mode 2 and when `fname_journal` is None, `rootpath` has to be empty.
+                `ShardedStreamWriter` sets it to False, as it checks `rootpath` once for all of its processes.
         '''
         super(StreamWriter, self).__init__()
         if(isinstance(rootpath, str) and isinstance(fname_tosave, str)):
@@ -41,77 +207,172 @@ class StreamWriter(mp.Process):
                     " For details, please refer to"+\
                      " `StreamWriter` documentation"
             raise Exception(exception_msg)
+        if(str_format not in StreamWriter.dict_format_to_extension.keys()):
+            raise Exception("The argument `str_format` must be one of {}.".format(
+                                list(StreamWriter.dict_format_to_extension.keys())))
+        if((str_compression is not None) and (str_compression not in dict_compression_to_suffix.keys())):
+            raise Exception("The argument `str_compression` must be None or one of {}.".format(
+                                list(dict_compression_to_suffix.keys())))
+        str_extension = StreamWriter.dict_format_to_extension[str_format]
+        if(str_compression is not None):
+            str_extension = str_extension + dict_compression_to_suffix[str_compression]
         if(self.op_mode == 1):
-            if(fname_tosave.endswith(".csv") == False):
-                raise Exception("The argument `fname_tosave` must end with .csv."+\
-                                "Because only .csv format is supported.")
-        if(self.op_mode == 2):
+            if(fname_tosave.endswith(str_extension) == False):
+                raise Exception("The argument `fname_tosave` must end with {}.".format(str_extension)+\
+                                "Because the format is {}.".format(str_format))
+        if((fname_journal is not None) and (self.op_mode == 1)):
+            raise Exception("The argument `fname_journal` is only supported when one file is created for each `Patient`.")
+        flag_resume = (fname_journal is not None) #the files of the patients with no progress are truncated to zero below.
+        if((self.op_mode == 2) and (flag_resume == False) and (flag_checkrootpath == True)):
             if(len(list(os.listdir(rootpath))) > 0):
                 print(list(os.listdir(rootpath)))
                 raise Exception("The folder {} \n is not empty.".format(rootpath)+\
                         " Delete its files before continuing.")
+        if(waiting_time_before_flush is not None):
+            print("Warning: the argument `waiting_time_before_flush` of `StreamWriter` is deprecated and ignored.")
         #grab privates ================
         self.list_patients = list_patients
         self.rootpath = rootpath
         self.fname_tosave = fname_tosave
-        self.waiting_time_before_flush = waiting_time_before_flush
-        #make/open csv file(s) =======================
+        self.str_format = str_format
+        self.timeout_get = timeout_get
+        self.max_elems_perdrain = max_elems_perdrain
+        self.size_writebuffer = size_writebuffer
+        self.max_openfiles = max_openfiles
+        self.str_compression = str_compression
+        self.compresslevel = compresslevel
+        self.str_filemode = 'a' if(str_format == "pdmcsv") else 'ab'
+        self.fname_journal = fname_journal
+        self.interval_savejournal = interval_savejournal
+        #make the map from patients to file names =======================
         if(self.op_mode == 1):
-            self.list_files = [open(fname_tosave, mode='a+')]
-            self.list_writers = [csv.writer(f, delimiter=',',\
-                                    quotechar='"', quoting=csv.QUOTE_MINIMAL
-                                    ) for f in self.list_files]
+            open_pdmfile(fname_tosave, self.str_filemode, compresslevel).close()
         elif(self.op_mode == 2):
-            self.list_files = [open(os.path.join(rootpath,\
-                                    "patient_{}.csv".format(patient.int_uniqueid))
-                                   , mode='a+') for patient in list_patients]
-            self.list_writers = [csv.writer(f, delimiter=',',\
-                                    quotechar='"', quoting=csv.QUOTE_MINIMAL
-                                    ) for f in self.list_files]
+            self.dict_uniqueid_to_fname = {
+                patient.int_uniqueid:os.path.join(rootpath,\
+                                    "patient_{}{}".format(patient.int_uniqueid, str_extension))
+                for patient in list_patients
+              }
+        #load the journal, and truncate the files to their last consistent points =======================
+        if(fname_journal is not None):
+            self._progressjournal = ProgressJournal(fname_journal)
+            for patient in list_patients:
+                fname = self.dict_uniqueid_to_fname[patient.int_uniqueid]
+                progress = self._progressjournal.get_progress(patient)
+                offset = 0 if(progress is None) else progress["offset"]
+                if(os.path.isfile(fname)):
+                    if(os.path.getsize(fname) > offset):
+                        with open(fname, "r+b") as file_totruncate:
+                            file_totruncate.truncate(offset)
+            self._progressjournal.save() #so a crash before the first save of the writing process can be resumed as well.
+            self._dict_uniqueid_to_lastrow = {} #the last row written for each patient, in the writing process.
+            self._flag_savejournalnow = False #set when a patient is finished, so the journal is saved right away.
+            self._time_lastsavejournal = time.time()
+        else:
+            self._progressjournal = None
+        #the open files, in least-recently-written order. They are opened in the writing process.
+        self._dict_fname_to_openfile = OrderedDict()
         #make mp stuff ========
         '''
         two mp.Queue objects:
         1. queue_towrite is used to pass data to the writing process.
-        2. queue_signal_end is used to signal the end of writing process.
+        2. queue_signal_end is used to signal the end of writing process (kept to support previous versions, 
+           `flush_and_close` places the end-of-stream signal in queue_towrite instead).
         3. flag_closecalled is used to indicate whether the close method has been called or not. Once close is called, writing would be disabled.
         '''
         self.queue_towrite = mp.Queue() #there is one queue in both operating modes.
         self.queue_signal_end = mp.Queue() #this queue not empty means "close"
         self.flag_closecalled = False #once close is called, writing would be disabled.
+        #metrics, shared with the writing process (see `get_metrics`) ======
+        self._mpvalue_time_start = mp.Value("d", time.time())
+        self._mpvalue_num_written = mp.Value("d", 0.0)
+        self._mpvalue_num_byteswritten = mp.Value("d", 0.0)
+        self._mpvalue_num_drains = mp.Value("d", 0.0)
+        self._mpvalue_lag_last = mp.Value("d", 0.0)
+        self._mpvalue_lag_max = mp.Value("d", 0.0)
     
     def flush_and_close(self):
         '''
-        1. flushes any remaining data in the queue_towrite
-        2. sleeps for the waiting_time_before_flush period
-        3. adds a "stop" signal to the queue_signal_end to signal that writing is complete and the process can be terminated
-        When the StreamWriter process receives the "stop" signal from queue_signal_end, it will stop writing to the file and terminate.
+        1. disables `write`
+        2. places an end-of-stream signal in queue_towrite, i.e. after all records which are written so far
+        3. waits until the writing process has written all records (i.e. it reaches the signal), closed the files, and exited.
+        '''
+        self.signal_endofstream()
+        self.join()
+    
+    def signal_endofstream(self):
+        '''
+        Disables `write` and places the end-of-stream signal in the queue, without waiting for the writing process.
+        When the writing process reaches the signal, it closes the files and exits.
         '''
         self.flag_closecalled = True
-        time.sleep(self.waiting_time_before_flush)
-        self.queue_signal_end.put_nowait("stop")
+        self.queue_towrite.put_nowait(_STREAMWRITER_END)
+    
+    def get_metrics(self):
+        '''
+        Returns the metrics of the writing process as a dictionary with the following keys:
+            - num_written: number of elements written to file(s).
+            - num_byteswritten: number of bytes (or characters, in "pdmcsv" format) written to file(s), before compression.
+            - throughput: number of elements written per second, since the `StreamWriter` is created.
+            - lag_last: the time (in seconds) between calling `write` and writing to file, for the last written element.
+            - lag_max: the maximum of `lag_last` so far.
+            - avg_elems_perdrain: the average number of elements written per wake-up of the writing process.
+            - qsize: the number of elements in the queue which are not written yet.
+        '''
+        time_elapsed = max(time.time() - self._mpvalue_time_start.value, 1e-6)
+        num_written = self._mpvalue_num_written.value
+        num_drains = self._mpvalue_num_drains.value
+        try:
+            qsize = self.queue_towrite.qsize()
+        except NotImplementedError: #on macOS
+            qsize = None
+        return {
+            "num_written":int(num_written),
+            "num_byteswritten":int(self._mpvalue_num_byteswritten.value),
+            "throughput":num_written/time_elapsed,
+            "lag_last":self._mpvalue_lag_last.value,
+            "lag_max":self._mpvalue_lag_max.value,
+            "avg_elems_perdrain":(num_written/num_drains) if(num_drains > 0) else 0.0,
+            "qsize":qsize
+        }
     
     
     def run(self):
         '''
-        executed when an instance of the class is started as a separate process. The method runs an infinite loop where it checks if the queue_signal_end has any item in it. 
-        If the queue has any item in it, it means that the flush_and_close method has been called, so the loop should be terminated, and all open files should be flushed and closed. 
-        If the queue does not have any item in it, the method executes the _wrt_patrol method, which is responsible for writing any data added to the queue_towrite by the main program to the appropriate CSV file.
+        executed when an instance of the class is started as a separate process. The method runs an infinite loop which executes the _wrt_patrol method, 
+        which blocks on queue_towrite (for at most `timeout_get` seconds) and writes all available elements to the appropriate file(s).
+        When _wrt_patrol reaches the end-of-stream signal of flush_and_close (or queue_signal_end has any item in it), 
+        the loop is terminated, and all open files are flushed and closed.
         '''
         while True:
+            flag_endofstream = False
             if(self.queue_signal_end.qsize()>0):
-                #execute flush_and_close ==========
+                #the previous way of closing, pop all elements of the queue ==========
                 self.flag_closecalled = True
                 self._wrt_onclose()
-                for f in self.list_files:
+                flag_endofstream = True
+            else:
+                #patrol the queue ==========
+                flag_endofstream = self._wrt_patrol()
+            if(flag_endofstream == True):
+                #execute flush_and_close ==========
+                if(self._progressjournal is not None):
+                    self._wrt_journal_onclose()
+                for f in self._dict_fname_to_openfile.values():
                     f.flush()
                     f.close()
+                self._dict_fname_to_openfile = OrderedDict()
                 break
-            else:
-                #patrol the queue ==========
-                self._wrt_patrol()
     
     
-    def write(self, patient, str_towrite):
+    def get_progressjournal(self):
+        '''
+        Returns the `ProgressJournal` as it was loaded when the `StreamWriter` was created 
+        (None if `fname_journal` is None).
+        '''
+        return self._progressjournal
+    
+    def write(self, patient, str_towrite, idx_row=None):
         '''
         writes a string to file(s) in a separate process. Depending on the op_mode attribute, it either writes to a single CSV file or writes to individual files for each patient.
         If the close method has been called previously, it raises a warning message and does not write anything. 
@@ -123,65 +384,604 @@ class StreamWriter(mp.Process):
             - patient: an instance of `Patient`. This argument is ignored
                     when operating in mode 1.
             - str_towrite: the string to be written to file.
+                    If the `StreamWriter` is created with `str_format="pdmbin"`, it has to be an instance of `bytes`.
+            - idx_row: the row of the record (e.g., `idx_bigrow` in `SlidingWindowDL`). It is only used when `fname_journal` is not None.
+                A patient is saved as finished in the journal only by `mark_patient_finished`.
         '''
         if(self.flag_closecalled == False):
-            self.queue_towrite.put_nowait({"patient": patient, "str_towrite":str_towrite})
+            self.queue_towrite.put_nowait({"patient": patient, "str_towrite":str_towrite, "time_write":time.time(),
+                                           "idx_row":idx_row})
         else:
             print("`StreamWriter` cannot `write` after calling the `close` function.")
     
+    def mark_patient_finished(self, patient):
+        '''
+        Tells the `StreamWriter` that all records of a patient are written (by `write`).
+        When `fname_journal` is not None, the patient is saved as finished in the journal after its records,
+        and the journal is saved right away.
+        '''
+        if(self.flag_closecalled == False):
+            self.queue_towrite.put_nowait({"patient": patient, "str_towrite":None, "time_write":time.time(),
+                                           "idx_row":None})
+    
     def _wrt_patrol(self):
         '''
         private method 
-        checks if there are elements in the queue_towrite and writes the first one to the corresponding file(s) if there are.
-        If the op_mode is 1, it writes the str_towrite to the first file in list_files.
-        If the op_mode is 2, it extracts the patient and str_towrite from the first element in the queue, checks that patient is in list_patients, finds the index of the patient in the list, and writes str_towrite to the file corresponding to that patient index in list_files.
-        If there are no elements in the queue, the method does nothing.
+        blocks on queue_towrite for at most `timeout_get` seconds. When an element arrives, all available elements (at most `max_elems_perdrain`) 
+        are popped and written by `_wrt_listelems`.
+        If no element arrives, the method does nothing.
+        Returns True if the end-of-stream signal is popped (see `flush_and_close`), otherwise False.
         '''
+        try:
+            poped_elem = self.queue_towrite.get(timeout=self.timeout_get)
+        except queue.Empty:
+            return False
+        list_poped = [poped_elem]
+        while(len(list_poped) < self.max_elems_perdrain):
+            if(isinstance(list_poped[-1], str)):
+                break
+            try:
+                list_poped.append(self.queue_towrite.get_nowait())
+            except queue.Empty:
+                break
+        flag_endofstream = isinstance(list_poped[-1], str) #i.e. _STREAMWRITER_END
+        if(flag_endofstream == True):
+            list_poped = list_poped[0:-1]
+        if(len(list_poped) > 0):
+            self._wrt_listelems(list_poped)
+        if(self._progressjournal is not None):
+            if(self._flag_savejournalnow or ((time.time() - self._time_lastsavejournal) > self.interval_savejournal)):
+                self._progressjournal.save()
+                self._time_lastsavejournal = time.time()
+                self._flag_savejournalnow = False
+        return flag_endofstream
+    
+    def _get_openfile(self, fname):
         '''
-        Pops/writes one element from the queue
+        Returns the open file `fname`, and opens it (in append mode) if needed.
+        If more than `max_openfiles` files are open, the least recently written file is closed.
         '''
-        if(self.queue_towrite.qsize() > 0):
-            try:
-                poped_elem = self.queue_towrite.get_nowait()
-                
-                if(self.op_mode == 1):
-                    self.list_files[0].write(poped_elem["str_towrite"])
-                elif(self.op_mode == 2):
-                    patient, str_towrite = poped_elem["patient"], poped_elem["str_towrite"]
-                    assert(patient in self.list_patients)
-                    idx_patient = self.list_patients.index(patient)
-                    self.list_files[idx_patient].write(str_towrite)
-            except Exception as e:
-                pass
-                #print("\n\n\n\n*************")
-                #print(str(e))
-            
+        if(fname in self._dict_fname_to_openfile):
+            self._dict_fname_to_openfile.move_to_end(fname)
+        else:
+            if(len(self._dict_fname_to_openfile) >= self.max_openfiles):
+                _, f_lru = self._dict_fname_to_openfile.popitem(last=False)
+                f_lru.close()
+            self._dict_fname_to_openfile[fname] = open_pdmfile(fname, self.str_filemode,
+                                                               self.compresslevel, self.size_writebuffer)
+        return self._dict_fname_to_openfile[fname]
+    
+    def _wrt_listelems(self, list_poped):
+        '''
+        Groups a list of popped elements by their target file, and writes each group with one call to `write`.
+        When `fname_journal` is not None, the group of a file is written (and committed, see `_wrt_commit`) 
+        as soon as a record of a new row of the patient arrives.
+        '''
+        dict_fname_to_listtowrite = {}
+        num_byteswritten = 0
+        for poped_elem in list_poped:
+            if(self.op_mode == 1):
+                fname = self.fname_tosave
+            elif(self.op_mode == 2):
+                fname = self.dict_uniqueid_to_fname.get(poped_elem["patient"].int_uniqueid, None)
+                if(fname is None):
+                    print("`StreamWriter` received a patient which is not in `list_patients`, the record is ignored.")
+                    continue
+            if(fname not in dict_fname_to_listtowrite.keys()):
+                dict_fname_to_listtowrite[fname] = []
+            if(self._progressjournal is not None):
+                int_uniqueid = poped_elem["patient"].int_uniqueid
+                lastrow = self._dict_uniqueid_to_lastrow.get(int_uniqueid, None)
+                flag_finished = (poped_elem["str_towrite"] is None)
+                flag_newrow = (lastrow is not None) and (poped_elem["idx_row"] is not None) and\
+                              (poped_elem["idx_row"] != lastrow)
+                if(flag_newrow or flag_finished):
+                    num_byteswritten += self._wrt_group(fname, dict_fname_to_listtowrite[fname])
+                    dict_fname_to_listtowrite[fname] = []
+                    if(flag_finished == True):
+                        self._progressjournal.set_progress(int_uniqueid, None, self._wrt_commit(fname), flag_finished=True)
+                        self._flag_savejournalnow = True
+                    else:
+                        self._progressjournal.set_progress(int_uniqueid, poped_elem["idx_row"], self._wrt_commit(fname))
+                if(poped_elem["idx_row"] is not None):
+                    self._dict_uniqueid_to_lastrow[int_uniqueid] = poped_elem["idx_row"]
+            if(poped_elem["str_towrite"] is not None):
+                dict_fname_to_listtowrite[fname].append(poped_elem["str_towrite"])
+        for fname in dict_fname_to_listtowrite.keys():
+            num_byteswritten += self._wrt_group(fname, dict_fname_to_listtowrite[fname])
+        #update the metrics ====
+        lag_last = time.time() - list_poped[-1]["time_write"]
+        self._mpvalue_num_written.value += len([u for u in list_poped if(u["str_towrite"] is not None)])
+        self._mpvalue_num_byteswritten.value += num_byteswritten
+        self._mpvalue_num_drains.value += 1
+        self._mpvalue_lag_last.value = lag_last
+        self._mpvalue_lag_max.value = max(self._mpvalue_lag_max.value, lag_last)
+    
+    def _wrt_group(self, fname, list_towrite):
+        '''
+        Writes a list of records to a file with one call to `write`, and returns the number of written bytes.
+        '''
+        if(len(list_towrite) == 0):
+            return 0
+        str_empty = "" if(self.str_format == "pdmcsv") else b""
+        str_towrite = str_empty.join(list_towrite)
+        try:
+            self._get_openfile(fname).write(str_towrite)
+            return len(str_towrite)
+        except Exception as e:
+            print("`StreamWriter` failed to write to file: {}".format(str(e)))
+            return 0
+    
+    def _wrt_commit(self, fname):
+        '''
+        Flushes a file to disk and returns its size, i.e. a consistent point of the file.
+        A compressed file is closed (so its compressed stream is complete), and is reopened by the next write.
+        '''
+        if(fname in self._dict_fname_to_openfile):
+            if(self.str_compression is not None):
+                self._dict_fname_to_openfile.pop(fname).close()
+            else:
+                self._dict_fname_to_openfile[fname].flush()
+        if(os.path.isfile(fname) == False):
+            return 0
+        with open(fname, "ab") as file_tosync:
+            os.fsync(file_tosync.fileno())
+        return os.path.getsize(fname)
+    
+    def _wrt_journal_onclose(self):
+        '''
+        Is called when all records are written, and saves the journal.
+        The patients are not saved as finished here (even if their last row is written), because the run may be stopped 
+        in the middle of a row. A patient is saved as finished only by `mark_patient_finished`.
+        '''
+        self._progressjournal.save()
         
     def _wrt_onclose(self):
         '''
         responsible for popping and writing all remaining elements from the queue_towrite queue when the close function is called. 
-        It first retrieves the size of the queue and iterates over all the elements using a for loop. It then pops each element and writes it to the corresponding file based on the operation mode. 
-            1. If op_mode is 1, it writes to the first file in list_files
-            2. If op_mode is 2, it looks up the index of the corresponding patient in list_patients and writes to the corresponding file in list_files. 
-        Any exception that occurs during the popping and writing of elements is caught and ignored.
+        It pops elements until the queue stays empty for `timeout_get` seconds, and writes them in batches of at most `max_elems_perdrain` by `_wrt_listelems`.
         '''
         '''
         Pops/writes all elements of the queue.
         '''
-        qsize = self.queue_towrite.qsize()
-        if(qsize > 0):
-            for idx_elem in range(qsize):
-                try:
-                    poped_elem = self.queue_towrite.get_nowait()
-                    if(self.op_mode == 1):
-                        self.list_files[0].write(poped_elem["str_towrite"])
-                    elif(self.op_mode == 2):
-                        patient, str_towrite = poped_elem["patient"], poped_elem["str_towrite"]
-                        assert(patient in self.list_patients)
-                        idx_patient = self.list_patients.index(patient)
-                        self.list_files[idx_patient].write(str_towrite)
-                except:
-                    pass
+        list_poped = []
+        while True:
+            try:
+                list_poped.append(self.queue_towrite.get(timeout=self.timeout_get))
+            except queue.Empty:
+                break
+            if(isinstance(list_poped[-1], str)):
+                list_poped = list_poped[0:-1] #the end-of-stream signal
+                break
+            if(len(list_poped) >= self.max_elems_perdrain):
+                self._wrt_listelems(list_poped)
+                list_poped = []
+        if(len(list_poped) > 0):
+            self._wrt_listelems(list_poped)
+        
         
         
+
+class ShardedStreamWriter(object):
+    def __init__(self, list_patients, rootpath, num_writers=2, **kwargs_streamwriter):
+        '''
+        Runs `num_writers` `StreamWriter` processes in parallel, and partitions the patients among them
+        by their `int_uniqueid`. All records of a patient go to the same process, so their order is preserved.
+        It has the same interface as `StreamWriter` (i.e. `start`, `write`, `flush_and_close`, `get_metrics`, and `join`),
+        and only supports mode 2 of `StreamWriter` (i.e. one file per `Patient` in the directory `rootpath`).
+        Inputs:
+            - list_patients, rootpath: as in `StreamWriter`.
+            - num_writers: the number of writing processes.
+            - kwargs_streamwriter: other arguments of `StreamWriter` (e.g., `str_format`, `str_compression`).
+                If `fname_journal` is passed in, each process keeps its own journal, i.e. `fname_journal` suffixed by 
+                the index of the process (e.g., journal.json.0), so a crashed run has to be resumed with the same `num_writers`.
+                Whether the run is resumed is decided once for all processes: when `fname_journal` is None `rootpath` has to be empty,
+                otherwise every process resumes from its own journal (a process with no journal file starts its patients from scratch).
+        '''
+        if(num_writers < 1):
+            raise Exception("The argument `num_writers` must be at least 1.")
+        if(kwargs_streamwriter.get("fname_tosave", None) is not None):
+            raise Exception("`ShardedStreamWriter` only writes one file per patient,"+\
+                            " so the argument `fname_tosave` must be None.")
+        fname_journal = kwargs_streamwriter.pop("fname_journal", None)
+        kwargs_streamwriter.pop("flag_checkrootpath", None)
+        if(fname_journal is None):
+            if(len(list(os.listdir(rootpath))) > 0):
+                print(list(os.listdir(rootpath)))
+                raise Exception("The folder {} \n is not empty.".format(rootpath)+\
+                        " Delete its files before continuing.")
+        #grab privates ================
+        self.list_patients = list_patients
+        self.rootpath = rootpath
+        self.num_writers = num_writers
+        #make the writers ================
+        list_listpatients = [[] for idx_writer in range(num_writers)]
+        for patient in list_patients:
+            list_listpatients[self.get_idx_writer(patient)].append(patient)
+        self.list_streamwriters = [StreamWriter(list_listpatients[idx_writer], rootpath=rootpath,
+                                                fname_journal=None if(fname_journal is None) else "{}.{}".format(fname_journal, idx_writer),
+                                                flag_checkrootpath=False, **kwargs_streamwriter)
+                                   for idx_writer in range(num_writers)]
+        self.flag_closecalled = False
+    
+    def get_idx_writer(self, patient):
+        '''
+        Returns the index of the writing process that writes the records of a patient.
+        '''
+        return patient.int_uniqueid % self.num_writers
+    
+    def start(self):
+        for streamwriter in self.list_streamwriters:
+            streamwriter.start()
+    
+    def join(self):
+        for streamwriter in self.list_streamwriters:
+            streamwriter.join()
+    
+    def write(self, patient, str_towrite, idx_row=None):
+        '''
+        Same as `StreamWriter.write`.
+        '''
+        self.list_streamwriters[self.get_idx_writer(patient)].write(patient, str_towrite, idx_row)
+    
+    def mark_patient_finished(self, patient):
+        '''
+        Same as `StreamWriter.mark_patient_finished`.
+        '''
+        self.list_streamwriters[self.get_idx_writer(patient)].mark_patient_finished(patient)
+    
+    def get_progressjournal(self):
+        '''
+        Returns the journals of all processes (see `StreamWriter.get_progressjournal`) merged in one `ProgressJournal`,
+        or None if `fname_journal` is None.
+        '''
+        if(self.list_streamwriters[0].get_progressjournal() is None):
+            return None
+        toret = ProgressJournal()
+        for streamwriter in self.list_streamwriters:
+            toret.update(streamwriter.get_progressjournal())
+        return toret
+    
+    def flush_and_close(self):
+        '''
+        Same as `StreamWriter.flush_and_close`. The processes are signaled together, and then joined.
+        '''
+        self.flag_closecalled = True
+        for streamwriter in self.list_streamwriters:
+            streamwriter.signal_endofstream()
+        self.join()
+    
+    def get_metrics(self):
+        '''
+        Returns the metrics of all writing processes (see `StreamWriter.get_metrics`) aggregated.
+        The metrics of each process are in the list `list_metrics_perwriter`.
+        '''
+        list_metrics = [streamwriter.get_metrics() for streamwriter in self.list_streamwriters]
+        list_qsize = [u["qsize"] for u in list_metrics]
+        num_written = sum([u["num_written"] for u in list_metrics])
+        list_avg = [u["avg_elems_perdrain"] for u in list_metrics if(u["avg_elems_perdrain"] > 0)]
+        return {
+            "num_written":num_written,
+            "num_byteswritten":sum([u["num_byteswritten"] for u in list_metrics]),
+            "throughput":sum([u["throughput"] for u in list_metrics]),
+            "lag_last":max([u["lag_last"] for u in list_metrics]),
+            "lag_max":max([u["lag_max"] for u in list_metrics]),
+            "avg_elems_perdrain":(sum(list_avg)/len(list_avg)) if(len(list_avg) > 0) else 0.0,
+            "qsize":None if(None in list_qsize) else sum(list_qsize),
+            "list_metrics_perwriter":list_metrics
+        }
+        
         
+
+
+class RasterWriter(object):
+    def __init__(self, rootpath, dtype=np.float32, fill_value=0.0, str_blending="last", max_openrasters=64):
+        '''
+        Writes the outputs of tiles directly into one memory-mapped raster per `Patient`,
+        i.e. the file `patient_{int_uniqueid}.npy` in the directory `rootpath`.
+        Each raster is created when the first output of the patient arrives, and is sized from the
+        image dimensions and the `kernel_size` of the tiles. The rasters can be read by `np.load(fname, mmap_mode="r")`.
+        Inputs:
+            - rootpath: the directory where the rasters are saved, it must be empty.
+            - dtype: the dtype of the rasters. Default is np.float32.
+            - fill_value: the value of the raster points which are not covered by any tile. Default is 0.0.
+            - str_blending: how overlapping tiles are stitched, one of "last" (default, the last tile overwrites the previous ones),
+                "average", or "weighted" (see `get_tileweights`). In "average" and "weighted" modes, the sum of weights is
+                accumulated in a temporary raster, and the rasters are normalized in `flush_and_close`.
+            - max_openrasters: the maximum number of rasters (i.e. memory-maps) that are kept open at the same time.
+                When more than `max_openrasters` rasters are open, the least recently written raster is flushed and closed,
+                and it is reopened (by `mode="r+"`) if another output of its patient arrives. Default is 64.
+        '''
+        if(str_blending not in ["last", "average", "weighted"]):
+            raise Exception("The argument `str_blending` must be one of 'last', 'average', or 'weighted'.")
+        if(len(list(os.listdir(rootpath))) > 0):
+            print(list(os.listdir(rootpath)))
+            raise Exception("The folder {} \n is not empty.".format(rootpath)+\
+                    " Delete its files before continuing.")
+        #grab privates ================
+        self.rootpath = rootpath
+        self.dtype = dtype
+        self.fill_value = fill_value
+        self.str_blending = str_blending
+        self.max_openrasters = max_openrasters
+        #make internals ================
+        self.dict_patient_to_raster = OrderedDict() #the open rasters, from the least recently written.
+        self.dict_patient_to_sumweights = {}
+        self.set_patientswithraster = set() #the patients whose raster is created (open or closed).
+    
+    def get_fname(self, patient):
+        '''
+        Returns the path of the raster of a patient.
+        '''
+        return os.path.join(self.rootpath, "patient_{}.npy".format(patient.int_uniqueid))
+    
+    def _get_raster(self, patient, c, h, kernel_size, WSI_W, WSI_H):
+        '''
+        Returns the raster of a patient, and creates (or reopens) it if needed.
+        '''
+        if(patient in self.dict_patient_to_raster):
+            self.dict_patient_to_raster.move_to_end(patient)
+            return self.dict_patient_to_raster[patient]
+        if(len(self.dict_patient_to_raster) >= self.max_openrasters):
+            self._close_raster(next(iter(self.dict_patient_to_raster.keys())))
+        if(patient in self.set_patientswithraster):
+            self._reopen_raster(patient)
+        else:
+            scale_wsi_to_raster = kernel_size/h
+            shape_raster = (int(math.ceil(WSI_H/scale_wsi_to_raster)),
+                            int(math.ceil(WSI_W/scale_wsi_to_raster)), c)
+            raster = np.lib.format.open_memmap(self.get_fname(patient), mode="w+",
+                                               dtype=self.dtype, shape=shape_raster)
+            if((self.fill_value != 0.0) and (self.str_blending == "last")):
+                raster[...] = self.fill_value
+            self.dict_patient_to_raster[patient] = raster
+            if(self.str_blending != "last"):
+                self.dict_patient_to_sumweights[patient] = np.lib.format.open_memmap(
+                        self._get_fname_sumweights(patient), mode="w+",
+                        dtype=np.float32, shape=shape_raster[0:2]
+                    )
+            self.set_patientswithraster.add(patient)
+        return self.dict_patient_to_raster[patient]
+    
+    def _close_raster(self, patient):
+        '''
+        Flushes and closes the memory-maps of a patient, without normalizing them (see `flush_and_close_patient`).
+        '''
+        raster = self.dict_patient_to_raster.pop(patient)
+        raster.flush()
+        del raster
+        if(patient in self.dict_patient_to_sumweights):
+            sumweights = self.dict_patient_to_sumweights.pop(patient)
+            sumweights.flush()
+            del sumweights
+    
+    def _reopen_raster(self, patient):
+        '''
+        Reopens the memory-maps of a patient which are closed by `_close_raster`.
+        '''
+        self.dict_patient_to_raster[patient] = np.lib.format.open_memmap(self.get_fname(patient), mode="r+")
+        if(self.str_blending != "last"):
+            self.dict_patient_to_sumweights[patient] = np.lib.format.open_memmap(
+                    self._get_fname_sumweights(patient), mode="r+"
+                )
+    
+    def _get_fname_sumweights(self, patient):
+        return os.path.join(self.rootpath, "patient_{}_sumweights.npy".format(patient.int_uniqueid))
+    
+    def write(self, patient, np_chw, x, y, kernel_size, WSI_W, WSI_H):
+        '''
+        Writes the output of a tile into the raster of the patient.
+        Inputs.
+            - patient: an instance of `Patient`.
+            - np_chw: the output of the tile, a numpy array of shape [C x h x w].
+            - x, y: the top-left corner of the tile in the image.
+            - kernel_size: the width of the tile in the image.
+            - WSI_W, WSI_H: the size of the image.
+        '''
+        c, h, w = np_chw.shape
+        raster = self._get_raster(patient, c, h, kernel_size, WSI_W, WSI_H)
+        scale_wsi_to_raster = kernel_size/h
+        x_onraster = int(math.floor(x/scale_wsi_to_raster))
+        y_onraster = int(math.floor(y/scale_wsi_to_raster))
+        #clip the block to the raster ====
+        h_valid = max(min(h, raster.shape[0]-y_onraster), 0)
+        w_valid = max(min(w, raster.shape[1]-x_onraster), 0)
+        np_block = np.transpose(np_chw[:, 0:h_valid, 0:w_valid], [1,2,0])
+        if(self.str_blending == "last"):
+            raster[y_onraster:y_onraster+h_valid, x_onraster:x_onraster+w_valid, :] = np_block
+        else:
+            np_weights = get_tileweights(h, w, self.str_blending)[0:h_valid, 0:w_valid]
+            raster[y_onraster:y_onraster+h_valid, x_onraster:x_onraster+w_valid, :] += np_block*np_weights[:,:,None]
+            self.dict_patient_to_sumweights[patient][y_onraster:y_onraster+h_valid, x_onraster:x_onraster+w_valid] += np_weights
+    
+    def flush_and_close(self):
+        '''
+        Flushes all rasters to disk, and returns a dictionary that maps each patient to the path of its raster.
+        '''
+        toret = {}
+        for patient in list(self.set_patientswithraster):
+            toret[patient] = self.flush_and_close_patient(patient)
+        return toret
+    
+    def flush_and_close_patient(self, patient):
+        '''
+        Flushes the raster of a patient to disk, removes it from memory, and returns the path of the raster
+        (None if nothing is written for the patient).
+        In "average" and "weighted" modes, the raster is first normalized by the sum of weights (a block of rows at a time),
+        and the temporary raster of the sum of weights is deleted.
+        '''
+        if(patient not in self.set_patientswithraster):
+            return None
+        if(patient not in self.dict_patient_to_raster):
+            self._reopen_raster(patient)
+        self.set_patientswithraster.remove(patient)
+        raster = self.dict_patient_to_raster.pop(patient)
+        if(self.str_blending != "last"):
+            sumweights = self.dict_patient_to_sumweights.pop(patient)
+            for y_begin in range(0, raster.shape[0], 1024):
+                np_sumweights = np.asarray(sumweights[y_begin:y_begin+1024])
+                np_block = np.asarray(raster[y_begin:y_begin+1024])
+                np_block[np_sumweights > 0] /= np_sumweights[np_sumweights > 0][:, None]
+                np_block[np_sumweights == 0] = self.fill_value
+                raster[y_begin:y_begin+1024] = np_block
+            del sumweights #closes the memory-map
+            os.remove(self._get_fname_sumweights(patient))
+        raster.flush()
+        return self.get_fname(patient)
+
+
+
+class LazyStats(object):
+    def __init__(self, np_stats, patient, fname_meta=None, np_metaoffsets=None):
+        '''
+        The stats of a patient which are spilled to disk by `StatSpiller`.
+        It behaves like a list of `ProcessedPiece`s (i.e. `len`, indexing, and iteration), 
+        and the stats are also available as one (memory-mapped) numpy array.
+        The source `SmallChunk`s are rebuilt (without data) from the file of their metadata when they are accessed.
+        Inputs.
+            - np_stats: a numpy array of shape [N x ...], the stats.
+            - patient: the patient of the stats.
+            - fname_meta: the file of the metadata of the source smallchunks (see `StatSpiller._spill`).
+            - np_metaoffsets: a numpy array of length N, the offset of the metadata of each smallchunk in `fname_meta`.
+        '''
+        self.np_stats = np_stats
+        self.patient = patient
+        self.fname_meta = fname_meta
+        self.np_metaoffsets = np_metaoffsets
+    
+    def __len__(self):
+        return self.np_stats.shape[0]
+    
+    def _read_piece(self, file_meta, n):
+        from pydmed.streamcollector import ProcessedPiece
+        from pydmed.lightdl import SmallChunk
+        offset_begin = int(self.np_metaoffsets[n])
+        if(n < (len(self)-1)):
+            size_record = int(self.np_metaoffsets[n+1]) - offset_begin
+        else:
+            size_record = -1 #until the end of the file.
+        file_meta.seek(offset_begin)
+        dict_info_of_smallchunk, dict_info_of_bigchunk = pickle.loads(file_meta.read(size_record))
+        smallchunk = SmallChunk(data="None to avoid memory leak",
+                                dict_info_of_smallchunk=dict_info_of_smallchunk,
+                                dict_info_of_bigchunk=dict_info_of_bigchunk,
+                                patient=self.patient)
+        return ProcessedPiece(smallchunk, stat=self.np_stats[n])
+    
+    def __getitem__(self, n):
+        if(isinstance(n, slice)):
+            return [self[u] for u in range(len(self))[n]]
+        if(n < 0):
+            n += len(self)
+        if((n < 0) or (n >= len(self))):
+            raise IndexError("LazyStats index out of range.")
+        with open(self.fname_meta, "rb") as file_meta:
+            return self._read_piece(file_meta, n)
+    
+    def __iter__(self):
+        if(len(self) == 0):
+            return
+        with open(self.fname_meta, "rb") as file_meta:
+            for n in range(len(self)):
+                yield self._read_piece(file_meta, n)
+
+
+class StatSpiller(object):
+    def __init__(self, rootpath, maxbytes_inmemory=1024**3):
+        '''
+        Keeps the stats of patients (e.g., in the "saveall" mode of `StreamCollector`) with bounded memory.
+        The stats are kept in memory until their total size exceeds `maxbytes_inmemory`, and then
+        all of them are appended to one binary file per patient (i.e. patient_{int_uniqueid}_stats.bin in `rootpath`).
+        The stats of each patient must have the same shape and dtype.
+        The metadata of the source smallchunks (i.e. `dict_info_of_smallchunk` and `dict_info_of_bigchunk`) are spilled as well,
+        to patient_{int_uniqueid}_meta.bin (pickled records) and patient_{int_uniqueid}_metaoffsets.bin (the int64 offsets of the records),
+        so the memory usage does not grow with the number of tiles.
+        Inputs:
+            - rootpath: the directory of the files, it must be empty.
+            - maxbytes_inmemory: the maximum size of the stats kept in memory, in bytes. Default is 1GB.
+        '''
+        if(len(list(os.listdir(rootpath))) > 0):
+            print(list(os.listdir(rootpath)))
+            raise Exception("The folder {} \n is not empty.".format(rootpath)+\
+                    " Delete its files before continuing.")
+        #grab privates ================
+        self.rootpath = rootpath
+        self.maxbytes_inmemory = maxbytes_inmemory
+        #make internals ================
+        self.nbytes_inmemory = 0
+        self.dict_patient_to_liststats = {} #the stats in memory.
+        self.dict_patient_to_listmeta = {} #the metadata of the source smallchunks in memory.
+        self.dict_patient_to_dtypeshape = {}
+        self.dict_patient_to_numspilled = {}
+        self.dict_patient_to_sizemeta = {} #the size of the file of metadata.
+    
+    def get_fname(self, patient):
+        return os.path.join(self.rootpath, "patient_{}_stats.bin".format(patient.int_uniqueid))
+    
+    def get_fname_meta(self, patient):
+        return os.path.join(self.rootpath, "patient_{}_meta.bin".format(patient.int_uniqueid))
+    
+    def get_fname_metaoffsets(self, patient):
+        return os.path.join(self.rootpath, "patient_{}_metaoffsets.bin".format(patient.int_uniqueid))
+    
+    def append(self, patient, stat, source_smallchunk):
+        '''
+        Adds a stat of a patient.
+        '''
+        np_stat = np.asarray(stat)
+        if(patient not in self.dict_patient_to_dtypeshape):
+            self.dict_patient_to_dtypeshape[patient] = (np_stat.dtype, np_stat.shape)
+            self.dict_patient_to_liststats[patient] = []
+            self.dict_patient_to_listmeta[patient] = []
+            self.dict_patient_to_numspilled[patient] = 0
+            self.dict_patient_to_sizemeta[patient] = 0
+        if(self.dict_patient_to_dtypeshape[patient] != (np_stat.dtype, np_stat.shape)):
+            raise Exception("All stats of a patient must have the same dtype and shape to be spilled to disk,"+\
+                            " expected {} but got {}.".format(self.dict_patient_to_dtypeshape[patient], (np_stat.dtype, np_stat.shape)))
+        self.dict_patient_to_liststats[patient].append(np_stat)
+        self.dict_patient_to_listmeta[patient].append((source_smallchunk.dict_info_of_smallchunk,
+                                                       source_smallchunk.dict_info_of_bigchunk)) #the data of the smallchunk is not kept.
+        self.nbytes_inmemory += np_stat.nbytes
+        if(self.nbytes_inmemory > self.maxbytes_inmemory):
+            for patient_tospill in self.dict_patient_to_liststats.keys():
+                self._spill(patient_tospill)
+            self.nbytes_inmemory = 0
+    
+    def _spill(self, patient):
+        '''
+        Appends the stats of a patient which are in memory (and the metadata of their source smallchunks) to its files.
+        '''
+        list_stats = self.dict_patient_to_liststats[patient]
+        if(len(list_stats) == 0):
+            return
+        with open(self.get_fname(patient), "ab") as file_stats:
+            file_stats.write(np.ascontiguousarray(np.stack(list_stats)).tobytes())
+        #spill the metadata ====
+        list_records = [pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+                        for meta in self.dict_patient_to_listmeta[patient]]
+        np_sizes = np.array([len(u) for u in list_records], dtype=np.int64)
+        np_offsets = self.dict_patient_to_sizemeta[patient] + np.cumsum(np_sizes) - np_sizes
+        with open(self.get_fname_meta(patient), "ab") as file_meta:
+            file_meta.write(b"".join(list_records))
+        with open(self.get_fname_metaoffsets(patient), "ab") as file_metaoffsets:
+            file_metaoffsets.write(np_offsets.tobytes())
+        self.dict_patient_to_sizemeta[patient] += int(np_sizes.sum())
+        self.dict_patient_to_numspilled[patient] += len(list_stats)
+        self.dict_patient_to_liststats[patient] = []
+        self.dict_patient_to_listmeta[patient] = []
+    
+    def get_lazystats(self, patient):
+        '''
+        Spills the remaining stats of a patient, and returns all stats of the patient as a `LazyStats`
+        whose `np_stats` is memory-mapped from the file of the patient.
+        '''
+        if(patient not in self.dict_patient_to_dtypeshape):
+            return LazyStats(np.zeros((0,)), patient)
+        self.nbytes_inmemory -= sum([u.nbytes for u in self.dict_patient_to_liststats[patient]])
+        self._spill(patient)
+        dtype, shape = self.dict_patient_to_dtypeshape[patient]
+        np_stats = np.memmap(self.get_fname(patient), dtype=dtype, mode="r",
+                             shape=tuple([self.dict_patient_to_numspilled[patient]] + list(shape)))
+        np_metaoffsets = np.memmap(self.get_fname_metaoffsets(patient), dtype=np.int64, mode="r",
+                                   shape=(self.dict_patient_to_numspilled[patient],))
+        return LazyStats(np_stats, patient, self.get_fname_meta(patient), np_metaoffsets)